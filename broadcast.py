@@ -0,0 +1,155 @@
+"""
+Массовые рассылки с сохранением прогресса.
+
+Рассылка - строка broadcast_jobs; выполняет ее фоновая задача лидера run_broadcasts():
+- получатели читаются пачками по BROADCAST_BATCH_SIZE по возрастанию user_id;
+- пачка уходит через диспетчер уведомлений (notifier.py): параллельно, в рамках лимитов Telegram,
+  с повтором после RetryAfter;
+- после пачки в БД сохраняются курсор и счетчики и перечитывается статус,
+  поэтому пауза и отмена срабатывают в пределах одной пачки;
+- после рестарта или смены лидера рассылка продолжается с курсора. Прерванная пачка
+  отправляется заново: ее получатели могут увидеть сообщение дважды.
+
+Бесплатный лимит бота - около 30 сообщений в секунду (200 тыс. получателей - почти два часа).
+BROADCAST_PAID_RATE включает платную рассылку Telegram со скоростью до 1000 сообщений в секунду.
+"""
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+
+from config import settings
+from database import db_commands as db
+from keyboards import get_broadcast_progress_kb
+from notifier import dispatcher, NotificationDispatcher
+
+log = logging.getLogger(__name__)
+
+STATUS_TITLES = {
+    db.BROADCAST_RUNNING: "идет",
+    db.BROADCAST_PAUSED: "на паузе",
+    db.BROADCAST_CANCELLED: "отменена",
+    db.BROADCAST_COMPLETED: "завершена",
+}
+
+_wakeup = asyncio.Event()
+
+
+def _make_dispatcher() -> NotificationDispatcher:
+    if not settings.BROADCAST_PAID_RATE:
+        return dispatcher  # Делим лимит бота с уведомлениями планировщика
+    return NotificationDispatcher(
+        global_rate=settings.BROADCAST_PAID_RATE,
+        private_chat_rate=settings.NOTIFY_PRIVATE_CHAT_RATE,
+        group_chat_per_minute=settings.NOTIFY_GROUP_CHAT_PER_MINUTE,
+        # Запрос к API идет ~200 мс: столько одновременных отправок держат заданную скорость
+        concurrency=max(settings.NOTIFY_CONCURRENCY, round(settings.BROADCAST_PAID_RATE / 5)),
+        max_retries=settings.NOTIFY_MAX_RETRIES,
+        max_background=settings.NOTIFY_BACKGROUND_MAX_PENDING,
+    )
+
+
+broadcast_dispatcher = _make_dispatcher()
+
+
+def wake():
+    """Появилась новая или возобновленная рассылка: если лидер - этот процесс, начать сразу."""
+    _wakeup.set()
+
+
+def build_progress_text(job, rate: float | None = None) -> str:
+    processed = job.sent + job.failed
+    percent = min(processed / job.total * 100, 100) if job.total else 100
+    text = f"📣 <b>Рассылка #{job.id}</b>: {STATUS_TITLES.get(job.status, job.status)}\n\n"
+    text += f"├ Обработано: {processed} из {job.total} ({percent:.0f}%)\n"
+    text += f"├ Доставлено: {job.sent}\n"
+    text += f"└ Ошибок: {job.failed} (заблокировали бота: {job.blocked})\n"
+    if rate and job.status == db.BROADCAST_RUNNING:
+        remaining = max(job.total - processed, 0)
+        text += f"\n⚡ {rate:.1f} сообщ./с, осталось ~{remaining / rate / 60:.0f} мин."
+    return text
+
+
+async def show_progress(bot: Bot, job, rate: float | None = None):
+    """Обновляет сообщение с прогрессом рассылки (если оно есть)."""
+    if job.progress_message_id is None:
+        return
+    try:
+        await dispatcher.send(job.progress_chat_id, lambda: bot.edit_message_text(
+            build_progress_text(job, rate),
+            chat_id=job.progress_chat_id,
+            message_id=job.progress_message_id,
+            reply_markup=get_broadcast_progress_kb(job.id, job.status),
+            parse_mode="HTML"
+        ))
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e).lower():
+            log.warning(f"Broadcast {job.id}: failed to update progress: {e}")
+    except Exception as e:
+        log.warning(f"Broadcast {job.id}: failed to update progress: {e}")
+
+
+async def run_job(bot: Bot, job):
+    """Рассылает пачками с курсора job, пока получатели не кончатся или статус не сменится."""
+    log.info(f"Broadcast {job.id}: starting after user {job.cursor}")
+    copy_options = {'allow_paid_broadcast': True} if settings.BROADCAST_PAID_RATE else {}
+
+    async def deliver(user_id: int) -> bool:
+        try:
+            await broadcast_dispatcher.send(user_id, lambda: bot.copy_message(
+                chat_id=user_id,
+                from_chat_id=job.from_chat_id,
+                message_id=job.message_id,
+                **copy_options
+            ))
+        except TelegramForbiddenError:
+            return False  # Бот заблокирован - диспетчер учел это в stats.blocked
+        return True
+
+    started = time.monotonic()
+    processed = 0
+    reported_at = started
+    while True:
+        user_ids = await db.get_broadcast_recipients(job.cursor, settings.BROADCAST_BATCH_SIZE)
+        if not user_ids:
+            job = (await db.set_broadcast_status(job.id, db.BROADCAST_COMPLETED, (db.BROADCAST_RUNNING,))
+                   or await db.get_broadcast(job.id))
+            break
+
+        stats = await broadcast_dispatcher.run("broadcast", user_ids, deliver)
+        processed += stats.selected
+        updated = await db.advance_broadcast(job.id, job.cursor, user_ids[-1], stats.sent, stats.failed, stats.blocked)
+        if updated is None:
+            log.warning(f"Broadcast {job.id}: cursor moved by another worker, stopping")
+            return
+        job = updated
+        if job.status != db.BROADCAST_RUNNING:
+            break
+
+        now = time.monotonic()
+        if now - reported_at >= settings.BROADCAST_PROGRESS_INTERVAL_SECONDS:
+            reported_at = now
+            await show_progress(bot, job, processed / (now - started))
+
+    log.info(f"Broadcast {job.id} {job.status}: sent {job.sent}, failed {job.failed} (blocked {job.blocked})")
+    await show_progress(bot, job)
+
+
+async def run_broadcasts(bot: Bot):
+    """Фоновая задача лидера: выполняет рассылки в статусе running по одной, в порядке создания."""
+    log.info("Starting broadcast worker...")
+    while True:
+        _wakeup.clear()
+        try:
+            job = await db.get_next_running_broadcast()
+            if job:
+                await run_job(bot, job)
+        except Exception as e:
+            log.error(f"Error in broadcast worker: {e}")
+
+        try:
+            await asyncio.wait_for(_wakeup.wait(), settings.BROADCAST_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
@@ -3,7 +3,7 @@ import json
 import logging
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import SecretStr, model_validator, BaseModel, Field
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Literal
 
 log = logging.getLogger(__name__)
 
@@ -61,12 +61,109 @@ class Settings(BaseSettings):
     # --- Список серверов X-UI ---
     XUI_SERVERS: List[XuiServer] = []
 
-    POSTGRESQL_USER: str
-    POSTGRESQL_PASSWORD: SecretStr
-    POSTGRESQL_HOST: str
-    POSTGRESQL_PORT: int = 5432  # Порт по умолчанию
-    POSTGRESQL_DBNAME: str
+    # --- База данных ---
+    # Полный URL SQLAlchemy имеет приоритет над POSTGRESQL_*,
+    # например sqlite+aiosqlite:///dev.db для локальной разработки и бенчмарков
+    DATABASE_URL: Optional[str] = None
 
+    POSTGRESQL_USER: Optional[str] = None
+    POSTGRESQL_PASSWORD: Optional[SecretStr] = None
+    POSTGRESQL_HOST: Optional[str] = None
+    POSTGRESQL_PORT: int = 5432  # Порт по умолчанию
+    POSTGRESQL_DBNAME: Optional[str] = None
+
+    # --- Миграции схемы ---
+    MIGRATION_LOCK_TIMEOUT: str = '5s'  # Сколько DDL ждет блокировку таблицы, прежде чем повторить попытку
+    MIGRATION_LOCK_RETRIES: int = 5
+    MIGRATION_BACKFILL_BATCH_SIZE: int = 5000
+    MIGRATION_BACKFILL_PAUSE_SECONDS: float = 0.1  # Пауза между пачками backfill
+
+    # --- Реплика для чтения (необязательно) ---
+    POSTGRESQL_REPLICA_HOST: str | None = None  # Не задан - все запросы идут в основную БД
+    POSTGRESQL_REPLICA_PORT: int = 5432
+    REPLICA_MAX_LAG_SECONDS: float = 5.0  # При большем отставании чтение уходит в основную БД
+    REPLICA_LAG_CHECK_INTERVAL: int = 10
+
+    # --- Кэши запросов ---
+    DB_QUERY_CACHE_SIZE: int = 1200  # Кэш скомпилированного SQL в SQLAlchemy (по умолчанию 500)
+    DB_PREPARED_STATEMENT_CACHE_SIZE: int = 500  # Подготовленные выражения на соединение asyncpg (по умолчанию 100)
+
+    # --- Кэш каталога тарифов ---
+    CATALOG_TTL_SECONDS: int = 3600  # Страховочное перечитывание каталога
+    # Синхронизировать кэши между репликами через LISTEN/NOTIFY (каталог, подписки, топики CRM)
+    CATALOG_LISTEN_NOTIFY: bool = False
+
+    # --- Кэш подписок (/sub/{token}) ---
+    SUB_CACHE_SIZE: int = 100_000
+    SUB_CACHE_TTL_SECONDS: int = 300
+    SUB_CACHE_NEGATIVE_TTL_SECONDS: int = 60  # Для неизвестных/истекших токенов
+
+    # --- Хранилище FSM в БД (database/fsm_storage.py) ---
+    FSM_STATE_TTL_SECONDS: int = 86400  # Сценарий без новых шагов удаляется через сутки
+    FSM_CACHE_SIZE: int = 10_000  # Записей в кэше процесса
+    FSM_CACHE_TTL_SECONDS: int = 300
+    FSM_CLEANUP_INTERVAL_SECONDS: int = 3600
+    FSM_CLEANUP_BATCH_SIZE: int = 1000
+
+    # --- Процессы веб-сервера (launcher.py) ---
+    WEB_WORKERS: int = 1  # > 1: несколько процессов на одном порту (SO_REUSEPORT), только с Postgres
+    WORKER_START_TIMEOUT_SECONDS: float = 60  # Сколько ждать готовности нового процесса при перезапуске
+    WORKER_STOP_TIMEOUT_SECONDS: float = 30  # Сколько ждать штатной остановки (больше UPDATE_DRAIN_TIMEOUT)
+
+    # --- Очередь апдейтов Telegram (update_queue.py) ---
+    UPDATE_WORKERS: int = 32  # Одновременно обрабатываемых апдейтов (хендлеры в основном ждут сеть)
+    UPDATE_QUEUE_SIZE: int = 2000  # Принятых, но не обработанных апдейтов; сверх - 503 и повтор от Telegram
+    UPDATE_DRAIN_TIMEOUT_SECONDS: float = 20  # Сколько при остановке дорабатывать принятые апдейты
+
+    # --- Ограничение частоты действий пользователей (middlewares/throttling.py) ---
+    # memory - корзины в процессе; database - общие для всех реплик (таблица throttle_buckets)
+    THROTTLE_BACKEND: Literal['memory', 'database'] = 'memory'
+    THROTTLE_MAX_USERS: int = 10_000  # Корзин в памяти на действие, давно не использованные вытесняются
+    THROTTLE_DEFAULT_RATE: float = 2  # Сообщений и нажатий в секунду на пользователя
+    THROTTLE_DEFAULT_BURST: int = 5
+    THROTTLE_ORDER_PER_MINUTE: float = 10  # Создание заказов и пробных ключей
+    THROTTLE_ORDER_BURST: int = 3
+    THROTTLE_PAYMENT_PER_MINUTE: float = 6  # Запросы к платежным системам (счета, проверка оплаты)
+    THROTTLE_PAYMENT_BURST: int = 2
+
+    # --- Планировщик уведомлений ---
+    SCHEDULER_LOOKAHEAD_SECONDS: int = 3600  # На сколько вперед сроки загружаются в очередь
+    SCHEDULER_RESYNC_SECONDS: int = 900  # Полная сверка с БД (должна быть меньше LOOKAHEAD)
+    SCHEDULER_RUN_HISTORY: int = 200  # Сколько последних циклов хранить (в памяти и в scheduler_runs)
+
+    # --- Выбор лидера (фоновые задачи работают только в одной реплике) ---
+    LEADER_RENEW_INTERVAL_SECONDS: float = 5  # Как часто лидер проверяет соединение с локом
+    LEADER_LEASE_TIMEOUT_SECONDS: float = 15  # Не подтвердил аренду за это время - отдает лидерство
+    LEADER_RETRY_INTERVAL_SECONDS: float = 10  # Как часто остальные пытаются стать лидером
+
+    # --- Массовая отправка уведомлений (лимиты Telegram) ---
+    NOTIFY_GLOBAL_RATE: float = 30  # Сообщений в секунду на бота
+    NOTIFY_PRIVATE_CHAT_RATE: float = 1  # Сообщений в секунду в один личный чат
+    NOTIFY_GROUP_CHAT_PER_MINUTE: int = 20  # Сообщений в минуту в одну группу (CRM)
+    NOTIFY_CONCURRENCY: int = 30  # Одновременных отправок
+    NOTIFY_MAX_RETRIES: int = 3  # Повторов после TelegramRetryAfter
+    NOTIFY_BACKGROUND_MAX_PENDING: int = 1000  # Фоновых отправок в CRM (send_later), сверх - отбрасываются
+
+    # --- Массовые рассылки ---
+    BROADCAST_BATCH_SIZE: int = 200  # Получателей между сохранениями прогресса (после рестарта повторится не больше)
+    BROADCAST_PROGRESS_INTERVAL_SECONDS: float = 5  # Как часто обновлять сообщение с прогрессом
+    BROADCAST_POLL_SECONDS: float = 5  # Как часто лидер проверяет новые и возобновленные рассылки
+    # > 0: платная рассылка (allow_paid_broadcast) с этой скоростью, до 1000 сообщений в секунду.
+    # Сообщения сверх бесплатного лимита оплачиваются Telegram Stars с баланса бота
+    BROADCAST_PAID_RATE: float = 0
+
+    # --- Архивация старых данных ---
+    ARCHIVE_STALE_ORDERS_AFTER_DAYS: int = 7  # Неоплаченные (pending/failed) заказы
+    ARCHIVE_EXPIRED_KEYS_AFTER_DAYS: int = 30  # Ключи, истекшие и уже отработанные планировщиком
+    ARCHIVE_BATCH_SIZE: int = 1000
+    ARCHIVE_INTERVAL_SECONDS: int = 3600
+
+    @model_validator(mode='after')
+    def check_database_settings(self):
+        postgres_fields = (self.POSTGRESQL_USER, self.POSTGRESQL_PASSWORD, self.POSTGRESQL_HOST, self.POSTGRESQL_DBNAME)
+        if not self.DATABASE_URL and not all(postgres_fields):
+            raise ValueError("Укажите DATABASE_URL или все параметры POSTGRESQL_USER/PASSWORD/HOST/DBNAME")
+        return self
 
     @property
     def get_admin_ids(self) -> list[int]:
@@ -0,0 +1,98 @@
+"""
+Кэш каталога тарифов (Products) в памяти процесса.
+
+Каталог меняется крайне редко, а читается на каждом шаге покупки,
+поэтому он целиком загружается при старте и индексируется по ID и по стране.
+
+Инвалидация:
+- явная: invalidate() после изменения таблицы products;
+- по TTL: каталог перечитывается не реже CATALOG_TTL_SECONDS;
+- между репликами: NOTIFY в канал CATALOG_CHANNEL (если включено CATALOG_LISTEN_NOTIFY).
+"""
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+from sqlalchemy import select
+
+from database.models import Products
+
+log = logging.getLogger(__name__)
+
+# Канал Postgres LISTEN/NOTIFY для синхронизации каталога между репликами
+CATALOG_CHANNEL = "products_changed"
+
+# Служебный тариф для счетов из CRM, обычным пользователям не показывается
+CUSTOM_PAYMENT_PRODUCT_NAME = "Кастомный платеж"
+
+
+class ProductCatalog:
+    """Индексированный снимок таблицы products."""
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._by_id = {}
+        self._by_country = defaultdict(list)
+        self._common = []  # Тарифы без страны (country is NULL)
+        self._all = []
+        self._loaded_at = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_fresh(self) -> bool:
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl_seconds
+
+    def invalidate(self):
+        """Помечает каталог устаревшим: следующее чтение перезагрузит его из БД."""
+        self._loaded_at = None
+
+    async def load(self, session_factory):
+        """Перечитывает таблицу products и перестраивает индексы."""
+        async with session_factory() as session:
+            result = await session.execute(select(Products).order_by(Products.c.id))
+            rows = result.fetchall()
+
+        by_id = {}
+        by_country = defaultdict(list)
+        common = []
+        for row in rows:
+            by_id[row.id] = row
+            if row.country is None:
+                common.append(row)
+            else:
+                by_country[row.country].append(row)
+
+        # Подменяем ссылки целиком, чтобы читатели не видели полупостроенный индекс
+        self._by_id, self._by_country, self._common, self._all = by_id, by_country, common, rows
+        self._loaded_at = time.monotonic()
+        log.info(f"Каталог тарифов загружен: {len(rows)} шт.")
+
+    async def ensure_loaded(self, session_factory):
+        """Read-through: загружает каталог, если он пуст или устарел."""
+        if self.is_fresh:
+            return
+        async with self._lock:
+            # Пока ждали блокировку, каталог мог загрузить другой вызов
+            if not self.is_fresh:
+                await self.load(session_factory)
+
+    def get(self, product_id: int):
+        return self._by_id.get(product_id)
+
+    def find_by_name(self, name: str):
+        return next((p for p in self._all if p.name == name), None)
+
+    def list(self, country: str | None = None, include_custom: bool = False) -> list:
+        """
+        Повторяет семантику прежнего SQL-запроса get_products:
+        со страной - тарифы страны плюс общие (country is NULL), без страны - все.
+        """
+        if country:
+            products = sorted(self._by_country.get(country, []) + self._common, key=lambda p: p.id)
+        else:
+            products = list(self._all)
+
+        if not include_custom:
+            products = [p for p in products if p.name != CUSTOM_PAYMENT_PRODUCT_NAME]
+        return products
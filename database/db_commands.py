@@ -1,23 +1,155 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import socket
 import uuid
+from types import SimpleNamespace
+from typing import NamedTuple
 
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import select, insert, update, func
-from database.models import metadata, DB_URL, Users, Products, Orders, Keys, Admins, Referrals
+from sqlalchemy import select, insert, update, delete, func, text, tuple_, case, true, exists, cast, bindparam, Float
+from config import settings
+from database.cache import TTLCache, MISSING
+from database.catalog import ProductCatalog, CATALOG_CHANNEL, CUSTOM_PAYMENT_PRODUCT_NAME
+from database.pagination import NEXT, PREV, AT, decode_cursor
+from database import metrics
+from database.migrations import run_migrations
+from database.dialect import IS_POSTGRES, upsert_insert, greatest, add_interval
+from database.routing import replica_state, read_only, pin_to_primary, is_reading_from_replica, RoutingSession
+from database.models import DB_URL, REPLICA_DB_URL, Users, Products, Orders, Keys, Admins, Referrals, \
+    OrdersArchive, KeysArchive, ProcessedPaymentEvents, SchedulerRuns, BroadcastJobs, ThrottleBuckets
 import datetime
 
-engine = create_async_engine(
-    DB_URL,
+log = logging.getLogger(__name__)
+
+_ENGINE_OPTIONS = dict(
     pool_recycle=1800,
-    pool_pre_ping=True
+    pool_pre_ping=True,
+    query_cache_size=settings.DB_QUERY_CACHE_SIZE,
+)
+if IS_POSTGRES:
+    # Горячие запросы выполняются как подготовленные выражения asyncpg, кэш - на каждое соединение
+    _ENGINE_OPTIONS['connect_args'] = {'prepared_statement_cache_size': settings.DB_PREPARED_STATEMENT_CACHE_SIZE}
+
+engine = create_async_engine(DB_URL, **_ENGINE_OPTIONS)
+replica_engine = create_async_engine(REPLICA_DB_URL, **_ENGINE_OPTIONS) if REPLICA_DB_URL else None
+replica_state.configure(engine, replica_engine)
+
+# Движок выбирается на каждый запрос: @read_only функции могут читать с реплики (см. database/routing.py)
+AsyncSessionLocal = sessionmaker(class_=AsyncSession, sync_session_class=RoutingSession, expire_on_commit=False)
+
+# Отставание реплики: 0, если все полученное WAL уже применено (иначе простой мастера выглядел бы как лаг)
+_REPLICA_LAG_SQL = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+# Запросы горячего пути собираются один раз при импорте: на вызове не строится выражение
+# и не пересчитывается ключ кэша компиляции SQLAlchemy, подставляются только параметры
+GET_KEY_BY_ID_STMT = select(Keys).where(Keys.c.id == bindparam('key_id'))
+GET_ORDER_BY_ID_STMT = select(Orders).where(Orders.c.id == bindparam('order_id'))
+COUNT_USER_KEYS_STMT = select(func.count()).select_from(Keys).where(Keys.c.user_id == bindparam('user_id'))
+UPDATE_USER_MENU_ID_STMT = (
+    update(Users)
+    .where(Users.c.user_id == bindparam('target_user_id'))
+    .values(last_menu_id=bindparam('message_id'))
 )
-AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+GET_ACTIVE_KEY_BY_TOKEN_STMT = select(Keys.c.vless_key, Keys.c.expires_at).where(
+    (Keys.c.subscription_token == bindparam('token')) &
+    (Keys.c.expires_at > bindparam('now'))
+)
+
+# Идентификатор процесса для захвата строк планировщиком (несколько реплик не дублируют уведомления)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+# Через сколько захват считается протухшим (воркер упал, не отметив отправку)
+CLAIM_TTL = datetime.timedelta(minutes=15)
+# Сколько строк захватывает один вызов
+CLAIM_BATCH_SIZE = 500
+
+# Каталог тарифов в памяти процесса (см. database/catalog.py)
+product_catalog = ProductCatalog(ttl_seconds=settings.CATALOG_TTL_SECONDS)
+_catalog_listener_conn = None
+
+# Кэши редко меняющихся справочных запросов.
+# Админы задаются ADMIN_IDS и записываются в БД при старте, поэтому кэш админов сбрасывать не нужно
+_admin_cache = TTLCache('is_admin', maxsize=1_000, ttl=300, negative_ttl=300)
+# Негативный TTL короткий, а при создании топика остальные процессы получают NOTIFY CACHE_CHANNEL
+_topic_cache = TTLCache('crm_topic_id', maxsize=50_000, ttl=3600, negative_ttl=60)
+_users_count_cache = TTLCache('users_count', maxsize=1, ttl=120)
+
+
+class SubscriptionEntry(NamedTuple):
+    """Готовый ответ для /sub/{token}."""
+    body: bytes  # base64 от vless-ключа
+    etag: str
+    expires_at: datetime.datetime
+
+
+# Кэш подписок: V2Ray-клиенты опрашивают ссылку очень часто, а ключ меняется редко.
+# Запись живет не дольше самого ключа, поэтому истечение не требует явной инвалидации.
+_subscription_cache = TTLCache(
+    'subscription',
+    maxsize=settings.SUB_CACHE_SIZE,
+    ttl=settings.SUB_CACHE_TTL_SECONDS,
+    negative_ttl=settings.SUB_CACHE_NEGATIVE_TTL_SECONDS
+)
+
+# Канал Postgres LISTEN/NOTIFY для кэшей справочных запросов: "<worker_id> <кэш> <ключ> <ключ> ..."
+CACHE_CHANNEL = "lookup_cache_changed"
+# NOTIFY ограничен 8000 байт - ключи рассылаются пачками
+_NOTIFY_KEYS_PER_MESSAGE = 100
+# Кэши, которые сбрасываются во всех процессах, и тип их ключей (в уведомлении ключ - строка)
+_SHARED_CACHES = {
+    _topic_cache.name: (_topic_cache, int),
+    _subscription_cache.name: (_subscription_cache, str),
+}
 
 
 async def init_db():
-    """Инициализация БД и создание таблиц"""
-    async with engine.begin() as conn:
-        await conn.run_sync(metadata.create_all)
+    """Инициализация БД: создание таблиц и миграции схемы (database/migrations.py)"""
+    await run_migrations(engine)
+
+
+async def check_replica_lag():
+    """Замеряет отставание реплики и включает/выключает чтение с нее."""
+    try:
+        async with replica_engine.connect() as conn:
+            lag = (await conn.execute(_REPLICA_LAG_SQL)).scalar()
+    except Exception as e:
+        lag = None
+        log.warning(f"Реплика недоступна, чтение идет с основной БД: {e}")
+
+    healthy = lag is not None and lag <= settings.REPLICA_MAX_LAG_SECONDS
+    if healthy != replica_state.healthy:
+        log.info(f"Чтение с реплики {'включено' if healthy else 'отключено'} (лаг: {lag})")
+    replica_state.healthy = healthy
+    replica_state.lag_seconds = lag
+
+
+async def check_database(timeout: float = 2.0) -> bool:
+    """Быстрая проверка доступности основной БД (для /health)."""
+    async def _ping():
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    try:
+        await asyncio.wait_for(_ping(), timeout)
+        return True
+    except Exception as e:
+        log.warning(f"Основная БД недоступна: {e!r}")
+        return False
+
+
+async def monitor_replica_lag():
+    """Фоновая задача: периодически проверяет отставание реплики."""
+    if replica_engine is None:
+        return
+    while True:
+        await check_replica_lag()
+        await asyncio.sleep(settings.REPLICA_LAG_CHECK_INTERVAL)
 
 
 async def get_or_create_user(user_id: int, username: str, first_name: str) -> int | None:
@@ -42,58 +174,142 @@ async def get_or_create_user(user_id: int, username: str, first_name: str) -> in
                         last_menu_id=None  #
                     )
                 )
+                await metrics.record_funnel(session, metrics.STAGE_REGISTERED)
                 await session.commit()
                 return None  #
             else:
+                if user.chat_status != CHAT_ACTIVE:
+                    # Пользователь снова пишет боту (/start) - значит, чат снова доступен
+                    await session.execute(
+                        update(Users)
+                        .where(Users.c.user_id == user_id)
+                        .values(chat_status=CHAT_ACTIVE, chat_status_changed_at=func.now())
+                    )
                 #
                 return user.last_menu_id  #
 
 
-async def update_user_menu_id(user_id: int, message_id: int):
-    """Обновляет ID последнего меню пользователя."""
+# Состояние личного чата с пользователем (Users.chat_status)
+CHAT_ACTIVE = "active"
+CHAT_BLOCKED = "blocked"  # Пользователь заблокировал бота
+CHAT_DEACTIVATED = "deactivated"  # Аккаунт удален
+
+
+async def set_chat_status(user_id: int, status: str) -> bool:
+    """Меняет chat_status пользователя. Возвращает True, если статус действительно изменился."""
     async with AsyncSessionLocal() as session:
         async with session.begin():
-            await session.execute(
+            result = await session.execute(
                 update(Users)
-                .where(Users.c.user_id == user_id)
-                .values(last_menu_id=message_id)
+                .where((Users.c.user_id == user_id) & (Users.c.chat_status != status))
+                .values(chat_status=status, chat_status_changed_at=func.now())
             )
+            return result.rowcount > 0
+
+
+def _chat_is_active(user_id_column):
+    """Условие для массовых отправок: пользователь не заблокировал бота и не удалил аккаунт."""
+    return exists().where((Users.c.user_id == user_id_column) & (Users.c.chat_status == CHAT_ACTIVE))
+
+
+async def update_user_menu_id(user_id: int, message_id: int):
+    """Обновляет ID последнего меню пользователя."""
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            await session.execute(UPDATE_USER_MENU_ID_STMT, {'target_user_id': user_id, 'message_id': message_id})
             await session.commit()
 
 
+async def load_product_catalog():
+    """Загружает каталог тарифов в память (вызывается при старте)."""
+    await product_catalog.load(AsyncSessionLocal)
+
+
+async def invalidate_product_catalog():
+    """
+    Сбрасывает кэш каталога после изменения таблицы products.
+    Если включен LISTEN/NOTIFY, остальные реплики получат сигнал и тоже сбросят кэш.
+    """
+    product_catalog.invalidate()
+    if settings.CATALOG_LISTEN_NOTIFY and IS_POSTGRES:
+        async with engine.begin() as conn:
+            await conn.execute(text(f"NOTIFY {CATALOG_CHANNEL}"))
+
+
+def _on_catalog_notify(connection, pid, channel, payload):
+    """Колбэк asyncpg: другая реплика изменила каталог."""
+    log.info(f"Получен {channel} от pid {pid}, каталог тарифов будет перечитан.")
+    product_catalog.invalidate()
+
+
+async def _notify_cache_changed(session, cache: TTLCache, keys):
+    """
+    Сбрасывает ключи кэша в остальных процессах (если включен LISTEN/NOTIFY).
+    Уведомление уходит при коммите транзакции session, вместе с данными.
+    """
+    if not settings.CATALOG_LISTEN_NOTIFY or not IS_POSTGRES:
+        return
+    keys = [str(key) for key in keys]
+    for start in range(0, len(keys), _NOTIFY_KEYS_PER_MESSAGE):
+        payload = " ".join([WORKER_ID, cache.name, *keys[start:start + _NOTIFY_KEYS_PER_MESSAGE]])
+        await session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                              {'channel': CACHE_CHANNEL, 'payload': payload})
+
+
+def _on_cache_notify(connection, pid, channel, payload):
+    """Колбэк asyncpg: другой процесс изменил данные кэша справочных запросов."""
+    worker_id, name, *keys = payload.split(" ")
+    if worker_id == WORKER_ID or name not in _SHARED_CACHES:
+        return
+    cache, key_type = _SHARED_CACHES[name]
+    for key in keys:
+        cache.invalidate(key_type(key))
+
+
+async def start_catalog_listener():
+    """
+    Подписывается на CATALOG_CHANNEL и CACHE_CHANNEL на отдельном соединении.
+    Соединение держится открытым всё время работы процесса.
+    """
+    global _catalog_listener_conn
+    if not settings.CATALOG_LISTEN_NOTIFY or not IS_POSTGRES or _catalog_listener_conn is not None:
+        return
+    conn = await engine.connect()
+    raw_conn = await conn.get_raw_connection()
+    await raw_conn.driver_connection.add_listener(CATALOG_CHANNEL, _on_catalog_notify)
+    await raw_conn.driver_connection.add_listener(CACHE_CHANNEL, _on_cache_notify)
+    _catalog_listener_conn = conn
+    log.info(f"Подписка на {CATALOG_CHANNEL} и {CACHE_CHANNEL} включена.")
+
+
+async def close_db():
+    """Закрывает соединения с БД при остановке процесса (сессии Postgres завершаются сразу)."""
+    global _catalog_listener_conn
+    if _catalog_listener_conn is not None:
+        conn, _catalog_listener_conn = _catalog_listener_conn, None
+        await conn.close()
+    await engine.dispose()
+    if replica_engine is not None:
+        await replica_engine.dispose()
+
+
 async def get_products(country: str | None = None, include_custom: bool = False):
     """
-    Получает список тарифов.
-    Если указана страна, фильтрует по ней.
+    Получает список тарифов (из кэша каталога).
+    Если указана страна, возвращает тарифы страны и общие тарифы (где country is NULL).
 
     Args:
         country: Страна для фильтрации
         include_custom: Если True, включает "Кастомный платеж" (для CRM)
     """
-    async with AsyncSessionLocal() as session:
-        stmt = select(Products)
-
-        # Исключаем "Кастомный платеж" для обычных пользователей
-        if not include_custom:
-            stmt = stmt.where(Products.c.name != "Кастомный платеж")
-
-        if country:
-            # Фильтруем по стране ИЛИ выбираем общие тарифы (где country is NULL)
-            stmt = stmt.where((Products.c.country == country) | (Products.c.country == None))
-        else:
-            # Если страна не указана, показываем все (или только общие? Решай сам)
-            pass  # Показываем все
-        result = await session.execute(stmt)
-        return result.fetchall()
+    await product_catalog.ensure_loaded(AsyncSessionLocal)
+    return product_catalog.list(country=country, include_custom=include_custom)
 
 
 async def get_product_by_id(product_id: int):
-    """Получает продукт по ID"""
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(Products).where(Products.c.id == product_id)
-        )
-        return result.fetchone()
+    """Получает продукт по ID (из кэша каталога)"""
+    await product_catalog.ensure_loaded(AsyncSessionLocal)
+    return product_catalog.get(product_id)
 
 
 async def get_or_create_custom_payment_product() -> int:
@@ -101,11 +317,16 @@ async def get_or_create_custom_payment_product() -> int:
     Получает или создает специальный продукт для кастомных платежей.
     Возвращает ID продукта.
     """
+    await product_catalog.ensure_loaded(AsyncSessionLocal)
+    product = product_catalog.find_by_name(CUSTOM_PAYMENT_PRODUCT_NAME)
+    if product:
+        return product.id
+
     async with AsyncSessionLocal() as session:
         async with session.begin():
-            # Ищем продукт с названием "Кастомный платеж"
+            # Кэш мог устареть - перепроверяем в БД
             result = await session.execute(
-                select(Products).where(Products.c.name == "Кастомный платеж")
+                select(Products).where(Products.c.name == CUSTOM_PAYMENT_PRODUCT_NAME)
             )
             product = result.fetchone()
 
@@ -115,7 +336,7 @@ async def get_or_create_custom_payment_product() -> int:
             # Если не найден - создаем
             result = await session.execute(
                 insert(Products).values(
-                    name="Кастомный платеж",
+                    name=CUSTOM_PAYMENT_PRODUCT_NAME,
                     price=0,  # Цена будет указана в заказе
                     duration_days=0,  # Длительность не применима
                     country=None  # Не привязан к стране
@@ -123,7 +344,9 @@ async def get_or_create_custom_payment_product() -> int:
             )
             product_id = result.scalar_one()
             await session.commit()
-            return product_id
+
+    await invalidate_product_catalog()
+    return product_id
 
 
 async def create_order(user_id: int, product_id: int, amount: float) -> int:
@@ -143,25 +366,149 @@ async def create_order(user_id: int, product_id: int, amount: float) -> int:
             return order_id
 
 
-async def update_order_status(order_id: int, payment_id: str, status: str = 'paid'):
-    """Обновляет статус заказа и ID платежа"""
+async def update_order_status(order_id: int, payment_id: str, status: str = 'pending'):
+    """
+    Обновляет статус заказа и ID платежа (данные неоплаченного заказа).
+    Оплату фиксирует только mark_order_paid; оплаченный заказ здесь не меняется.
+    """
     async with AsyncSessionLocal() as session:
         async with session.begin():
             await session.execute(
                 update(Orders).
-                where(Orders.c.id == order_id).
+                where((Orders.c.id == order_id) & (Orders.c.status != 'paid')).
                 values(status=status, payment_id=payment_id)
             )
             await session.commit()
 
 
-async def get_order_by_id(order_id: int):
-    """Получает заказ по ID"""
+# Платежные системы (orders.provider)
+PROVIDER_YOOKASSA = "yookassa"
+PROVIDER_CRYPTO_BOT = "crypto_bot"
+
+
+async def mark_order_paid(order_id: int, provider: str, payment_id: str, restore_archived: bool = False) -> bool:
+    """
+    Переводит заказ из 'pending' в 'paid' - единственная точка фиксации оплаты.
+    Первым записывается событие платежа (уникально по provider, payment_id), затем
+    UPDATE ... WHERE status = 'pending': из повторных и параллельных доставок одного уведомления
+    (и ручной проверки оплаты) True получает ровно одна, и только она выдает ключ.
+    Дубликат отсекается одним запросом.
+    С restore_archived заказ, которого нет в orders, ищется в архиве: счет мог быть оплачен
+    после переноса заказа в orders_archive.
+    """
     async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(Orders).where(Orders.c.id == order_id)
-        )
-        return result.fetchone()
+        async with session.begin():
+            result = await session.execute(
+                upsert_insert(ProcessedPaymentEvents)
+                .values(provider=provider, payment_id=payment_id, order_id=order_id)
+                .on_conflict_do_nothing()
+                .returning(ProcessedPaymentEvents.c.order_id)
+            )
+            if result.first() is None:
+                return False  # Платеж уже зачтен (в этом или другом заказе)
+
+            paid = await _set_order_paid(session, order_id, provider, payment_id)
+            if not paid and restore_archived and await _restore_archived_order(session, order_id):
+                paid = await _set_order_paid(session, order_id, provider, payment_id)
+            if not paid:
+                # Заказа нет или он уже оплачен другим платежом - событие не сохраняем
+                await session.rollback()
+                return False
+            await metrics.record_order_paid(session, order_id)
+    return True
+
+
+async def _set_order_paid(session, order_id: int, provider: str, payment_id: str) -> bool:
+    result = await session.execute(
+        update(Orders)
+        .where((Orders.c.id == order_id) & (Orders.c.status == 'pending'))
+        .values(status='paid', provider=provider, payment_id=payment_id, paid_at=datetime.datetime.now())
+        .returning(Orders.c.id)
+    )
+    return result.first() is not None
+
+
+async def get_order_by_id(order_id: int, include_archived: bool = False):
+    """Получает заказ по ID (с include_archived ищет и в orders_archive)"""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(GET_ORDER_BY_ID_STMT, {'order_id': order_id})
+        order = result.fetchone()
+        if order is None and include_archived:
+            result = await session.execute(
+                select(OrdersArchive).where(OrdersArchive.c.id == order_id)
+            )
+            order = result.fetchone()
+        return order
+
+
+class KeyChange(NamedTuple):
+    """Ключ выдан или его срок изменился."""
+    key_id: int
+    order_id: int | None  # None - пробный ключ
+    expires_at: datetime.datetime
+
+
+_key_change_listeners = []
+
+# Канал Postgres LISTEN/NOTIFY: ключ выдан или продлен в другом процессе.
+# "<worker_id> <key_id> <order_id или -> <expires_at>"; слушает только лидер (планировщик)
+KEY_CHANNEL = "key_changed"
+
+
+def add_key_change_listener(listener):
+    """
+    listener(KeyChange) вызывается после коммита выдачи или продления ключа в этом процессе,
+    а при открытой подписке start_key_change_listener - и в остальных.
+    Вызов синхронный, в event loop бота - слушатель не должен блокировать.
+    """
+    if listener not in _key_change_listeners:  # Задача планировщика перезапускается при смене лидера
+        _key_change_listeners.append(listener)
+
+
+def _notify_key_changed(change: KeyChange):
+    for listener in _key_change_listeners:
+        try:
+            listener(change)
+        except Exception as e:
+            log.error(f"Ошибка обработчика изменения ключа {change.key_id}: {e}")
+
+
+async def _publish_key_changed(session, change: KeyChange):
+    """Сообщает об изменении ключа остальным процессам. Уведомление уходит при коммите session."""
+    if not IS_POSTGRES:
+        return
+    order_id = '-' if change.order_id is None else change.order_id
+    payload = f"{WORKER_ID} {change.key_id} {order_id} {change.expires_at.isoformat()}"
+    await session.execute(text("SELECT pg_notify(:channel, :payload)"), {'channel': KEY_CHANNEL, 'payload': payload})
+
+
+def _on_key_notify(connection, pid, channel, payload):
+    """Колбэк asyncpg: ключ выдан или продлен в другом процессе."""
+    worker_id, key_id, order_id, expires_at = payload.split(" ")
+    if worker_id == WORKER_ID:
+        return  # Свои изменения слушатели уже получили
+    _notify_key_changed(KeyChange(
+        int(key_id), None if order_id == '-' else int(order_id), datetime.datetime.fromisoformat(expires_at)
+    ))
+
+
+async def start_key_change_listener():
+    """
+    Подписывается на KEY_CHANNEL на отдельном соединении (только Postgres), чтобы слушатели
+    add_key_change_listener получали изменения из всех процессов.
+    Возвращает соединение (его нужно закрыть, когда слушать больше не нужно) или None.
+    """
+    if not IS_POSTGRES:
+        return None
+    conn = await engine.connect()
+    try:
+        raw_conn = await conn.get_raw_connection()
+        await raw_conn.driver_connection.add_listener(KEY_CHANNEL, _on_key_notify)
+    except Exception:
+        await conn.close()
+        raise
+    log.info(f"Подписка на {KEY_CHANNEL} включена.")
+    return conn
 
 
 async def add_vless_key(user_id: int, order_id: int, vless_key: str, expires_at: datetime.datetime) -> uuid.UUID:
@@ -171,62 +518,153 @@ async def add_vless_key(user_id: int, order_id: int, vless_key: str, expires_at:
     async with AsyncSessionLocal() as session:
         async with session.begin():
             new_token = uuid.uuid4()
-            await session.execute(
+            result = await session.execute(
                 insert(Keys).values(
                     user_id=user_id,
                     order_id=order_id,
                     vless_key=vless_key,
                     expires_at=expires_at,
                     subscription_token=new_token  #
-                )
+                ).returning(Keys.c.id)
             )
+            key_id = result.scalar_one()
+            await metrics.record_key_activated(session, vless_key)
+            # Промах по токену мог закэшироваться в другом процессе
+            await _notify_cache_changed(session, _subscription_cache, [new_token])
+            change = KeyChange(key_id, order_id, expires_at)
+            await _publish_key_changed(session, change)
             await session.commit()
-            return new_token
+        invalidate_subscription(new_token)
+        _notify_key_changed(change)
+        return new_token
 
 
-async def get_user_keys(user_id: int, page: int = 0, page_size: int = 5):  # Добавили page, page_size
-    """Получает ключи пользователя для указанной страницы."""
+@read_only
+async def get_user_keys(user_id: int, limit: int = 5):
+    """
+    Получает ключи пользователя с самым поздним сроком действия.
+    Для постраничного вывода - get_user_keys_page.
+    """
     async with AsyncSessionLocal() as session:
-        offset = page * page_size
         stmt = (
             select(Keys)
             .where(Keys.c.user_id == user_id)
-            .order_by(Keys.c.expires_at.desc())
-            .limit(page_size)
-            .offset(offset)
+            .order_by(Keys.c.expires_at.desc(), Keys.c.id.desc())
+            .limit(limit)
         )
         result = await session.execute(stmt)
         return result.fetchall()
 
 
+@read_only
 async def count_user_keys(user_id: int) -> int:
     """Считает общее количество ключей пользователя."""
     async with AsyncSessionLocal() as session:
-        stmt = select(func.count()).select_from(Keys).where(Keys.c.user_id == user_id)
-        result = await session.execute(stmt)
+        result = await session.execute(COUNT_USER_KEYS_STMT, {'user_id': user_id})
         count = result.scalar_one_or_none()
         return count if count is not None else 0
 
 
-async def get_key_by_id(key_id: int):
-    """Получает один ключ по его ID."""
+async def get_key_by_id(key_id: int, include_archived: bool = False):
+    """Получает один ключ по его ID (с include_archived ищет и в keys_archive)."""
     async with AsyncSessionLocal() as session:
-        stmt = select(Keys).where(Keys.c.id == key_id)
-        result = await session.execute(stmt)
-        return result.fetchone()
+        result = await session.execute(GET_KEY_BY_ID_STMT, {'key_id': key_id})
+        key = result.fetchone()
+        if key is None and include_archived:
+            result = await session.execute(select(KeysArchive).where(KeysArchive.c.id == key_id))
+            key = result.fetchone()
+        return key
+
 
+class KeyExtension(NamedTuple):
+    key_id: int
+    user_id: int
+    order_id: int | None
+    vless_key: str
+    subscription_token: uuid.UUID
+    old_expires_at: datetime.datetime
+    new_expires_at: datetime.datetime
 
-async def update_key_expiry(key_id: int, new_expires_at: datetime.datetime):
-    """Обновляет дату истечения срока действия ключа."""
+
+async def _extend_key(session, key_id: int, interval: datetime.timedelta, user_id: int | None = None):
+    """
+    Продлевает ключ одним UPDATE: новый срок считается в БД от max(expires_at, now),
+    поэтому параллельные продления складываются, а не затирают друг друга.
+    Сбрасывает флаги уведомлений - о новом сроке пользователь будет предупрежден заново.
+    Кэш подписки вызывающий сбрасывает после коммита.
+    """
+    now = datetime.datetime.now()
+    key_filter = Keys.c.id == key_id
+    if user_id is not None:
+        key_filter &= Keys.c.user_id == user_id
+    old = select(Keys.c.id, Keys.c.expires_at, Keys.c.has_sent_expiry_notification).where(key_filter)
+
+    stmt = update(Keys).values(
+        # now передается из Python, как и во всех остальных запросах (колонки без часового пояса)
+        expires_at=add_interval(greatest(Keys.c.expires_at, now), interval),
+        has_sent_renewal_warning=False,
+        has_sent_trial_warning=False,
+        has_sent_expiry_notification=False,
+        # Планировщик мог захватить ключ под старый срок - после продления он снова свободен
+        claimed_by=None,
+        claimed_at=None,
+    )
+    new_values = (Keys.c.user_id, Keys.c.order_id, Keys.c.vless_key, Keys.c.subscription_token, Keys.c.expires_at)
+
+    if IS_POSTGRES:
+        # Старые значения берутся из заблокированной строки в FROM - все за один запрос
+        old = old.with_for_update().subquery()
+        result = await session.execute(
+            stmt.where(Keys.c.id == old.c.id)
+            .returning(*new_values, old.c.expires_at, old.c.has_sent_expiry_notification)
+        )
+        row = result.fetchone()
+        if row is None:
+            return None
+        user_id, order_id, vless_key, token, new_expires_at, old_expires_at, was_expired = row
+    else:
+        # RETURNING в SQLite не видит таблиц из FROM. Первым идет запись: она берет блокировку
+        # базы, и дальше старые значения читаются без гонок с параллельным продлением
+        result = await session.execute(
+            update(Keys)
+            .where(key_filter & (Keys.c.has_sent_expiry_notification == True))
+            .values(has_sent_expiry_notification=False)
+            .returning(Keys.c.id)
+        )
+        was_expired = result.first() is not None
+        result = await session.execute(old)
+        previous = result.fetchone()
+        if previous is None:
+            return None
+        result = await session.execute(stmt.where(key_filter).returning(*new_values))
+        user_id, order_id, vless_key, token, new_expires_at = result.one()
+        old_expires_at = previous.expires_at
+
+    # Истекший ключ снова активен
+    if was_expired:
+        await metrics.record_key_activated(session, vless_key)
+    await _notify_cache_changed(session, _subscription_cache, [token])
+    await _publish_key_changed(session, KeyChange(key_id, order_id, new_expires_at))
+    return KeyExtension(key_id, user_id, order_id, vless_key, token, old_expires_at, new_expires_at)
+
+
+async def extend_key(key_id: int, interval: datetime.timedelta, user_id: int | None = None) -> KeyExtension | None:
+    """
+    Продлевает ключ на interval (от текущего срока или от now, если ключ истек).
+    С user_id продлевает, только если ключ принадлежит этому пользователю.
+    Возвращает старый и новый срок или None, если ключ не найден.
+    """
     async with AsyncSessionLocal() as session:
         async with session.begin():
-            stmt = (
-                update(Keys)
-                .where(Keys.c.id == key_id)
-                .values(expires_at=new_expires_at)
-            )
-            await session.execute(stmt)
-            await session.commit()
+            extension = await _extend_key(session, key_id, interval, user_id)
+    if extension:
+        _after_key_extended(extension)
+    return extension
+
+
+def _after_key_extended(extension: KeyExtension):
+    invalidate_subscription(extension.subscription_token)
+    _notify_key_changed(KeyChange(extension.key_id, extension.order_id, extension.new_expires_at))
 
 
 async def get_user_key_by_order_id(order_id: int):
@@ -239,19 +677,19 @@ async def get_user_key_by_order_id(order_id: int):
 
 
 async def is_admin(user_id: int) -> bool:
-    """Проверяет, является ли пользователь админом"""
+    """Проверяет, является ли пользователь админом (с кэшированием)"""
+    cached = _admin_cache.get(user_id)
+    if cached is not MISSING:
+        return cached
+
     async with AsyncSessionLocal() as session:
         result = await session.execute(
             select(Admins).where(Admins.c.user_id == user_id)
         )
-        return result.fetchone() is not None
+        is_admin_flag = result.fetchone() is not None
 
-
-async def get_all_user_ids():
-    """Получает ID всех пользователей для рассылки"""
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(select(Users.c.user_id))
-        return result.scalars().all()
+    _admin_cache.set(user_id, is_admin_flag)
+    return is_admin_flag
 
 
 # async def delete_order(order_id: int):
@@ -279,127 +717,131 @@ async def mark_trial_received(user_id: int):
         async with session.begin():
             stmt = (
                 update(Users)
-                .where(Users.c.user_id == user_id)
+                .where((Users.c.user_id == user_id) & (Users.c.has_received_trial == False))
                 .values(has_received_trial=True)
+                .returning(Users.c.user_id)
             )
-            await session.execute(stmt)
+            result = await session.execute(stmt)
+            if result.first() is not None:
+                await metrics.record_funnel(session, metrics.STAGE_TRIAL)
             await session.commit()
 
 
-async def get_all_active_keys_details():
-    """
-    Получает детальную информацию по всем АКТИВНЫМ ключам.
-    Джойнит Keys, Users, Orders, Products.
-    Учитывает пробные ключи (где order_id is None).
-    """
-    async with AsyncSessionLocal() as session:
-        now = datetime.datetime.now()
-
-        stmt = (
-            select(
-                Keys.c.vless_key,
-                Keys.c.expires_at,
-                Users.c.user_id,
-                Users.c.first_name,
-                Users.c.username,
-                Products.c.name.label("product_name"),
-                Products.c.duration_days
-            )
-            .join(Users, Keys.c.user_id == Users.c.user_id)
-            .outerjoin(Orders, Keys.c.order_id == Orders.c.id)
-            .outerjoin(Products, Orders.c.product_id == Products.c.id)
-            .where(Keys.c.expires_at > now)  # Выбираем только активные ключи
-            .order_by(Keys.c.expires_at.asc())  # Сначала те, что скоро истекут
-        )
-
-        result = await session.execute(stmt)
-        return result.fetchall()
+def _is_unclaimed(table, now: datetime.datetime):
+    """Строка свободна, если её никто не захватил или захват протух (воркер упал)."""
+    return table.c.claimed_at.is_(None) | (table.c.claimed_at < now - CLAIM_TTL)
 
 
-async def get_keys_for_renewal_warning(hours: int = 24):
+async def get_keys_for_expiry_notification(limit: int = CLAIM_BATCH_SIZE):
     """
-    Находит ПЛАТНЫЕ ключи, которые истекают через 23-24 часа,
-    И о которых ЕЩЕ НЕ ПРЕДУПРЕЖДАЛИ.
+    Захватывает ВСЕ ключи (включая пробные), которые УЖЕ ИСТЕКЛИ,
+    И о которых ЕЩЕ НЕ УВЕДОМЛЯЛИ.
+    Захват атомарный (FOR UPDATE SKIP LOCKED), поэтому несколько реплик делят работу без дублей.
     """
     async with AsyncSessionLocal() as session:
-        now = datetime.datetime.now()
-        in_X_minus_1_hours = now + datetime.timedelta(hours=hours - 1)
-        in_X_hours = now + datetime.timedelta(hours=hours)
+        async with session.begin():
+            now = datetime.datetime.now()
 
-        stmt = (
-            select(Keys.c.user_id, Keys.c.id, Products.c.name)
-            .join(Orders, Keys.c.order_id == Orders.c.id)
-            .join(Products, Orders.c.product_id == Products.c.id)
-            .where(
-                (Keys.c.expires_at > in_X_minus_1_hours) &
-                (Keys.c.expires_at <= in_X_hours) &
-                (Keys.c.order_id.is_not(None)) &
-                (Keys.c.has_sent_renewal_warning == False)
+            candidates = (
+                select(Keys.c.id)
+                .where(
+                    (Keys.c.expires_at <= now) &
+                    (Keys.c.has_sent_expiry_notification == False) &
+                    _is_unclaimed(Keys, now) &
+                    _chat_is_active(Keys.c.user_id)
+                )
+                .limit(limit)
+                .with_for_update(skip_locked=True)
             )
-        )
-        result = await session.execute(stmt)
-        return result.fetchall()
+            stmt = (
+                update(Keys)
+                .where(Keys.c.id.in_(candidates))
+                .values(claimed_by=WORKER_ID, claimed_at=now)
+                .returning(Keys.c.user_id, Keys.c.id, Keys.c.order_id)
+            )
+            result = await session.execute(stmt)
+            return result.fetchall()
 
 
-async def get_keys_for_expiry_notification():
-    """
-    Находит ВСЕ ключи (включая пробные), которые УЖЕ ИСТЕКЛИ,
-    И о которых ЕЩЕ НЕ УВЕДОМЛЯЛИ.
-    """
+async def get_keys_for_renewal_warning(hours: int = 24, limit: int = CLAIM_BATCH_SIZE):
+    """Захватывает ПЛАТНЫЕ ключи, которые истекают через указанное время."""
     async with AsyncSessionLocal() as session:
-        now = datetime.datetime.now()
+        async with session.begin():
+            now = datetime.datetime.now()
+            in_X_hours = now + datetime.timedelta(hours=hours)
+            # Берем диапазон, чтобы не спамить, если бот лежал
+            in_X_minus_some_hours = now + datetime.timedelta(hours=max(1, hours - 2))
 
-        stmt = (
-            select(Keys.c.user_id, Keys.c.id, Keys.c.order_id)
-            .where(
-                (Keys.c.expires_at <= now) &  #
-                (Keys.c.has_sent_expiry_notification == False)  #
+            candidates = (
+                select(Keys.c.id)
+                .where(
+                    (Keys.c.expires_at > in_X_minus_some_hours) &
+                    (Keys.c.expires_at <= in_X_hours) &
+                    (Keys.c.order_id.is_not(None)) &
+                    (Keys.c.has_sent_renewal_warning == False) &
+                    _is_unclaimed(Keys, now) &
+                    _chat_is_active(Keys.c.user_id)
+                )
+                .limit(limit)
+                .with_for_update(skip_locked=True)
             )
-        )
-        result = await session.execute(stmt)
-        return result.fetchall()
-
-
-async def get_keys_for_renewal_warning(hours: int = 24):
-    """Находит ПЛАТНЫЕ ключи, которые истекают через указанное время."""
-    async with AsyncSessionLocal() as session:
-        now = datetime.datetime.now()
-        in_X_hours = now + datetime.timedelta(hours=hours)
-        # Берем диапазон, чтобы не спамить, если бот лежал
-        in_X_minus_some_hours = now + datetime.timedelta(hours=max(1, hours - 2))
+            if not IS_POSTGRES:
+                # RETURNING в SQLite не видит таблиц из FROM - название тарифа читаем вторым запросом
+                result = await session.execute(
+                    update(Keys)
+                    .where(Keys.c.id.in_(candidates))
+                    .values(claimed_by=WORKER_ID, claimed_at=now)
+                    .returning(Keys.c.id)
+                )
+                claimed_ids = result.scalars().all()
+                result = await session.execute(
+                    select(Keys.c.user_id, Keys.c.id, Products.c.name)
+                    .join(Orders, Keys.c.order_id == Orders.c.id)
+                    .join(Products, Orders.c.product_id == Products.c.id)
+                    .where(Keys.c.id.in_(claimed_ids))
+                )
+                return result.fetchall()
 
-        stmt = (
-            select(Keys.c.user_id, Keys.c.id, Products.c.name)
-            .join(Orders, Keys.c.order_id == Orders.c.id)
-            .join(Products, Orders.c.product_id == Products.c.id)
-            .where(
-                (Keys.c.expires_at > in_X_minus_some_hours) &
-                (Keys.c.expires_at <= in_X_hours) &
-                (Keys.c.order_id.is_not(None)) &
-                (Keys.c.has_sent_renewal_warning == False)
+            stmt = (
+                update(Keys)
+                .where(Keys.c.id.in_(candidates))
+                .where(Keys.c.order_id == Orders.c.id)
+                .where(Orders.c.product_id == Products.c.id)
+                .values(claimed_by=WORKER_ID, claimed_at=now)
+                .returning(Keys.c.user_id, Keys.c.id, Products.c.name)
             )
-        )
-        result = await session.execute(stmt)
-        return result.fetchall()
+            result = await session.execute(stmt)
+            return result.fetchall()
 
 
-async def get_trial_keys_for_warning(hours: int = 2):
-    """Находит ПРОБНЫЕ ключи, истекающие скоро (для Task 4)."""
+async def get_trial_keys_for_warning(hours: int = 2, limit: int = CLAIM_BATCH_SIZE):
+    """Захватывает ПРОБНЫЕ ключи, истекающие скоро (для Task 4)."""
     async with AsyncSessionLocal() as session:
-        now = datetime.datetime.now()
-        in_X_hours = now + datetime.timedelta(hours=hours)
+        async with session.begin():
+            now = datetime.datetime.now()
+            in_X_hours = now + datetime.timedelta(hours=hours)
 
-        stmt = (
-            select(Keys.c.user_id, Keys.c.id)
-            .where(
-                (Keys.c.expires_at > now) &
-                (Keys.c.expires_at <= in_X_hours) &
-                (Keys.c.order_id.is_(None)) &  # Только пробные
-                (Keys.c.has_sent_trial_warning == False)
+            candidates = (
+                select(Keys.c.id)
+                .where(
+                    (Keys.c.expires_at > now) &
+                    (Keys.c.expires_at <= in_X_hours) &
+                    (Keys.c.order_id.is_(None)) &  # Только пробные
+                    (Keys.c.has_sent_trial_warning == False) &
+                    _is_unclaimed(Keys, now) &
+                    _chat_is_active(Keys.c.user_id)
+                )
+                .limit(limit)
+                .with_for_update(skip_locked=True)
             )
-        )
-        result = await session.execute(stmt)
-        return result.fetchall()
+            stmt = (
+                update(Keys)
+                .where(Keys.c.id.in_(candidates))
+                .values(claimed_by=WORKER_ID, claimed_at=now)
+                .returning(Keys.c.user_id, Keys.c.id)
+            )
+            result = await session.execute(stmt)
+            return result.fetchall()
 
 
 async def mark_trial_warning_sent(key_id: int):
@@ -409,7 +851,7 @@ async def mark_trial_warning_sent(key_id: int):
             stmt = (
                 update(Keys)
                 .where(Keys.c.id == key_id)
-                .values(has_sent_trial_warning=True)
+                .values(has_sent_trial_warning=True, claimed_by=None, claimed_at=None)
             )
             await session.execute(stmt)
             await session.commit()
@@ -422,36 +864,102 @@ async def mark_renewal_warning_sent(key_id: int):
             stmt = (
                 update(Keys)
                 .where(Keys.c.id == key_id)
-                .values(has_sent_renewal_warning=True)
+                .values(has_sent_renewal_warning=True, claimed_by=None, claimed_at=None)
             )
             await session.execute(stmt)
             await session.commit()
 
 
 async def mark_expiry_notification_sent(key_id: int):
-    """Отмечает, что уведомление об истечении было отправлено."""
+    """
+    Отмечает, что уведомление об истечении было отправлено.
+    С этого момента ключ не считается активным в метриках серверов.
+    """
     async with AsyncSessionLocal() as session:
         async with session.begin():
             stmt = (
                 update(Keys)
-                .where(Keys.c.id == key_id)
-                .values(has_sent_expiry_notification=True)
+                .where((Keys.c.id == key_id) & (Keys.c.has_sent_expiry_notification == False))
+                .values(has_sent_expiry_notification=True, claimed_by=None, claimed_at=None)
+                .returning(Keys.c.vless_key, Keys.c.subscription_token)
             )
-            await session.execute(stmt)
+            result = await session.execute(stmt)
+            expired_key = result.fetchone()
+            if expired_key is not None:
+                await metrics.record_key_expired(session, expired_key.vless_key)
             await session.commit()
+    if expired_key is not None:
+        invalidate_subscription(expired_key.subscription_token)
+
+
+async def _release_claims(id_column, ids: list[int]):
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            for start in range(0, len(ids), CLAIM_BATCH_SIZE):
+                await session.execute(
+                    update(id_column.table)
+                    .where(id_column.in_(ids[start:start + CLAIM_BATCH_SIZE]) &
+                           (id_column.table.c.claimed_by == WORKER_ID))
+                    .values(claimed_by=None, claimed_at=None)
+                )
+
+
+async def release_key_claims(key_ids: list[int]):
+    """
+    Снимает захват с ключей, уведомление по которым не отправилось. Захват общий для всех фаз,
+    поэтому иначе ключ ждал бы CLAIM_TTL и в остальных фазах (например, истечение после
+    неудачного предупреждения).
+    """
+    await _release_claims(Keys.c.id, key_ids)
+
+
+async def close_expired_keys_of_inactive_chats(limit: int = CLAIM_BATCH_SIZE) -> int:
+    """
+    Отмечает уведомленными истекшие ключи пользователей, заблокировавших бота, - без отправки.
+    Иначе такие ключи не попали бы в метрики истечения и в архив. Возвращает число ключей.
+    """
+    closed = []
+    while True:
+        async with AsyncSessionLocal() as session:
+            async with session.begin():
+                now = datetime.datetime.now()
+                candidates = (
+                    select(Keys.c.id)
+                    .where(
+                        (Keys.c.expires_at <= now) &
+                        (Keys.c.has_sent_expiry_notification == False) &
+                        _is_unclaimed(Keys, now) &
+                        ~_chat_is_active(Keys.c.user_id)
+                    )
+                    .limit(limit)
+                    .with_for_update(skip_locked=True)
+                )
+                result = await session.execute(
+                    update(Keys)
+                    .where(Keys.c.id.in_(candidates))
+                    .values(has_sent_expiry_notification=True, claimed_by=None, claimed_at=None)
+                    .returning(Keys.c.vless_key, Keys.c.subscription_token)
+                )
+                batch = result.fetchall()
+                for key in batch:
+                    await metrics.record_key_expired(session, key.vless_key)
+        closed.extend(batch)
+        if len(batch) < limit:
+            break
+
+    for key in closed:
+        invalidate_subscription(key.subscription_token)
+    return len(closed)
 
 
+@read_only
 async def get_key_by_subscription_token(token: str):
     """Находит ОДИН vless_key по токену подписки (из таблицы Keys)."""
     async with AsyncSessionLocal() as session:
         now = datetime.datetime.now()
         try:
             #
-            stmt = select(Keys.c.vless_key).where(
-                (Keys.c.subscription_token == token) &
-                (Keys.c.expires_at > now)  #
-            )
-            result = await session.execute(stmt)
+            result = await session.execute(GET_ACTIVE_KEY_BY_TOKEN_STMT, {'token': token, 'now': now})
             return result.scalar_one_or_none()  #
         except Exception:
             #
@@ -459,28 +967,85 @@ async def get_key_by_subscription_token(token: str):
 
 
 
-async def get_users_for_trial_reminder(hours_min: int = 24, hours_max: int = 25):
+@read_only
+async def get_subscription(token: str) -> SubscriptionEntry | None:
+    """
+    Возвращает готовый ответ подписки по токену или None (токен неизвестен / ключ истек).
+    Read-through кэш: в БД идем только на промахе.
     """
-    Находит пользователей, которые зарегистрировались X часов назад,
+    entry = _subscription_cache.get(token)
+    now = datetime.datetime.now()
+    if entry is not MISSING:
+        if entry is None or entry.expires_at > now:
+            return entry
+        _subscription_cache.invalidate(token)
+
+    try:
+        token_uuid = uuid.UUID(token)
+    except ValueError:
+        _subscription_cache.set(token, None)
+        return None
+
+    params = {'token': token_uuid, 'now': now}
+    async with AsyncSessionLocal() as session:
+        key = (await session.execute(GET_ACTIVE_KEY_BY_TOKEN_STMT, params)).fetchone()
+
+    if not key and is_reading_from_replica():
+        # Только что выданный ключ мог еще не доехать до реплики - не кэшируем промах по ней
+        with pin_to_primary():
+            async with AsyncSessionLocal() as session:
+                key = (await session.execute(GET_ACTIVE_KEY_BY_TOKEN_STMT, params)).fetchone()
+
+    if not key:
+        _subscription_cache.set(token, None)
+        return None
+
+    body = base64.b64encode(key.vless_key.encode('utf-8'))
+    entry = SubscriptionEntry(body=body, etag=f'"{hashlib.sha1(body).hexdigest()}"', expires_at=key.expires_at)
+    ttl = min(settings.SUB_CACHE_TTL_SECONDS, (key.expires_at - now).total_seconds())
+    _subscription_cache.set(token, entry, ttl=ttl)
+    return entry
+
+
+def invalidate_subscription(token: uuid.UUID | str | None):
+    """Сбрасывает кэш подписки (продление, истечение, новый ключ)."""
+    if token is not None:
+        _subscription_cache.invalidate(str(token))
+
+
+async def get_users_for_trial_reminder(hours_min: int = 24, hours_max: int = 25, limit: int = CLAIM_BATCH_SIZE):
+    """
+    Захватывает пользователей, которые зарегистрировались X часов назад,
     не брали триал и не получали напоминание.
     """
     async with AsyncSessionLocal() as session:
-        now = datetime.datetime.now()
-        # Ищем тех, кто зарегистрировался 24-25 часов назад
-        min_time_ago = now - datetime.timedelta(hours=hours_max)
-        max_time_ago = now - datetime.timedelta(hours=hours_min)
+        async with session.begin():
+            now = datetime.datetime.now()
+            # Ищем тех, кто зарегистрировался 24-25 часов назад
+            min_time_ago = now - datetime.timedelta(hours=hours_max)
+            max_time_ago = now - datetime.timedelta(hours=hours_min)
 
-        stmt = (
-            select(Users.c.user_id)
-            .where(
-                (Users.c.created_at > min_time_ago) &
-                (Users.c.created_at <= max_time_ago) &
-                (Users.c.has_received_trial == False) &
-                (Users.c.has_sent_trial_reminder == False)
+            candidates = (
+                select(Users.c.user_id)
+                .where(
+                    (Users.c.created_at > min_time_ago) &
+                    (Users.c.created_at <= max_time_ago) &
+                    (Users.c.has_received_trial == False) &
+                    (Users.c.has_sent_trial_reminder == False) &
+                    (Users.c.chat_status == CHAT_ACTIVE) &
+                    _is_unclaimed(Users, now)
+                )
+                .limit(limit)
+                .with_for_update(skip_locked=True)
             )
-        )
-        result = await session.execute(stmt)
-        return result.scalars().all()
+            stmt = (
+                update(Users)
+                .where(Users.c.user_id.in_(candidates))
+                .values(claimed_by=WORKER_ID, claimed_at=now)
+                .returning(Users.c.user_id)
+            )
+            result = await session.execute(stmt)
+            return result.scalars().all()
 
 
 async def mark_trial_reminder_sent(user_id: int):
@@ -490,12 +1055,52 @@ async def mark_trial_reminder_sent(user_id: int):
             stmt = (
                 update(Users)
                 .where(Users.c.user_id == user_id)
-                .values(has_sent_trial_reminder=True)
+                .values(has_sent_trial_reminder=True, claimed_by=None, claimed_at=None)
             )
             await session.execute(stmt)
             await session.commit()
 
 
+async def release_user_claims(user_ids: list[int]):
+    """Снимает захват с пользователей, напоминание которым не отправилось."""
+    await _release_claims(Users.c.user_id, user_ids)
+
+
+@read_only
+async def get_upcoming_key_deadlines(expires_before: datetime.datetime):
+    """
+    Ключи, истекающие до expires_before, о которых еще не уведомляли (для очереди планировщика).
+    Возвращает (id, order_id, expires_at).
+    """
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(Keys.c.id, Keys.c.order_id, Keys.c.expires_at)
+            .where(
+                (Keys.c.expires_at > datetime.datetime.now()) &
+                (Keys.c.expires_at <= expires_before) &
+                (Keys.c.has_sent_expiry_notification == False)
+            )
+        )
+        return result.fetchall()
+
+
+@read_only
+async def get_upcoming_trial_reminders(registered_before: datetime.datetime, registered_after: datetime.datetime):
+    """Время регистрации тех, кому еще предстоит напоминание о триале (для очереди планировщика)."""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(Users.c.created_at)
+            .where(
+                (Users.c.created_at > registered_after) &
+                (Users.c.created_at <= registered_before) &
+                (Users.c.has_received_trial == False) &
+                (Users.c.has_sent_trial_reminder == False) &
+                (Users.c.chat_status == CHAT_ACTIVE)
+            )
+        )
+        return result.scalars().all()
+
+
 async def update_user_topic_id(user_id: int, topic_id: int):
     """Обновляет ID топика для пользователя в CRM-группе."""
     async with AsyncSessionLocal() as session:
@@ -506,103 +1111,243 @@ async def update_user_topic_id(user_id: int, topic_id: int):
                 .values(crm_topic_id=topic_id)
             )
             await session.execute(stmt)
+            # В других процессах мог закэшироваться None - иначе они создали бы второй топик
+            await _notify_cache_changed(session, _topic_cache, [user_id])
             await session.commit()
+    # Write-through: следующий send_to_crm не пойдет в БД
+    _topic_cache.set(user_id, topic_id)
 
 
 async def get_user_topic_id(user_id: int) -> int | None:
-    """Получает ID топика пользователя в CRM-группе."""
+    """Получает ID топика пользователя в CRM-группе (с кэшированием)."""
+    cached = _topic_cache.get(user_id)
+    if cached is not MISSING:
+        return cached
+
     async with AsyncSessionLocal() as session:
         result = await session.execute(
             select(Users.c.crm_topic_id).where(Users.c.user_id == user_id)
         )
-        return result.scalar_one_or_none()
+        topic_id = result.scalar_one_or_none()
+
+    # None тоже кэшируется (с коротким TTL): у пользователя может не быть топика
+    _topic_cache.set(user_id, topic_id)
+    return topic_id
+
 
+def get_lookup_cache_stats() -> dict:
+    """Счетчики попаданий кэшей справочных запросов."""
+    return {
+        cache.name: cache.stats()
+        for cache in (_admin_cache, _topic_cache, _users_count_cache, _subscription_cache)
+    }
+
+
+@read_only
+async def get_business_dashboard(days: int = 30) -> dict:
+    """Сводка для админского дашборда из инкрементальных таблиц метрик."""
+    async with AsyncSessionLocal() as session:
+        return await metrics.read_dashboard(session, days=days)
 
+
+async def rebuild_business_metrics():
+    """Полностью пересчитывает сводные таблицы метрик."""
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            await metrics.rebuild(session)
+    log.info("Бизнес-метрики пересчитаны")
+
+
+async def ensure_business_metrics():
+    """Первичное заполнение сводных таблиц (на базе, где их еще не было)."""
+    async with AsyncSessionLocal() as session:
+        empty = await metrics.is_empty(session)
+    if empty:
+        await rebuild_business_metrics()
+
+
+@read_only
 async def count_all_users() -> int:
-    """Считает общее количество пользователей."""
+    """
+    Считает общее количество пользователей.
+    Результат кэшируется: для счетчика страниц точность до пары минут не важна,
+    а count(*) по всей таблице на каждую страницу - дорого.
+    """
+    cached = _users_count_cache.get('total')
+    if cached is not MISSING:
+        return cached
+
     async with AsyncSessionLocal() as session:
         stmt = select(func.count()).select_from(Users)
         result = await session.execute(stmt)
         count = result.scalar_one_or_none()
-        return count if count is not None else 0
+        count = count if count is not None else 0
+
+    _users_count_cache.set('total', count)
+    return count
 
 
-async def get_all_users_paginated(page: int = 0, page_size: int = 10):
+def _apply_keyset(stmt, sort_col, id_col, cursor: str | None, direction: str, page_size: int):
     """
-    Получает список всех пользователей с пагинацией.
-    Возвращает базовую информацию: user_id, username, first_name, created_at.
+    Добавляет к запросу keyset-условие, сортировку (по убыванию) и лимит.
+    Берем на одну строку больше, чтобы понять, есть ли следующая страница.
+    """
+    position = tuple_(sort_col, id_col)
+    if cursor:
+        cursor_value = tuple_(*decode_cursor(cursor))
+        if direction == PREV:
+            stmt = stmt.where(position > cursor_value)
+        elif direction == AT:
+            stmt = stmt.where(position <= cursor_value)
+        else:
+            stmt = stmt.where(position < cursor_value)
+
+    if direction == PREV and cursor:
+        stmt = stmt.order_by(sort_col.asc(), id_col.asc())
+    else:
+        stmt = stmt.order_by(sort_col.desc(), id_col.desc())
+    return stmt.limit(page_size + 1)
+
+
+def _split_keyset_page(rows: list, direction: str, cursor: str | None, page_size: int) -> tuple[list, bool]:
+    """Отрезает лишнюю строку и восстанавливает порядок для направления PREV."""
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if direction == PREV and cursor:
+        rows.reverse()
+    return rows, has_more
+
+
+@read_only
+async def get_users_page(cursor: str | None = None, direction: str = NEXT, page_size: int = 10):
+    """
+    Keyset-пагинация списка пользователей (сначала новые).
+    Время выборки не зависит от номера страницы.
+
+    Args:
+        cursor: Позиция (created_at, user_id) из encode_cursor; None - первая страница
+        direction: NEXT / PREV / AT (см. database/pagination.py)
+        page_size: Размер страницы
+
+    Returns:
+        (пользователи страницы, есть ли еще строки в направлении перехода)
     """
     async with AsyncSessionLocal() as session:
-        offset = page * page_size
-        stmt = (
-            select(Users)
-            .order_by(Users.c.created_at.desc())  # Сначала новые пользователи
-            .limit(page_size)
-            .offset(offset)
+        stmt = _apply_keyset(select(Users), Users.c.created_at, Users.c.user_id, cursor, direction, page_size)
+        result = await session.execute(stmt)
+        return _split_keyset_page(result.fetchall(), direction, cursor, page_size)
+
+
+@read_only
+async def get_user_keys_page(user_id: int, cursor: str | None = None, direction: str = NEXT, page_size: int = 5):
+    """
+    Keyset-пагинация ключей пользователя (сортировка по expires_at, сначала поздние).
+    Возвращает (ключи страницы, есть ли еще строки в направлении перехода).
+    """
+    async with AsyncSessionLocal() as session:
+        stmt = _apply_keyset(
+            select(Keys).where(Keys.c.user_id == user_id),
+            Keys.c.expires_at, Keys.c.id, cursor, direction, page_size
         )
         result = await session.execute(stmt)
-        return result.fetchall()
+        return _split_keyset_page(result.fetchall(), direction, cursor, page_size)
 
 
-async def get_user_stats_detailed(user_id: int):
+@read_only
+async def get_user_stats_detailed(user_id: int, keys_page_size: int | None = None, keys_cursor: str | None = None,
+                                  keys_direction: str = NEXT):
     """
-    Получает детальную статистику по пользователю:
+    Получает детальную статистику по пользователю одним запросом:
     - Информация о пользователе
     - Количество заказов и общая сумма
-    - Список всех ключей с деталями
-    """
-    async with AsyncSessionLocal() as session:
-        # 1. Информация о пользователе
-        user_stmt = select(Users).where(Users.c.user_id == user_id)
-        user_result = await session.execute(user_stmt)
-        user = user_result.fetchone()
+    - Список ключей с деталями (все или, если передан keys_page_size, одна keyset-страница
+      по (expires_at, id) от курсора keys_cursor; 'keys_has_more' - есть ли еще ключи в направлении перехода)
 
-        if not user:
-            return None
+    Агрегаты считаются в CTE, ключи присоединяются LEFT JOIN'ом, поэтому
+    пользователь без ключей дает одну строку с пустыми колонками ключа.
+    """
+    now = datetime.datetime.now()
 
-        # 2. Статистика по заказам
-        orders_stmt = (
-            select(
-                func.count(Orders.c.id).label('total_orders'),
-                func.sum(Orders.c.amount).label('total_spent')
-            )
-            .where(
-                (Orders.c.user_id == user_id) &
-                (Orders.c.status == 'paid')
-            )
+    order_stats = (
+        select(
+            func.count(Orders.c.id).label('total_orders'),
+            func.coalesce(func.sum(Orders.c.amount), 0.0).label('total_spent')
         )
-        orders_result = await session.execute(orders_stmt)
-        orders_stats = orders_result.fetchone()
-
-        # 3. Список всех ключей с деталями
-        now = datetime.datetime.now()
-        keys_stmt = (
-            select(
-                Keys.c.id,
-                Keys.c.vless_key,
-                Keys.c.created_at,
-                Keys.c.expires_at,
-                Keys.c.order_id,
-                Keys.c.subscription_token,
-                Products.c.name.label("product_name"),
-                Products.c.duration_days
-            )
-            .outerjoin(Orders, Keys.c.order_id == Orders.c.id)
-            .outerjoin(Products, Orders.c.product_id == Products.c.id)
-            .where(Keys.c.user_id == user_id)
-            .order_by(Keys.c.expires_at.desc())  # Сначала активные
+        .where((Orders.c.user_id == user_id) & (Orders.c.status == 'paid'))
+        .cte('order_stats')
+    )
+    key_stats = (
+        select(
+            func.count(Keys.c.id).label('total_keys_count'),
+            func.coalesce(func.sum(case((Keys.c.expires_at > now, 1), else_=0)), 0).label('active_keys_count')
+        )
+        .where(Keys.c.user_id == user_id)
+        .cte('key_stats')
+    )
+
+    keys_stmt = (
+        select(
+            Keys.c.id,
+            Keys.c.vless_key,
+            Keys.c.created_at,
+            Keys.c.expires_at,
+            Keys.c.order_id,
+            Keys.c.subscription_token,
+            Products.c.name.label("product_name"),
+            Products.c.duration_days
+        )
+        .outerjoin(Orders, Keys.c.order_id == Orders.c.id)
+        .outerjoin(Products, Orders.c.product_id == Products.c.id)
+        .where(Keys.c.user_id == user_id)
+    )
+    if keys_page_size is not None:
+        keys_stmt = _apply_keyset(keys_stmt, Keys.c.expires_at, Keys.c.id, keys_cursor, keys_direction, keys_page_size)
+    user_keys = keys_stmt.subquery('user_keys')
+
+    stmt = (
+        select(
+            *[column.label(f"user_{column.name}") for column in Users.c],
+            order_stats.c.total_orders,
+            order_stats.c.total_spent,
+            key_stats.c.total_keys_count,
+            key_stats.c.active_keys_count,
+            *user_keys.c
+        )
+        .select_from(
+            Users
+            .join(order_stats, true())
+            .join(key_stats, true())
+            .outerjoin(user_keys, true())
         )
-        keys_result = await session.execute(keys_stmt)
-        keys = keys_result.fetchall()
+        .where(Users.c.user_id == user_id)
+        .order_by(user_keys.c.expires_at.desc(), user_keys.c.id.desc())  # Сначала активные
+    )
 
-        return {
-            'user': user,
-            'total_orders': orders_stats.total_orders or 0,
-            'total_spent': orders_stats.total_spent or 0.0,
-            'keys': keys,
-            'active_keys_count': sum(1 for k in keys if k.expires_at > now),
-            'total_keys_count': len(keys)
-        }
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(stmt)
+        rows = result.fetchall()
+
+    if not rows:
+        return None
+
+    first = rows[0]
+    user = SimpleNamespace(**{column.name: getattr(first, f"user_{column.name}") for column in Users.c})
+    keys = [row for row in rows if row.id is not None]
+    keys_has_more = False
+    if keys_page_size is not None and len(keys) > keys_page_size:
+        # Лишняя строка - самая дальняя от курсора; ключи уже отсортированы по убыванию
+        keys_has_more = True
+        keys = keys[1:] if keys_direction == PREV and keys_cursor else keys[:keys_page_size]
+
+    return {
+        'user': user,
+        'total_orders': first.total_orders or 0,
+        'total_spent': first.total_spent or 0.0,
+        'keys': keys,
+        'keys_has_more': keys_has_more,
+        'active_keys_count': first.active_keys_count or 0,
+        'total_keys_count': first.total_keys_count or 0
+    }
 
 
 
@@ -677,6 +1422,7 @@ async def mark_referral_purchased(referred_id: int) -> int | None:
             return None  # Реферала нет или уже покупал
 
 
+@read_only
 async def get_referral_stats(user_id: int):
     """
     Получает статистику рефералов для пользователя.
@@ -737,7 +1483,7 @@ async def add_referral_bonus_days(referrer_id: int, bonus_days: int = 7) -> dict
 
             # Находим активный ключ реферера (срок действия ещё не истёк)
             result = await session.execute(
-                select(Keys)
+                select(Keys.c.id)
                 .where(
                     (Keys.c.user_id == referrer_id) &
                     (Keys.c.expires_at > now)
@@ -751,21 +1497,17 @@ async def add_referral_bonus_days(referrer_id: int, bonus_days: int = 7) -> dict
                 return None  # У реферера нет активных ключей
 
             # Продлеваем ключ на bonus_days
-            new_expiry = key.expires_at + datetime.timedelta(days=bonus_days)
+            extension = await _extend_key(session, key.id, datetime.timedelta(days=bonus_days))
+            if not extension:
+                return None
 
-            await session.execute(
-                update(Keys)
-                .where(Keys.c.id == key.id)
-                .values(expires_at=new_expiry)
-            )
-            await session.commit()
-
-            return {
-                'key_id': key.id,
-                'old_expiry': key.expires_at,
-                'new_expiry': new_expiry,
-                'bonus_days': bonus_days
-            }
+    _after_key_extended(extension)
+    return {
+        'key_id': extension.key_id,
+        'old_expiry': extension.old_expires_at,
+        'new_expiry': extension.new_expires_at,
+        'bonus_days': bonus_days
+    }
 
 
 async def get_referral_balance(user_id: int) -> int:
@@ -846,3 +1588,265 @@ async def use_referral_balance(user_id: int, days: int) -> tuple[bool, int]:
             await session.commit()
 
             return True, new_balance
+
+
+# --- Рассылки ---
+
+BROADCAST_RUNNING = "running"
+BROADCAST_PAUSED = "paused"
+BROADCAST_CANCELLED = "cancelled"
+BROADCAST_COMPLETED = "completed"
+
+
+async def create_broadcast(admin_id: int, from_chat_id: int, message_id: int) -> int:
+    """Создает рассылку сообщения message_id всем доступным пользователям и возвращает ее ID."""
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            total = (await session.execute(
+                select(func.count()).select_from(Users).where(Users.c.chat_status == CHAT_ACTIVE)
+            )).scalar_one()
+            result = await session.execute(
+                insert(BroadcastJobs).values(
+                    admin_id=admin_id,
+                    from_chat_id=from_chat_id,
+                    message_id=message_id,
+                    status=BROADCAST_RUNNING,
+                    total=total,
+                ).returning(BroadcastJobs.c.id)
+            )
+            return result.scalar_one()
+
+
+async def set_broadcast_progress_message(job_id: int, chat_id: int, message_id: int):
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            await session.execute(
+                update(BroadcastJobs)
+                .where(BroadcastJobs.c.id == job_id)
+                .values(progress_chat_id=chat_id, progress_message_id=message_id)
+            )
+
+
+async def get_broadcast(job_id: int):
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(select(BroadcastJobs).where(BroadcastJobs.c.id == job_id))
+        return result.first()
+
+
+async def get_next_running_broadcast():
+    """Самая старая незавершенная рассылка в статусе running."""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(BroadcastJobs)
+            .where(BroadcastJobs.c.status == BROADCAST_RUNNING)
+            .order_by(BroadcastJobs.c.id)
+            .limit(1)
+        )
+        return result.first()
+
+
+@read_only
+async def get_broadcast_recipients(after_user_id: int, limit: int) -> list[int]:
+    """Следующая пачка получателей: keyset по user_id, без OFFSET."""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(Users.c.user_id)
+            .where((Users.c.user_id > after_user_id) & (Users.c.chat_status == CHAT_ACTIVE))
+            .order_by(Users.c.user_id)
+            .limit(limit)
+        )
+        return result.scalars().all()
+
+
+async def advance_broadcast(job_id: int, from_cursor: int, to_cursor: int, sent: int, failed: int, blocked: int):
+    """
+    Сохраняет прогресс после пачки и возвращает обновленную рассылку (статус мог смениться:
+    админ поставил паузу или отменил). None - курсор уже сдвинул другой процесс.
+    """
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            result = await session.execute(
+                update(BroadcastJobs)
+                .where((BroadcastJobs.c.id == job_id) & (BroadcastJobs.c.cursor == from_cursor))
+                .values(
+                    cursor=to_cursor,
+                    sent=BroadcastJobs.c.sent + sent,
+                    failed=BroadcastJobs.c.failed + failed,
+                    blocked=BroadcastJobs.c.blocked + blocked,
+                )
+                .returning(*BroadcastJobs.c)
+            )
+            return result.first()
+
+
+async def set_broadcast_status(job_id: int, status: str, from_statuses: tuple):
+    """
+    Переводит рассылку в status, если сейчас она в одном из from_statuses.
+    Возвращает обновленную рассылку или None, если переход невозможен.
+    """
+    values = {'status': status}
+    if status in (BROADCAST_CANCELLED, BROADCAST_COMPLETED):
+        values['finished_at'] = func.now()
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            result = await session.execute(
+                update(BroadcastJobs)
+                .where((BroadcastJobs.c.id == job_id) & BroadcastJobs.c.status.in_(from_statuses))
+                .values(**values)
+                .returning(*BroadcastJobs.c)
+            )
+            return result.first()
+
+# --- Архивация ---
+
+async def _archive_batch(hot_table, archive_table, condition, batch_size: int) -> int:
+    """Переносит одну пачку строк hot_table -> archive_table в одной транзакции."""
+    columns = [column.name for column in archive_table.c if column.name != 'archived_at']
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            result = await session.execute(
+                select(hot_table.c.id)
+                .where(condition)
+                .order_by(hot_table.c.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            ids = result.scalars().all()
+            if not ids:
+                return 0
+
+            await session.execute(
+                insert(archive_table).from_select(
+                    columns, select(*[hot_table.c[name] for name in columns]).where(hot_table.c.id.in_(ids))
+                )
+            )
+            await session.execute(delete(hot_table).where(hot_table.c.id.in_(ids)))
+    return len(ids)
+
+
+async def archive_stale_rows(batch_size: int | None = None) -> dict:
+    """
+    Переносит в архив неоплаченные заказы старше ARCHIVE_STALE_ORDERS_AFTER_DAYS
+    и ключи, истекшие более ARCHIVE_EXPIRED_KEYS_AFTER_DAYS назад.
+    Работает пачками, чтобы не держать долгих блокировок. Возвращает число перенесенных строк.
+    """
+    batch_size = batch_size or settings.ARCHIVE_BATCH_SIZE
+    now = datetime.datetime.now()
+
+    # Ключ архивируется только после уведомления об истечении - иначе разъедутся метрики серверов
+    keys_condition = (
+        (Keys.c.expires_at < now - datetime.timedelta(days=settings.ARCHIVE_EXPIRED_KEYS_AFTER_DAYS)) &
+        (Keys.c.has_sent_expiry_notification == True)
+    )
+    # На заказ может ссылаться ключ (оплата прошла, а статус не обновился) - такие не трогаем
+    orders_condition = (
+        Orders.c.status.in_(('pending', 'failed')) &
+        (Orders.c.created_at < now - datetime.timedelta(days=settings.ARCHIVE_STALE_ORDERS_AFTER_DAYS)) &
+        ~exists().where(Keys.c.order_id == Orders.c.id)
+    )
+
+    moved = {'keys': 0, 'orders': 0}
+    for name, hot_table, archive_table, condition in (
+        ('keys', Keys, KeysArchive, keys_condition),
+        ('orders', Orders, OrdersArchive, orders_condition),
+    ):
+        while True:
+            count = await _archive_batch(hot_table, archive_table, condition, batch_size)
+            moved[name] += count
+            if count < batch_size:
+                break
+
+    if moved['keys'] or moved['orders']:
+        log.info(f"Архивация: ключей {moved['keys']}, заказов {moved['orders']}")
+    return moved
+
+
+async def _restore_archived_order(session, order_id: int) -> bool:
+    """
+    Возвращает заказ из архива в orders (например, оплата пришла по давно созданному счету).
+    Возвращает True, если заказ был в архиве.
+    """
+    columns = [column.name for column in OrdersArchive.c if column.name != 'archived_at']
+    source = [
+        cast(OrdersArchive.c.status, Orders.c.status.type) if name == 'status' else OrdersArchive.c[name]
+        for name in columns
+    ]
+    result = await session.execute(
+        insert(Orders).from_select(columns, select(*source).where(OrdersArchive.c.id == order_id))
+    )
+    if not result.rowcount:
+        return False
+    await session.execute(delete(OrdersArchive).where(OrdersArchive.c.id == order_id))
+    log.info(f"Заказ {order_id} восстановлен из архива")
+    return True
+
+
+# --- История планировщика ---
+
+async def save_scheduler_run(trigger: str, started_at: datetime.datetime, duration: float, lag: float,
+                             phases: dict, error: str | None = None):
+    """Записывает цикл планировщика и удаляет записи старше последних SCHEDULER_RUN_HISTORY."""
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            result = await session.execute(
+                insert(SchedulerRuns).values(
+                    worker_id=WORKER_ID,
+                    trigger=trigger,
+                    started_at=started_at,
+                    duration_ms=round(duration * 1000),
+                    lag_ms=round(lag * 1000),
+                    phases=phases,
+                    error=error,
+                ).returning(SchedulerRuns.c.id)
+            )
+            run_id = result.scalar_one()
+            await session.execute(
+                delete(SchedulerRuns).where(SchedulerRuns.c.id <= run_id - settings.SCHEDULER_RUN_HISTORY)
+            )
+
+
+@read_only
+async def get_scheduler_runs(limit: int = 10):
+    """Последние циклы планировщика (всех реплик), новые первыми."""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(SchedulerRuns).order_by(SchedulerRuns.c.id.desc()).limit(limit)
+        )
+        return result.all()
+
+
+# --- Ограничение частоты действий (middlewares/throttling.py) ---
+
+# GCRA одним запросом: новая корзина создается с tat = now + interval; существующая сдвигается,
+# только если запрос укладывается в допустимый всплеск (tat - tolerance <= now).
+# Строка вернулась - действие разрешено; не вернулась - лимит исчерпан
+_throttle_insert = upsert_insert(ThrottleBuckets).values(
+    key=bindparam('key'),
+    tat=bindparam('now', type_=Float) + bindparam('interval', type_=Float),
+)
+TAKE_THROTTLE_TOKEN_STMT = _throttle_insert.on_conflict_do_update(
+    index_elements=['key'],
+    set_={'tat': greatest(ThrottleBuckets.c.tat, bindparam('now', type_=Float)) + bindparam('interval', type_=Float)},
+    where=ThrottleBuckets.c.tat - bindparam('tolerance', type_=Float) <= bindparam('now', type_=Float),
+).returning(ThrottleBuckets.c.tat)
+
+
+async def take_throttle_token(key: str, now: float, rate: float, burst: int) -> bool:
+    """
+    Берет токен из общей корзины key (rate действий в секунду, всплеск до burst).
+    now - unix time процесса: часы реплик должны быть синхронизированы (NTP).
+    """
+    interval = 1 / rate
+    async with engine.begin() as conn:
+        result = await conn.execute(TAKE_THROTTLE_TOKEN_STMT, {
+            'key': key, 'now': now, 'interval': interval, 'tolerance': (burst - 1) * interval
+        })
+        return result.first() is not None
+
+
+async def delete_idle_throttle_buckets(now: float) -> int:
+    """Удаляет заполнившиеся корзины (tat в прошлом): они ничем не отличаются от отсутствующих."""
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            result = await session.execute(delete(ThrottleBuckets).where(ThrottleBuckets.c.tat < now))
+            return result.rowcount
@@ -0,0 +1,38 @@
+"""
+Различия между СУБД, которые нужно учитывать в коде запросов.
+
+Основная база - Postgres; SQLite (aiosqlite) поддерживается для локальной разработки
+и бенчмарков (DATABASE_URL=sqlite+aiosqlite:///...).
+"""
+import datetime
+
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+
+from database.models import DB_URL
+
+BACKEND = make_url(DB_URL).get_backend_name()
+IS_POSTGRES = BACKEND == 'postgresql'
+
+
+def upsert_insert(table):
+    """insert() текущей СУБД с поддержкой on_conflict_do_nothing / on_conflict_do_update."""
+    if BACKEND == 'sqlite':
+        return sqlite.insert(table)
+    return postgresql.insert(table)
+
+
+def greatest(*args):
+    """GREATEST(...) Postgres; в SQLite то же делает скалярный max(...)."""
+    if BACKEND == 'sqlite':
+        return func.max(*args)
+    return func.greatest(*args)
+
+
+def add_interval(expr, interval: datetime.timedelta):
+    """expr + interval для колонки/выражения DateTime."""
+    if BACKEND == 'sqlite':
+        # Дата хранится строкой; datetime() сдвигает ее и отбрасывает микросекунды
+        return func.datetime(expr, f"{interval.total_seconds():+f} seconds", type_=expr.type)
+    return expr + interval
@@ -0,0 +1,219 @@
+"""
+Хранилище FSM aiogram в основной БД (таблица fsm_states) вместо MemoryStorage.
+Состояние сценариев переживает рестарт и видно всем репликам бота.
+
+- Чтение: FSMContextMiddleware читает состояние на каждом апдейте, поэтому записи
+  (в том числе отсутствие записи) кэшируются в процессе; промах - один SELECT по ключу.
+- Запись (write-back): set_state/set_data меняют только кэш и помечают ключ;
+  FSMFlushMiddleware после обработки апдейта сохраняет одним запросом ключи, измененные
+  этим апдейтом (track_changes): незаконченные шаги параллельных апдейтов не записываются.
+  Шаг сценария (set_state + update_data) - один upsert вместо нескольких запросов.
+- Пустая запись (state=None, data={}) после state.clear() удаляется из таблицы.
+- Запись живет FSM_STATE_TTL_SECONDS с последнего изменения; брошенные сценарии
+  удаляет cleanup_expired() (фоновая задача лидера).
+- Между репликами: сохраненные ключи рассылаются через NOTIFY FSM_CHANNEL,
+  остальные реплики сбрасывают их в своем кэше.
+
+Чтения идут только в основную БД: с реплики можно было бы прочитать прошлый шаг сценария.
+"""
+import datetime
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, NamedTuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, KeyBuilder, DefaultKeyBuilder
+from sqlalchemy import select, delete, text, bindparam
+
+from config import settings
+from database.cache import TTLCache, MISSING
+from database.dialect import IS_POSTGRES, upsert_insert
+from database.models import FsmStates
+
+log = logging.getLogger(__name__)
+
+# Канал Postgres LISTEN/NOTIFY: "<worker_id> <ключ> <ключ> ..."
+FSM_CHANNEL = "fsm_changed"
+# NOTIFY ограничен 8000 байт - ключи рассылаются пачками
+_NOTIFY_KEYS_PER_MESSAGE = 100
+
+# Ключи, измененные в текущем апдейте (см. track_changes); None - вне апдейта
+_changed_keys = ContextVar('fsm_changed_keys', default=None)
+
+GET_FSM_RECORD_STMT = select(FsmStates.c.state, FsmStates.c.data).where(
+    (FsmStates.c.key == bindparam('key')) & (FsmStates.c.expires_at > bindparam('now'))
+)
+
+
+class FsmRecord(NamedTuple):
+    state: str | None
+    data: dict
+
+    @property
+    def is_empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+EMPTY_RECORD = FsmRecord(None, {})
+
+
+@contextmanager
+def track_changes():
+    """Собирает ключи FSM, измененные внутри блока (и в запущенных из него задачах)."""
+    keys = set()
+    token = _changed_keys.set(keys)
+    try:
+        yield keys
+    finally:
+        _changed_keys.reset(token)
+
+
+class DatabaseStorage(BaseStorage):
+    """BaseStorage aiogram поверх таблицы fsm_states."""
+
+    def __init__(self, engine, worker_id: str, key_builder: KeyBuilder | None = None,
+                 cache_size: int | None = None, cache_ttl: float | None = None):
+        self.engine = engine
+        self.worker_id = worker_id
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache = TTLCache(
+            'fsm',
+            maxsize=settings.FSM_CACHE_SIZE if cache_size is None else cache_size,
+            ttl=settings.FSM_CACHE_TTL_SECONDS if cache_ttl is None else cache_ttl,
+        )
+        self._dirty = {}  # Ключ -> FsmRecord, еще не сохраненная в БД
+        self._listener_conn = None
+
+    async def _load(self, key: str) -> FsmRecord:
+        record = self._dirty.get(key)
+        if record is not None:
+            return record
+        record = self._cache.get(key)
+        if record is not MISSING:
+            return record
+
+        async with self.engine.connect() as conn:
+            result = await conn.execute(GET_FSM_RECORD_STMT, {'key': key, 'now': datetime.datetime.now()})
+            row = result.first()
+        record = FsmRecord(row.state, row.data) if row else EMPTY_RECORD
+        if key not in self._dirty:  # Пока шел запрос, ключ могли изменить
+            self._cache.set(key, record)
+        return self._dirty.get(key, record)
+
+    def _put(self, key: str, old: FsmRecord, new: FsmRecord):
+        if new == old:
+            return  # state.clear() без сценария и т.п. - писать нечего
+        self._cache.set(key, new)
+        self._dirty[key] = new
+        changed = _changed_keys.get()
+        if changed is not None:
+            changed.add(key)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self.key_builder.build(key)
+        record = await self._load(storage_key)
+        self._put(storage_key, record, record._replace(state=state.state if isinstance(state, State) else state))
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._load(self.key_builder.build(key))).state
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        storage_key = self.key_builder.build(key)
+        record = await self._load(storage_key)
+        self._put(storage_key, record, record._replace(data=dict(data)))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return dict((await self._load(self.key_builder.build(key))).data)
+
+    async def flush(self, keys=None):
+        """
+        Сохраняет изменения ключей keys (после апдейта - собранные track_changes) одной транзакцией.
+        Без keys сохраняет все накопленные изменения (при остановке).
+        """
+        if keys is None:
+            dirty, self._dirty = self._dirty, {}
+        else:
+            dirty = {key: self._dirty.pop(key) for key in keys if key in self._dirty}
+        if not dirty:
+            return
+        expires_at = datetime.datetime.now() + datetime.timedelta(seconds=settings.FSM_STATE_TTL_SECONDS)
+        rows = [
+            {'key': key, 'state': record.state, 'data': record.data, 'expires_at': expires_at}
+            for key, record in dirty.items() if not record.is_empty
+        ]
+        deleted = [key for key, record in dirty.items() if record.is_empty]
+        try:
+            async with self.engine.begin() as conn:
+                if rows:
+                    stmt = upsert_insert(FsmStates)
+                    await conn.execute(
+                        stmt.on_conflict_do_update(
+                            index_elements=['key'],
+                            set_={'state': stmt.excluded.state, 'data': stmt.excluded.data,
+                                  'expires_at': stmt.excluded.expires_at}
+                        ),
+                        rows
+                    )
+                if deleted:
+                    await conn.execute(delete(FsmStates).where(FsmStates.c.key.in_(deleted)))
+                if IS_POSTGRES:
+                    # Уведомления уходят при коммите, вместе с данными
+                    keys = list(dirty)
+                    for start in range(0, len(keys), _NOTIFY_KEYS_PER_MESSAGE):
+                        payload = " ".join([self.worker_id, *keys[start:start + _NOTIFY_KEYS_PER_MESSAGE]])
+                        await conn.execute(text("SELECT pg_notify(:channel, :payload)"),
+                                           {'channel': FSM_CHANNEL, 'payload': payload})
+        except Exception:
+            # Изменения остаются в очереди до следующего изменения ключа или остановки,
+            # если их не перекрыли более новые
+            for key, record in dirty.items():
+                self._dirty.setdefault(key, record)
+            raise
+
+    def _on_notify(self, connection, pid, channel, payload):
+        """Колбэк asyncpg: другая реплика сохранила ключи."""
+        worker_id, *keys = payload.split(" ")
+        if worker_id == self.worker_id:
+            return
+        for key in keys:
+            if key not in self._dirty:
+                self._cache.invalidate(key)
+
+    async def start_listener(self):
+        """Подписывается на FSM_CHANNEL на отдельном соединении (только Postgres)."""
+        if not IS_POSTGRES or self._listener_conn is not None:
+            return
+        conn = await self.engine.connect()
+        raw_conn = await conn.get_raw_connection()
+        await raw_conn.driver_connection.add_listener(FSM_CHANNEL, self._on_notify)
+        self._listener_conn = conn
+        log.info(f"Подписка на {FSM_CHANNEL} включена.")
+
+    async def cleanup_expired(self, batch_size: int | None = None) -> int:
+        """Удаляет записи брошенных сценариев пачками. Возвращает число удаленных."""
+        batch_size = batch_size or settings.FSM_CLEANUP_BATCH_SIZE
+        total = 0
+        while True:
+            async with self.engine.begin() as conn:
+                expired = (
+                    select(FsmStates.c.key)
+                    .where(FsmStates.c.expires_at <= datetime.datetime.now())
+                    .limit(batch_size)
+                    .with_for_update(skip_locked=True)
+                )
+                result = await conn.execute(delete(FsmStates).where(FsmStates.c.key.in_(expired)))
+            total += result.rowcount
+            if result.rowcount < batch_size:
+                return total
+
+    def stats(self) -> dict:
+        return {**self._cache.stats(), 'dirty': len(self._dirty)}
+
+    async def close(self) -> None:
+        try:
+            await self.flush()
+        finally:
+            if self._listener_conn is not None:
+                conn, self._listener_conn = self._listener_conn, None
+                await conn.close()
@@ -0,0 +1,148 @@
+"""
+Выбор лидера среди реплик бота.
+
+Лидер - процесс, взявший сессионный pg_try_advisory_lock на выделенном соединении.
+Фоновые задачи (планировщик уведомлений, архивация и т.п.) работают только у лидера.
+
+- Аренда: лидер раз в LEADER_RENEW_INTERVAL_SECONDS проверяет соединение с локом.
+  Если проверка не прошла за LEADER_LEASE_TIMEOUT_SECONDS, лидер останавливает задачи
+  и закрывает соединение - Postgres снимает лок вместе с сессией.
+- Failover: остальные процессы пытаются взять лок каждые LEADER_RETRY_INTERVAL_SECONDS.
+
+Даже при коротком пересечении двух лидеров (сеть пропала, а сервер еще не закрыл сессию)
+уведомления не дублируются: фазы планировщика захватывают строки атомарно.
+
+В SQLite (локальная разработка, один процесс) процесс всегда лидер.
+"""
+import asyncio
+import datetime
+import logging
+
+from sqlalchemy import text
+
+from config import settings
+from database.dialect import IS_POSTGRES
+
+log = logging.getLogger(__name__)
+
+# Ключ pg_advisory_lock лидера (любое число, уникальное в пределах базы)
+LEADER_LOCK_ID = 0x5650_4E02
+
+
+class LeaderElection:
+    """jobs - список (имя, фабрика корутины) задач, которые выполняет только лидер."""
+
+    def __init__(self, engine, jobs, worker_id: str, lock_id: int = LEADER_LOCK_ID):
+        self.engine = engine
+        self.jobs = jobs
+        self.worker_id = worker_id
+        self.lock_id = lock_id
+        self.is_leader = False
+        self.leader_since = None
+        self.renewed_at = None
+        self._conn = None
+        self._tasks = {}
+        self._stopped = False
+
+    async def run(self):
+        """Фоновая задача: борется за лидерство, пока процесс не остановится."""
+        log.info(f"Leader election started (worker {self.worker_id})")
+        while not self._stopped:
+            try:
+                if not IS_POSTGRES:
+                    if not self.is_leader:
+                        self._become_leader()
+                elif self.is_leader:
+                    await self._renew()
+                else:
+                    await self._try_acquire()
+                self._restart_finished_jobs()
+            except Exception as e:
+                log.error(f"Leader election error: {e}")
+                await self._step_down()
+
+            interval = settings.LEADER_RENEW_INTERVAL_SECONDS if self.is_leader \
+                else settings.LEADER_RETRY_INTERVAL_SECONDS
+            await asyncio.sleep(interval)
+
+    async def _try_acquire(self):
+        conn = await self.engine.connect()
+        try:
+            # AUTOCOMMIT: соединение держит только лок, без открытой транзакции
+            await conn.execution_options(isolation_level="AUTOCOMMIT")
+            result = await conn.execute(text("SELECT pg_try_advisory_lock(:lock_id)"), {'lock_id': self.lock_id})
+            acquired = result.scalar()
+        except Exception:
+            await conn.invalidate()
+            await conn.close()
+            raise
+        if not acquired:
+            await conn.close()
+            return
+        self._conn = conn
+        self._become_leader()
+
+    async def _renew(self):
+        try:
+            await asyncio.wait_for(
+                self._conn.execute(text("SELECT 1")),
+                timeout=settings.LEADER_LEASE_TIMEOUT_SECONDS
+            )
+        except Exception as e:
+            log.warning(f"Leader lease lost: {e!r}")
+            await self._step_down()
+            return
+        self.renewed_at = datetime.datetime.now()
+
+    def _become_leader(self):
+        self.is_leader = True
+        self.leader_since = self.renewed_at = datetime.datetime.now()
+        log.info(f"Worker {self.worker_id} became leader, starting background jobs")
+        for name, factory in self.jobs:
+            self._tasks[name] = asyncio.create_task(factory(), name=name)
+
+    def _restart_finished_jobs(self):
+        """Задачи лидера работают бесконечно; упавшую перезапускаем."""
+        if not self.is_leader:
+            return
+        for name, factory in self.jobs:
+            task = self._tasks.get(name)
+            if task is not None and task.done():
+                error = None if task.cancelled() else task.exception()
+                log.error(f"Leader job {name} stopped ({error!r}), restarting")
+                self._tasks[name] = asyncio.create_task(factory(), name=name)
+
+    async def _step_down(self):
+        if self.is_leader:
+            log.warning(f"Worker {self.worker_id} is no longer leader, stopping background jobs")
+        self.is_leader = False
+        self.leader_since = None
+
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            try:
+                # Соединение не возвращается в пул: закрытие сессии гарантированно снимает лок
+                await conn.invalidate()
+                await conn.close()
+            except Exception as e:
+                log.warning(f"Failed to close leader connection: {e!r}")
+
+    async def stop(self):
+        """Отдает лидерство при остановке процесса, чтобы другая реплика подхватила задачи сразу."""
+        self._stopped = True
+        await self._step_down()
+
+    def status(self) -> dict:
+        return {
+            'worker_id': self.worker_id,
+            'is_leader': self.is_leader,
+            'leader_since': self.leader_since.isoformat() if self.leader_since else None,
+            'lease_renewed_at': self.renewed_at.isoformat() if self.is_leader and self.renewed_at else None,
+            'jobs': sorted(name for name, task in self._tasks.items() if not task.done()),
+        }
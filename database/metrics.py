@@ -0,0 +1,185 @@
+"""
+Инкрементальные бизнес-метрики для админского дашборда.
+
+Счетчики в daily_revenue / server_key_stats / funnel_stats обновляются в той же
+транзакции, что и само событие (оплата заказа, выдача ключа, истечение ключа),
+поэтому дашборд читает готовые цифры и не агрегирует orders и keys целиком.
+rebuild() пересчитывает все с нуля - для первичного заполнения и сверки.
+"""
+import datetime
+from collections import Counter
+
+from sqlalchemy import select, delete, insert, func
+
+from database.dialect import upsert_insert
+
+from database.models import Users, Products, Orders, Keys, DailyRevenue, ServerKeyStats, FunnelStats
+
+# Этапы воронки
+STAGE_REGISTERED = "registered"
+STAGE_TRIAL = "trial"
+STAGE_PAID = "paid"
+STAGE_TRIAL_PAID = "trial_paid"  # Оплатили после пробного периода
+
+FUNNEL_STAGES = (STAGE_REGISTERED, STAGE_TRIAL, STAGE_PAID, STAGE_TRIAL_PAID)
+
+UNKNOWN_SERVER = "unknown"
+
+
+def server_from_vless_key(vless_key: str | None) -> str:
+    """Достает хост сервера из vless://uuid@host:port?..."""
+    try:
+        return vless_key.split('@')[1].split(':')[0]
+    except (AttributeError, IndexError):
+        return UNKNOWN_SERVER
+
+
+async def _increment(session, table, keys: dict, deltas: dict):
+    """Атомарно прибавляет deltas к счетчикам строки keys, создавая ее при необходимости."""
+    stmt = upsert_insert(table).values(**keys, **deltas)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={column: table.c[column] + stmt.excluded[column] for column in deltas}
+    )
+    await session.execute(stmt)
+
+
+async def record_funnel(session, stage: str):
+    await _increment(session, FunnelStats, {'stage': stage}, {'users': 1})
+
+
+async def record_key_activated(session, vless_key: str):
+    """Ключ выдан или продлен после истечения."""
+    await _increment(session, ServerKeyStats, {'server': server_from_vless_key(vless_key)}, {'active_keys': 1})
+
+
+async def record_key_expired(session, vless_key: str):
+    await _increment(session, ServerKeyStats, {'server': server_from_vless_key(vless_key)}, {'active_keys': -1})
+
+
+async def record_order_paid(session, order_id: int):
+    """
+    Учитывает оплату заказа: выручка дня оплаты (paid_at) и, если это первая оплата пользователя,
+    этап воронки. Вызывается только при переходе заказа в статус 'paid'.
+    """
+    result = await session.execute(
+        select(Orders.c.user_id, Orders.c.amount, Orders.c.product_id, Orders.c.paid_at, Products.c.country,
+               Users.c.has_received_trial)
+        .join(Products, Orders.c.product_id == Products.c.id)
+        .join(Users, Orders.c.user_id == Users.c.user_id)
+        .where(Orders.c.id == order_id)
+    )
+    order = result.fetchone()
+    if not order:
+        return
+
+    await _increment(
+        session, DailyRevenue,
+        {'day': order.paid_at.date(), 'product_id': order.product_id, 'country': order.country or ''},
+        {'orders_count': 1, 'revenue': order.amount}
+    )
+
+    result = await session.execute(
+        select(Orders.c.id)
+        .where((Orders.c.user_id == order.user_id) & (Orders.c.status == 'paid') & (Orders.c.id != order_id))
+        .limit(1)
+    )
+    if result.first() is None:
+        await record_funnel(session, STAGE_PAID)
+        if order.has_received_trial:
+            await record_funnel(session, STAGE_TRIAL_PAID)
+
+
+async def rebuild(session):
+    """Полный пересчет сводных таблиц по orders / keys / users."""
+    await session.execute(delete(DailyRevenue))
+    await session.execute(delete(ServerKeyStats))
+    await session.execute(delete(FunnelStats))
+
+    # День оплаты - как в record_order_paid. Заказы, оплаченные до появления paid_at, - по дню создания
+    day = func.date(func.coalesce(Orders.c.paid_at, Orders.c.created_at))
+    country = func.coalesce(Products.c.country, '')
+    revenue = (
+        select(day, Orders.c.product_id, country, func.count(Orders.c.id), func.sum(Orders.c.amount))
+        .join(Products, Orders.c.product_id == Products.c.id)
+        .where(Orders.c.status == 'paid')
+        .group_by(day, Orders.c.product_id, country)
+    )
+    await session.execute(
+        insert(DailyRevenue).from_select(['day', 'product_id', 'country', 'orders_count', 'revenue'], revenue)
+    )
+
+    result = await session.execute(select(Keys.c.vless_key).where(Keys.c.has_sent_expiry_notification == False))
+    per_server = Counter(server_from_vless_key(vless_key) for vless_key in result.scalars())
+    if per_server:
+        await session.execute(
+            insert(ServerKeyStats),
+            [{'server': server, 'active_keys': count} for server, count in per_server.items()]
+        )
+
+    paid_users = select(Orders.c.user_id).where(Orders.c.status == 'paid').distinct().subquery()
+    result = await session.execute(
+        select(
+            func.count(Users.c.user_id),
+            func.count(Users.c.user_id).filter(Users.c.has_received_trial == True),
+            func.count(paid_users.c.user_id),
+            func.count(paid_users.c.user_id).filter(Users.c.has_received_trial == True),
+        )
+        .select_from(Users.outerjoin(paid_users, Users.c.user_id == paid_users.c.user_id))
+    )
+    counts = result.one()
+    await session.execute(
+        insert(FunnelStats),
+        [{'stage': stage, 'users': count} for stage, count in zip(FUNNEL_STAGES, counts)]
+    )
+
+
+async def is_empty(session) -> bool:
+    result = await session.execute(select(FunnelStats.c.stage).limit(1))
+    return result.first() is None
+
+
+async def read_dashboard(session, days: int = 30) -> dict:
+    """Читает сводные таблицы. Размер выборки не зависит от объема orders и keys."""
+    today = datetime.date.today()
+    since = today - datetime.timedelta(days=days - 1)
+
+    result = await session.execute(
+        select(DailyRevenue.c.day, DailyRevenue.c.product_id, DailyRevenue.c.country,
+               DailyRevenue.c.orders_count, DailyRevenue.c.revenue)
+        .where(DailyRevenue.c.day >= since)
+    )
+    revenue_rows = result.fetchall()
+
+    def _revenue_since(start: datetime.date) -> float:
+        return sum(row.revenue for row in revenue_rows if row.day >= start)
+
+    by_product = Counter()
+    orders_by_product = Counter()
+    for row in revenue_rows:
+        by_product[(row.product_id, row.country)] += row.revenue
+        orders_by_product[(row.product_id, row.country)] += row.orders_count
+
+    result = await session.execute(
+        select(ServerKeyStats.c.server, ServerKeyStats.c.active_keys).order_by(ServerKeyStats.c.active_keys.desc())
+    )
+    servers = result.fetchall()
+
+    result = await session.execute(select(FunnelStats.c.stage, FunnelStats.c.users))
+    funnel = {stage: 0 for stage in FUNNEL_STAGES}
+    funnel.update({row.stage: row.users for row in result})
+
+    return {
+        'days': days,
+        'revenue_today': _revenue_since(today),
+        'revenue_week': _revenue_since(today - datetime.timedelta(days=6)),
+        'revenue_period': _revenue_since(since),
+        'orders_period': sum(orders_by_product.values()),
+        'by_product': [
+            {'product_id': product_id, 'country': country, 'revenue': revenue,
+             'orders': orders_by_product[(product_id, country)]}
+            for (product_id, country), revenue in by_product.most_common()
+        ],
+        'servers': servers,
+        'funnel': funnel,
+    }
@@ -0,0 +1,275 @@
+"""
+Версионные миграции схемы.
+
+metadata.create_all создает только отсутствующие таблицы, поэтому новые колонки и индексы
+в существующих таблицах добавляются миграциями из MIGRATIONS:
+
+- миграции применяются по возрастанию version, примененные записываются в schema_migrations
+  вместе с контрольной суммой; изменение уже примененной миграции останавливает запуск;
+- запуск идет под advisory-локом Postgres, поэтому несколько экземпляров бота
+  не накатывают миграции одновременно;
+- CreateIndexConcurrently строит индекс без блокировки записи в таблицу (вне транзакции),
+  Backfill заполняет данные короткими пачками с паузами между ними.
+
+Миграция только из Sql выполняется одной транзакцией. Миграция с онлайн-операциями
+выполняется по шагам, поэтому каждый шаг должен быть идемпотентным (IF NOT EXISTS,
+условие Backfill, которое перестает выполняться для обновленных строк):
+после падения посередине она будет запущена заново целиком.
+
+В SQLite (локальная разработка) схема создается с нуля по моделям, поэтому миграции
+там только отмечаются примененными.
+"""
+import asyncio
+import hashlib
+import logging
+import time
+from typing import NamedTuple
+
+from sqlalchemy import select, insert, text
+from sqlalchemy.exc import DBAPIError
+
+from config import settings
+from database.dialect import IS_POSTGRES
+from database.models import metadata, SchemaMigrations
+
+log = logging.getLogger(__name__)
+
+# Ключ pg_advisory_lock для миграций (любое число, уникальное в пределах базы)
+MIGRATION_LOCK_ID = 0x5650_4E01
+
+
+class Sql(NamedTuple):
+    """Обычный SQL. DDL выполняется с lock_timeout, чтобы не вставать в очередь за долгими запросами."""
+    statement: str
+
+    def describe(self) -> str:
+        return self.statement
+
+
+class CreateIndexConcurrently(NamedTuple):
+    """CREATE INDEX CONCURRENTLY: таблица остается доступной для записи, пока строится индекс."""
+    name: str
+    table: str
+    columns: str  # Как в SQL: "user_id, expires_at"
+    unique: bool = False
+
+    def describe(self) -> str:
+        unique = "UNIQUE " if self.unique else ""
+        return f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {self.name} ON {self.table} ({self.columns})"
+
+
+class Backfill(NamedTuple):
+    """
+    UPDATE table SET set_sql WHERE where_sql пачками по batch_size строк (пачки выбираются по key_column).
+    where_sql должно перестать выполняться для обновленной строки - иначе цикл не закончится.
+    """
+    table: str
+    set_sql: str
+    where_sql: str
+    batch_size: int | None = None
+    key_column: str = "id"  # Первичный ключ таблицы; на результат UPDATE не влияет, в контрольную сумму не входит
+
+    def describe(self) -> str:
+        return f"UPDATE {self.table} SET {self.set_sql} WHERE {self.where_sql}"
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    operations: tuple
+
+    @property
+    def checksum(self) -> str:
+        source = "\n".join(operation.describe() for operation in self.operations)
+        return hashlib.sha256(source.encode()).hexdigest()
+
+    @property
+    def is_transactional(self) -> bool:
+        return all(isinstance(operation, Sql) for operation in self.operations)
+
+
+MIGRATIONS = [
+    Migration(1, "claim-колонки планировщика", (
+        Sql("ALTER TABLE keys ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(64)"),
+        Sql("ALTER TABLE keys ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP WITHOUT TIME ZONE"),
+        Sql("ALTER TABLE users ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(64)"),
+        Sql("ALTER TABLE users ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP WITHOUT TIME ZONE"),
+    )),
+    Migration(2, "индексы для планировщика и пагинации", (
+        CreateIndexConcurrently("ix_keys_expires_at", "keys", "expires_at"),
+        CreateIndexConcurrently("ix_users_created_at_user_id", "users", "created_at, user_id"),
+        CreateIndexConcurrently("ix_keys_user_id_expires_at", "keys", "user_id, expires_at, id"),
+    )),
+    Migration(3, "orders.provider", (
+        Sql("ALTER TABLE orders ADD COLUMN IF NOT EXISTS provider VARCHAR(20)"),
+    )),
+    Migration(4, "уникальность платежа провайдера", (
+        CreateIndexConcurrently("uq_orders_provider_payment_id", "orders", "provider, payment_id", unique=True),
+        # Старые оплаченные заказы: у CryptoBot ID счета числовой, у ЮKassa - UUID.
+        # Платежи, зачтенные в нескольких заказах (до идемпотентных вебхуков), не трогаем
+        Backfill(
+            "orders",
+            "provider = CASE WHEN payment_id ~ '^[0-9]+$' THEN 'crypto_bot' ELSE 'yookassa' END",
+            "status = 'paid' AND provider IS NULL AND payment_id IS NOT NULL AND NOT EXISTS ("
+            "SELECT 1 FROM orders AS duplicate WHERE duplicate.payment_id = orders.payment_id "
+            "AND duplicate.id <> orders.id AND duplicate.status = 'paid')",
+        ),
+    )),
+    Migration(5, "users.chat_status", (
+        # Колонка с константным DEFAULT добавляется без перезаписи таблицы
+        Sql("ALTER TABLE users ADD COLUMN IF NOT EXISTS chat_status VARCHAR(16) NOT NULL DEFAULT 'active'"),
+        Sql("ALTER TABLE users ADD COLUMN IF NOT EXISTS chat_status_changed_at TIMESTAMP WITHOUT TIME ZONE"),
+    )),
+    Migration(6, "orders.paid_at", (
+        Sql("ALTER TABLE orders ADD COLUMN IF NOT EXISTS paid_at TIMESTAMP WITHOUT TIME ZONE"),
+        # Время старых оплат неизвестно - как и раньше при пересчете метрик, берем день создания заказа
+        Backfill("orders", "paid_at = created_at", "status = 'paid' AND paid_at IS NULL"),
+    )),
+    Migration(7, "users.created_at NOT NULL", (
+        # Keyset-пагинация пользователей идет по (created_at, user_id), а сравнение кортежей
+        # с NULL не выполняется никогда - такие пользователи выпадали из списка.
+        # Дата регистрации неизвестна - ставим начало эпохи: такие пользователи оказываются самыми старыми
+        Backfill("users", "created_at = TIMESTAMP '1970-01-01'", "created_at IS NULL", key_column="user_id"),
+        # SET NOT NULL сканирует таблицу под эксклюзивной блокировкой, если нет проверенного CHECK;
+        # VALIDATE CONSTRAINT проверяет строки, не блокируя запись
+        Sql("ALTER TABLE users DROP CONSTRAINT IF EXISTS users_created_at_not_null"),
+        Sql("ALTER TABLE users ADD CONSTRAINT users_created_at_not_null CHECK (created_at IS NOT NULL) NOT VALID"),
+        Sql("ALTER TABLE users VALIDATE CONSTRAINT users_created_at_not_null"),
+        Sql("ALTER TABLE users ALTER COLUMN created_at SET NOT NULL"),
+        Sql("ALTER TABLE users DROP CONSTRAINT IF EXISTS users_created_at_not_null"),
+    )),
+]
+
+
+async def _apply_sql(conn, operation: Sql):
+    await conn.execute(text(f"SET LOCAL lock_timeout = '{settings.MIGRATION_LOCK_TIMEOUT}'"))
+    await conn.execute(text(operation.statement))
+
+
+async def _create_index_concurrently(conn, operation: CreateIndexConcurrently):
+    """conn - в режиме AUTOCOMMIT: CONCURRENTLY нельзя выполнять внутри транзакции."""
+    result = await conn.execute(
+        text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+        {'name': operation.name}
+    )
+    is_valid = result.scalar_one_or_none()
+    if is_valid:
+        return
+    if is_valid is False:
+        # Прерванная сборка оставляет невалидный индекс - IF NOT EXISTS его бы пропустил
+        log.warning(f"Индекс {operation.name} невалиден (прерванная сборка), пересоздаю")
+        await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {operation.name}"))
+    await conn.execute(text(operation.describe()))
+
+
+async def _backfill(engine, operation: Backfill):
+    batch_size = operation.batch_size or settings.MIGRATION_BACKFILL_BATCH_SIZE
+    statement = text(
+        f"UPDATE {operation.table} SET {operation.set_sql} WHERE {operation.key_column} IN ("
+        f"SELECT {operation.key_column} FROM {operation.table} WHERE {operation.where_sql} "
+        f"ORDER BY {operation.key_column} LIMIT :batch_size FOR UPDATE SKIP LOCKED)"
+    )
+    remaining = text(f"SELECT EXISTS (SELECT 1 FROM {operation.table} WHERE {operation.where_sql})")
+    total = 0
+    while True:
+        # Каждая пачка - своя короткая транзакция: блокировки строк держатся миллисекунды
+        async with engine.begin() as conn:
+            result = await conn.execute(statement, {'batch_size': batch_size})
+            # Пустая пачка при SKIP LOCKED значит и "строки заняты чужими транзакциями" -
+            # проверяем без SKIP LOCKED, остались ли строки вообще
+            has_remaining = bool(result.rowcount) or (await conn.execute(remaining)).scalar()
+        if not has_remaining:
+            break
+        if not result.rowcount:
+            log.info(f"Backfill {operation.table}: оставшиеся строки заблокированы, жду")
+        total += result.rowcount
+        await asyncio.sleep(settings.MIGRATION_BACKFILL_PAUSE_SECONDS)
+    log.info(f"Backfill {operation.table}: обновлено строк {total}")
+
+
+async def _apply(engine, autocommit_conn, migration: Migration):
+    if migration.is_transactional:
+        async with engine.begin() as conn:
+            for operation in migration.operations:
+                await _apply_sql(conn, operation)
+            await conn.execute(_record(migration))
+        return
+
+    for operation in migration.operations:
+        if isinstance(operation, CreateIndexConcurrently):
+            await _create_index_concurrently(autocommit_conn, operation)
+        elif isinstance(operation, Backfill):
+            await _backfill(engine, operation)
+        else:
+            async with engine.begin() as conn:
+                await _apply_sql(conn, operation)
+    async with engine.begin() as conn:
+        await conn.execute(_record(migration))
+
+
+def _record(migration: Migration):
+    return insert(SchemaMigrations).values(
+        version=migration.version, name=migration.name, checksum=migration.checksum
+    )
+
+
+async def _applied_checksums(engine) -> dict:
+    async with engine.connect() as conn:
+        result = await conn.execute(select(SchemaMigrations.c.version, SchemaMigrations.c.checksum))
+        return {row.version: row.checksum for row in result}
+
+
+def _pending(migrations, applied: dict) -> list:
+    for migration in migrations:
+        checksum = applied.get(migration.version)
+        if checksum is not None and checksum != migration.checksum:
+            raise RuntimeError(
+                f"Миграция {migration.version} ({migration.name}) изменена после применения. "
+                "Изменения схемы оформляются новой миграцией."
+            )
+    return sorted((m for m in migrations if m.version not in applied), key=lambda m: m.version)
+
+
+async def _apply_with_retries(engine, autocommit_conn, migration: Migration):
+    """Повторяет миграцию, если DDL не дождался блокировки (lock_timeout) - например, в час пик."""
+    for attempt in range(1, settings.MIGRATION_LOCK_RETRIES + 1):
+        try:
+            await _apply(engine, autocommit_conn, migration)
+            return
+        except DBAPIError as e:
+            if 'lock timeout' not in str(e) or attempt == settings.MIGRATION_LOCK_RETRIES:
+                raise
+            log.warning(f"Миграция {migration.version}: таблица занята, попытка {attempt} не удалась")
+            await asyncio.sleep(attempt * 2)
+
+
+async def run_migrations(engine, migrations=MIGRATIONS):
+    """Создает недостающие таблицы и накатывает непримененные миграции."""
+    if not IS_POSTGRES:
+        async with engine.begin() as conn:
+            await conn.run_sync(metadata.create_all)
+        applied = await _applied_checksums(engine)
+        pending = _pending(migrations, applied)
+        if pending:
+            async with engine.begin() as conn:
+                for migration in pending:
+                    await conn.execute(_record(migration))
+        return
+
+    async with engine.connect() as lock_conn:
+        # AUTOCOMMIT: соединение не держит открытую транзакцию (ее ждал бы CREATE INDEX CONCURRENTLY),
+        # а сессионный advisory-лок живет, пока соединение не закрыто
+        lock_conn = await lock_conn.execution_options(isolation_level="AUTOCOMMIT")
+        await lock_conn.execute(text("SELECT pg_advisory_lock(:lock_id)"), {'lock_id': MIGRATION_LOCK_ID})
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(metadata.create_all)
+
+            applied = await _applied_checksums(engine)
+            for migration in _pending(migrations, applied):
+                log.info(f"Применяю миграцию {migration.version}: {migration.name}")
+                started = time.monotonic()
+                await _apply_with_retries(engine, lock_conn, migration)
+                log.info(f"Миграция {migration.version} применена за {time.monotonic() - started:.1f} с")
+        finally:
+            await lock_conn.execute(text("SELECT pg_advisory_unlock(:lock_id)"), {'lock_id': MIGRATION_LOCK_ID})
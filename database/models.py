@@ -2,19 +2,42 @@ import datetime
 import uuid
 from sqlalchemy import (
     create_engine, MetaData, Table, Column, Integer, String, BigInteger,
-    DateTime, ForeignKey, Float, Enum, Boolean, UUID
+    DateTime, ForeignKey, Float, Enum, Boolean, UUID, Index, Date, JSON, Text
 )
 
-from sqlalchemy.sql import func
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import func, false
+from sqlalchemy.sql.expression import FunctionElement
 from config import settings
 
 
-DB_URL = (
+DB_URL = settings.DATABASE_URL or (
     f"postgresql+asyncpg://{settings.POSTGRESQL_USER}:{settings.POSTGRESQL_PASSWORD.get_secret_value()}"
     f"@{settings.POSTGRESQL_HOST}:{settings.POSTGRESQL_PORT}/{settings.POSTGRESQL_DBNAME}"
 )
+REPLICA_DB_URL = (
+    f"postgresql+asyncpg://{settings.POSTGRESQL_USER}:{settings.POSTGRESQL_PASSWORD.get_secret_value()}"
+    f"@{settings.POSTGRESQL_REPLICA_HOST}:{settings.POSTGRESQL_REPLICA_PORT}/{settings.POSTGRESQL_DBNAME}"
+) if settings.POSTGRESQL_REPLICA_HOST else None
 metadata = MetaData()
 
+
+class gen_random_uuid(FunctionElement):
+    """Серверный UUID по умолчанию: gen_random_uuid() в Postgres, случайный hex в SQLite."""
+    type = UUID(as_uuid=True)
+    inherit_cache = True
+
+
+@compiles(gen_random_uuid)
+def _compile_gen_random_uuid(element, compiler, **kw):
+    return "gen_random_uuid()"
+
+
+@compiles(gen_random_uuid, 'sqlite')
+def _compile_gen_random_uuid_sqlite(element, compiler, **kw):
+    # UUID(as_uuid=True) хранится в SQLite как 32 hex-символа без дефисов
+    return "(lower(hex(randomblob(16))))"
+
 # Таблица пользователей
 Users = Table(
     'users',
@@ -22,13 +45,19 @@ Users = Table(
     Column('user_id', BigInteger, primary_key=True, unique=True, autoincrement=False),
     Column('username', String(255), nullable=True),
     Column('first_name', String(255)),
-    Column('created_at', DateTime, server_default=func.now()),
-    Column('has_received_trial', Boolean, nullable=False, default=False, server_default='false'),
+    Column('created_at', DateTime, nullable=False, server_default=func.now()),
+    Column('has_received_trial', Boolean, nullable=False, default=False, server_default=false()),
     Column('last_menu_id', BigInteger, nullable=True, default=None),
-    Column('has_sent_trial_reminder', Boolean, nullable=False, default=False, server_default='false'),
+    Column('has_sent_trial_reminder', Boolean, nullable=False, default=False, server_default=false()),
     Column('crm_topic_id', Integer, nullable=True),  # ID топика в CRM-группе
     Column('referrer_id', BigInteger, nullable=True),  # ID пользователя, который пригласил
     Column('referral_balance', Integer, nullable=False, default=0, server_default='0'),  # Бонусные дни за рефералов
+    Column('claimed_by', String(64), nullable=True),  # Воркер планировщика, захвативший напоминание
+    Column('claimed_at', DateTime, nullable=True),  # Когда напоминание было захвачено
+    # active | blocked (заблокировал бота) | deactivated (аккаунт удален); массовые отправки - только active
+    Column('chat_status', String(16), nullable=False, default='active', server_default='active'),
+    Column('chat_status_changed_at', DateTime, nullable=True),
+    Index('ix_users_created_at_user_id', 'created_at', 'user_id'),  # Keyset-пагинация в админке
 )
 
 # Таблица продуктов (тарифов)
@@ -53,7 +82,11 @@ Orders = Table(
     Column('status', Enum('pending', 'paid', 'failed', name='order_status'),
            nullable=False, default='pending'),
     Column('payment_id', String(255), nullable=True), # ID из ЮKassa
-    Column('created_at', DateTime, server_default=func.now())
+    Column('created_at', DateTime, server_default=func.now()),
+    Column('provider', String(20), nullable=True),  # Платежная система; заполняется при оплате
+    Column('paid_at', DateTime, nullable=True),  # Когда зачтена оплата; по этому дню считается выручка
+    # Один платеж провайдера может оплатить только один заказ
+    Index('uq_orders_provider_payment_id', 'provider', 'payment_id', unique=True),
 )
 
 # Таблица ключей VLess
@@ -66,10 +99,14 @@ Keys = Table(
     Column('vless_key', String, unique=True, nullable=False),
     Column('created_at', DateTime, server_default=func.now()),
     Column('expires_at', DateTime, nullable=False),
-    Column('has_sent_renewal_warning', Boolean, nullable=False, default=False, server_default='false'),
-    Column('has_sent_trial_warning', Boolean, nullable=False, default=False, server_default='false'),
-    Column('has_sent_expiry_notification', Boolean, nullable=False, default=False, server_default='false'),
-    Column('subscription_token', UUID(as_uuid=True), unique=True, server_default=func.gen_random_uuid())
+    Column('has_sent_renewal_warning', Boolean, nullable=False, default=False, server_default=false()),
+    Column('has_sent_trial_warning', Boolean, nullable=False, default=False, server_default=false()),
+    Column('has_sent_expiry_notification', Boolean, nullable=False, default=False, server_default=false()),
+    Column('subscription_token', UUID(as_uuid=True), unique=True, server_default=gen_random_uuid()),
+    Column('claimed_by', String(64), nullable=True),  # Воркер планировщика, захвативший уведомление
+    Column('claimed_at', DateTime, nullable=True),  # Когда уведомление было захвачено
+    Index('ix_keys_expires_at', 'expires_at'),
+    Index('ix_keys_user_id_expires_at', 'user_id', 'expires_at', 'id'),  # Ключи пользователя по страницам
 )
 
 # Таблица для админов
@@ -88,6 +125,147 @@ Referrals = Table(
     Column('referrer_id', BigInteger, ForeignKey('users.user_id'), nullable=False),  # Кто пригласил
     Column('referred_id', BigInteger, ForeignKey('users.user_id'), nullable=False),  # Кого пригласили
     Column('created_at', DateTime, server_default=func.now()),  # Когда перешел по ссылке
-    Column('has_purchased', Boolean, nullable=False, default=False, server_default='false'),  # Купил ли что-то
+    Column('has_purchased', Boolean, nullable=False, default=False, server_default=false()),  # Купил ли что-то
     Column('first_purchase_at', DateTime, nullable=True),  # Когда совершил первую покупку
-)
\ No newline at end of file
+)
+
+# Обработанные уведомления об оплате (по одному на платеж провайдера)
+ProcessedPaymentEvents = Table(
+    'processed_payment_events',
+    metadata,
+    Column('provider', String(20), primary_key=True),  # 'yookassa' / 'crypto_bot'
+    Column('payment_id', String(255), primary_key=True),
+    Column('order_id', Integer, nullable=False),
+    Column('processed_at', DateTime, server_default=func.now()),
+)
+
+
+# --- Архив: старые строки переносятся сюда из горячих таблиц (см. archive_stale_rows) ---
+
+# Неоплаченные заказы старше ARCHIVE_STALE_ORDERS_AFTER_DAYS
+OrdersArchive = Table(
+    'orders_archive',
+    metadata,
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('user_id', BigInteger, nullable=False, index=True),
+    Column('product_id', Integer, nullable=False),
+    Column('amount', Float, nullable=False),
+    Column('status', String(20), nullable=False),
+    Column('payment_id', String(255), nullable=True),
+    Column('created_at', DateTime),
+    Column('archived_at', DateTime, server_default=func.now()),
+)
+
+# Ключи, истекшие более ARCHIVE_EXPIRED_KEYS_AFTER_DAYS назад
+KeysArchive = Table(
+    'keys_archive',
+    metadata,
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('user_id', BigInteger, nullable=False, index=True),
+    Column('order_id', Integer, nullable=True),
+    Column('vless_key', String, nullable=False),
+    Column('created_at', DateTime),
+    Column('expires_at', DateTime, nullable=False),
+    Column('has_sent_renewal_warning', Boolean, nullable=False, default=False),
+    Column('has_sent_trial_warning', Boolean, nullable=False, default=False),
+    Column('has_sent_expiry_notification', Boolean, nullable=False, default=False),
+    Column('subscription_token', UUID(as_uuid=True), nullable=True),
+    Column('archived_at', DateTime, server_default=func.now()),
+)
+
+# --- Сводные бизнес-метрики (обновляются инкрементально, см. database/metrics.py) ---
+
+# Выручка по дням в разрезе тарифа и страны
+DailyRevenue = Table(
+    'daily_revenue',
+    metadata,
+    Column('day', Date, primary_key=True),
+    Column('product_id', Integer, primary_key=True),
+    Column('country', String(100), primary_key=True),  # '' - тариф без страны
+    Column('orders_count', Integer, nullable=False, default=0, server_default='0'),
+    Column('revenue', Float, nullable=False, default=0.0, server_default='0'),
+)
+
+# Число активных ключей на каждом сервере
+ServerKeyStats = Table(
+    'server_key_stats',
+    metadata,
+    Column('server', String(255), primary_key=True),  # Хост из vless-ключа
+    Column('active_keys', Integer, nullable=False, default=0, server_default='0'),
+)
+
+# Воронка: регистрация -> триал -> оплата
+FunnelStats = Table(
+    'funnel_stats',
+    metadata,
+    Column('stage', String(32), primary_key=True),
+    Column('users', Integer, nullable=False, default=0, server_default='0'),
+)
+
+
+# Массовые рассылки (см. broadcast.py). Получатели обходятся по возрастанию user_id,
+# cursor - последний обработанный user_id: после рестарта рассылка продолжается с него
+BroadcastJobs = Table(
+    'broadcast_jobs',
+    metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('admin_id', BigInteger, nullable=False),
+    Column('from_chat_id', BigInteger, nullable=False),  # Откуда копируется сообщение
+    Column('message_id', Integer, nullable=False),
+    Column('status', String(16), nullable=False, index=True),  # running | paused | cancelled | completed
+    Column('cursor', BigInteger, nullable=False, default=0, server_default='0'),
+    Column('total', Integer, nullable=False, default=0, server_default='0'),  # Пользователей на момент запуска
+    Column('sent', Integer, nullable=False, default=0, server_default='0'),
+    Column('failed', Integer, nullable=False, default=0, server_default='0'),
+    Column('blocked', Integer, nullable=False, default=0, server_default='0'),  # Из failed: бот заблокирован
+    Column('progress_chat_id', BigInteger, nullable=True),  # Сообщение с живым прогрессом
+    Column('progress_message_id', Integer, nullable=True),
+    Column('created_at', DateTime, server_default=func.now()),
+    Column('finished_at', DateTime, nullable=True),
+)
+
+# --- Служебные таблицы ---
+
+# Примененные миграции схемы (см. database/migrations.py)
+SchemaMigrations = Table(
+    'schema_migrations',
+    metadata,
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('name', String(255), nullable=False),
+    Column('checksum', String(64), nullable=False),  # sha256 операций миграции
+    Column('applied_at', DateTime, server_default=func.now()),
+)
+
+# Состояния FSM aiogram (см. database/fsm_storage.py); key строит DefaultKeyBuilder
+FsmStates = Table(
+    'fsm_states',
+    metadata,
+    Column('key', String(255), primary_key=True),
+    Column('state', String(255), nullable=True),
+    Column('data', JSON, nullable=False),
+    Column('expires_at', DateTime, nullable=False, index=True),  # Брошенные сценарии удаляет фоновая очистка
+)
+
+# Общие лимиты частоты действий пользователей (middlewares/throttling.py, THROTTLE_BACKEND=database).
+# GCRA: tat - теоретическое время следующего запроса (unix time); tat в прошлом - корзина полна.
+# Без индекса по tat: строка обновляется на каждом действии, а очистка идет раз в час
+ThrottleBuckets = Table(
+    'throttle_buckets',
+    metadata,
+    Column('key', String(128), primary_key=True),  # "<действие>:<user_id>"
+    Column('tat', Float, nullable=False),
+)
+
+# История циклов планировщика (см. scheduler_tasks.py); хранятся последние SCHEDULER_RUN_HISTORY
+SchedulerRuns = Table(
+    'scheduler_runs',
+    metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('worker_id', String(64), nullable=False),
+    Column('trigger', String(16), nullable=False),  # resync | deadline
+    Column('started_at', DateTime, nullable=False),
+    Column('duration_ms', Integer, nullable=False),
+    Column('lag_ms', Integer, nullable=False),  # Опоздание старта относительно запланированного момента
+    Column('phases', JSON, nullable=False),  # {фаза: счетчики PhaseStats}
+    Column('error', Text, nullable=True),
+)
@@ -0,0 +1,26 @@
+"""
+Курсоры для keyset-пагинации.
+
+Курсор - позиция строки в сортировке (datetime, id), упакованная в короткую строку,
+чтобы помещаться в callback_data (лимит Telegram - 64 байта).
+"""
+import datetime
+
+# Направления перехода
+NEXT = "n"  # Строго после курсора
+PREV = "p"  # Строго перед курсором (предыдущая страница)
+AT = "a"  # Начиная с курсора включительно (возврат на ту же страницу)
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def encode_cursor(sort_value: datetime.datetime, row_id: int) -> str:
+    """Упаковывает (datetime, id) в строку вида '<микросекунды>_<id>' без потери точности."""
+    return f"{(sort_value - _EPOCH) // _MICROSECOND}_{row_id}"
+
+
+def decode_cursor(cursor: str) -> tuple[datetime.datetime, int]:
+    """Обратное преобразование encode_cursor. Бросает ValueError на мусорных данных."""
+    micros, row_id = cursor.split("_")
+    return _EPOCH + int(micros) * _MICROSECOND, int(row_id)
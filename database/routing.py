@@ -0,0 +1,88 @@
+"""
+Маршрутизация запросов между основной БД и репликой для чтения.
+
+- Функции, помеченные @read_only, читают с реплики (если она настроена и не отстает).
+- Любой INSERT/UPDATE/DELETE закрепляет текущий контекст (апдейт бота, HTTP-запрос)
+  за основной БД: дальнейшие чтения в нем увидят собственную запись.
+- pin_to_primary() закрепляет явно, например, когда запись сделала другая реплика бота.
+
+Состояние хранится в contextvars, поэтому у каждой asyncio-задачи оно свое.
+"""
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy.orm import Session
+
+_read_only = ContextVar('db_read_only', default=False)
+_pinned_to_primary = ContextVar('db_pinned_to_primary', default=False)
+
+
+class ReplicaState:
+    """Движки и здоровье реплики; обновляется монитором задержки."""
+
+    def __init__(self):
+        self.primary = None
+        self.replica = None
+        self.healthy = False  # До первой успешной проверки задержки читаем с основной БД
+        self.lag_seconds = None
+
+    def configure(self, primary, replica=None):
+        self.primary = primary
+        self.replica = replica
+
+
+replica_state = ReplicaState()
+
+
+@contextmanager
+def read_only_scope():
+    """Запросы внутри блока только читают и могут уйти на реплику."""
+    token = _read_only.set(True)
+    try:
+        yield
+    finally:
+        _read_only.reset(token)
+
+
+def read_only(func):
+    """
+    Помечает функцию db_commands как только читающую: ее запросы могут уйти на реплику.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with read_only_scope():
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def pin_to_primary():
+    """Все запросы внутри блока идут в основную БД."""
+    token = _pinned_to_primary.set(True)
+    try:
+        yield
+    finally:
+        _pinned_to_primary.reset(token)
+
+
+def is_reading_from_replica() -> bool:
+    return (
+        replica_state.replica is not None
+        and replica_state.healthy
+        and _read_only.get()
+        and not _pinned_to_primary.get()
+    )
+
+
+class RoutingSession(Session):
+    """Sync-часть AsyncSession, выбирающая движок для каждого запроса."""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if clause is not None and getattr(clause, 'is_dml', False):
+            # SQLAlchemy выполняет запрос в greenlet с контекстом вызывающей задачи,
+            # поэтому закрепление действует до конца текущего апдейта/запроса
+            _pinned_to_primary.set(True)
+        elif is_reading_from_replica():
+            return replica_state.replica.sync_engine
+        return replica_state.primary.sync_engine
@@ -1,4 +1,3 @@
-import asyncio
 import html
 import logging
 import datetime
@@ -14,9 +13,12 @@ from aiogram.exceptions import AiogramError
 
 from config import settings
 from database import db_commands as db
+from database.pagination import NEXT, PREV, decode_cursor
 from keyboards import (get_admin_menu_kb, get_back_to_admin_kb, get_admin_stats_kb,
-                       get_broadcast_confirmation_kb, get_users_list_kb, get_user_card_kb)
+                       get_broadcast_confirmation_kb, get_users_list_kb, get_user_card_kb,
+                       get_admin_dashboard_kb)
 import vpn_api
+import broadcast
 
 
 # Кастомный фильтр для проверки ID админа
@@ -37,15 +39,22 @@ class BroadcastState(StatesGroup):
 
 
 
-async def build_and_send_users_list(update_obj: Message | CallbackQuery, page: int = 0):
+async def build_and_send_users_list(update_obj: Message | CallbackQuery, page: int = 0,
+                                    cursor: str | None = None, direction: str = NEXT):
     """
     Единая функция для генерации и отправки списка пользователей с пагинацией.
+    Страницы выбираются по курсору (keyset); callback без курсора (старые кнопки)
+    открывает первую страницу.
     """
     page_size = 10
+    if not cursor:
+        page = 0
 
     try:
         total_users = await db.count_all_users()
-        users_on_page = await db.get_all_users_paginated(page=page, page_size=page_size)
+        users_on_page, has_more = await db.get_users_page(cursor, direction, page_size)
+        # При шаге назад has_more говорит о предыдущих страницах, а следующая точно есть
+        has_next = True if direction == PREV and cursor else has_more
     except Exception as e:
         logging.error(f"Ошибка получения списка пользователей из БД: {e}")
         error_text = f"❌ Ошибка при получении данных из БД: {e}"
@@ -64,15 +73,20 @@ async def build_and_send_users_list(update_obj: Message | CallbackQuery, page: i
             await update_obj.answer()
         return
 
-    total_pages = math.ceil(total_users / page_size)
-    page = max(0, min(page, total_pages - 1))
+    if not users_on_page and cursor:
+        # Курсор указывает за пределы списка (пользователи удалены) - начинаем сначала
+        await build_and_send_users_list(update_obj, page=0)
+        return
+
+    total_pages = max(math.ceil(total_users / page_size), page + 1)
+    page = max(0, page)
 
     # Формируем текст сообщения
     text = f"📊 <b>Статистика пользователей</b> (Стр. {page + 1}/{total_pages})\n\n"
     text += f"Всего пользователей: <b>{total_users}</b>\n\n"
     text += "Нажмите на пользователя для просмотра деталей:"
 
-    kb = get_users_list_kb(users_on_page, total_users, page=page, page_size=page_size)
+    kb = get_users_list_kb(users_on_page, total_users, page=page, page_size=page_size, has_next=has_next)
 
     try:
         if isinstance(update_obj, Message):
@@ -95,7 +109,7 @@ async def build_and_send_users_list(update_obj: Message | CallbackQuery, page: i
             await update_obj.answer("Неожиданная ошибка.", show_alert=True)
 
 
-async def build_and_send_user_card(callback: CallbackQuery, user_id: int, page: int):
+async def build_and_send_user_card(callback: CallbackQuery, user_id: int, page: int, page_cursor: str | None = None):
     """
     Формирует и отправляет детальную карточку пользователя.
     """
@@ -197,7 +211,7 @@ async def build_and_send_user_card(callback: CallbackQuery, user_id: int, page:
     else:
         text += "У пользователя нет ключей.\n"
 
-    kb = get_user_card_kb(page)
+    kb = get_user_card_kb(page, page_cursor)
 
     try:
         await callback.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
@@ -226,6 +240,94 @@ async def cmd_stats(message: Message):
     await build_and_send_users_list(message, page=0)
 
 
+def build_dashboard_text(dashboard: dict) -> str:
+    """Форматирует сводку бизнес-метрик для админа."""
+    server_names = {s.vless_server: f"{s.name} ({s.country})" for s in settings.XUI_SERVERS}
+    products = {p.id: p.name for p in db.product_catalog.list(include_custom=True)}
+
+    text = "📈 <b>Дашборд</b>\n\n"
+    text += "💰 <b>Выручка:</b>\n"
+    text += f"├ Сегодня: {dashboard['revenue_today']:.2f} ₽\n"
+    text += f"├ 7 дней: {dashboard['revenue_week']:.2f} ₽\n"
+    text += f"└ {dashboard['days']} дней: {dashboard['revenue_period']:.2f} ₽ ({dashboard['orders_period']} заказов)\n\n"
+
+    if dashboard['by_product']:
+        text += f"🏷 <b>По тарифам за {dashboard['days']} дней:</b>\n"
+        for item in dashboard['by_product'][:10]:
+            product_name = products.get(item['product_id'], f"#{item['product_id']}")
+            country = item['country'] or "все страны"
+            text += f"• {html.escape(product_name)} / {html.escape(country)}: {item['revenue']:.2f} ₽ ({item['orders']})\n"
+        text += "\n"
+
+    text += "🖥 <b>Активные ключи по серверам:</b>\n"
+    if dashboard['servers']:
+        for server in dashboard['servers']:
+            name = server_names.get(server.server, server.server)
+            text += f"• {html.escape(name)}: {server.active_keys}\n"
+    else:
+        text += "• нет данных\n"
+
+    funnel = dashboard['funnel']
+    registered = funnel['registered']
+    trial = funnel['trial']
+
+    def _percent(part: int, whole: int) -> str:
+        return f"{part / whole * 100:.1f}%" if whole else "—"
+
+    text += "\n🔻 <b>Воронка:</b>\n"
+    text += f"├ Регистрации: {registered}\n"
+    text += f"├ Взяли триал: {trial} ({_percent(trial, registered)})\n"
+    text += f"├ Оплатили: {funnel['paid']} ({_percent(funnel['paid'], registered)})\n"
+    text += f"└ Триал → оплата: {funnel['trial_paid']} ({_percent(funnel['trial_paid'], trial)})\n"
+    return text
+
+
+@router.message(Command("dashboard"))
+async def cmd_dashboard(message: Message):
+    """Дашборд бизнес-метрик (команда)"""
+    dashboard = await db.get_business_dashboard()
+    await message.answer(build_dashboard_text(dashboard), reply_markup=get_admin_dashboard_kb(), parse_mode="HTML")
+
+
+PHASE_TITLES = {
+    'renewal_warning': "предупреждение 24ч",
+    'trial_warning': "предупреждение триала",
+    'expiry': "истечение",
+    'trial_reminder': "напоминание о триале",
+}
+
+
+def build_scheduler_text(runs) -> str:
+    """Форматирует последние циклы планировщика (таблица scheduler_runs)."""
+    text = "⏱ <b>Планировщик: последние циклы</b>\n\n"
+    if not runs:
+        return text + "Циклов еще не было."
+
+    for run in runs:
+        trigger = "сверка" if run.trigger == "resync" else "срок"
+        text += (f"<b>{run.started_at:%d.%m %H:%M:%S}</b> {trigger}: {run.duration_ms / 1000:.1f} с, "
+                 f"опоздание {run.lag_ms / 1000:.1f} с\n")
+        for phase, stats in run.phases.items():
+            title = PHASE_TITLES.get(phase, phase)
+            if 'error' in stats:
+                text += f"├ {title}: ❌ {html.escape(stats['error'][:200])}\n"
+            elif stats['selected']:
+                text += (f"├ {title}: выбрано {stats['selected']}, отправлено {stats['sent']}, "
+                         f"ошибок {stats['failed']} (заблокировали {stats['blocked']}), "
+                         f"{stats['elapsed_seconds']:.1f} с\n")
+        if run.error:
+            text += f"├ ❌ {html.escape(run.error[:200])}\n"
+        text += f"└ {html.escape(run.worker_id)}\n\n"
+    return text
+
+
+@router.message(Command("scheduler"))
+async def cmd_scheduler(message: Message):
+    """Последние циклы планировщика уведомлений (команда)"""
+    runs = await db.get_scheduler_runs(limit=10)
+    await message.answer(build_scheduler_text(runs), parse_mode="HTML")
+
+
 @router.message(Command("broadcast"))
 async def start_broadcast(message: Message, state: FSMContext):
     """Начало рассылки (команда, дублирует кнопку)"""
@@ -267,7 +369,6 @@ async def process_broadcast_confirmation(callback: CallbackQuery, state: FSMCont
         await cmd_admin(callback.message)
         return
 
-    await callback.message.edit_text("⏳ Начинаю рассылку... Это может занять время.", reply_markup=None)
     await callback.answer()
 
     data = await state.get_data()
@@ -277,37 +378,43 @@ async def process_broadcast_confirmation(callback: CallbackQuery, state: FSMCont
     await state.clear()
 
     if not message_to_send_id or not chat_id:
-        await callback.message.answer(
+        await callback.message.edit_text(
             "❌ Ошибка! Не удалось найти сообщение для рассылки. Попробуйте снова.",
             reply_markup=get_back_to_admin_kb()
         )
         return
 
-    user_ids = await db.get_all_user_ids()
-    success_count = 0
-    fail_count = 0
-
-    for user_id in user_ids:
-        try:
-            #
-            await bot.copy_message(
-                chat_id=user_id,
-                from_chat_id=chat_id,
-                message_id=message_to_send_id
-            )
-            success_count += 1
-            await asyncio.sleep(0.1)  #
-        except Exception as e:
-            fail_count += 1
-            logging.warning(f"Failed to send broadcast to {user_id}: {e}")
-
-    await callback.message.answer(
-        f"✅ Рассылка завершена.\n\n"
-        f"Успешно: {success_count}\n"
-        f"Заблокировано/Ошибка: {fail_count}",
-        reply_markup=get_back_to_admin_kb()
-    )
+    # Рассылку выполняет фоновая задача лидера (broadcast.py); это сообщение показывает ее прогресс
+    job_id = await db.create_broadcast(callback.from_user.id, chat_id, message_to_send_id)
+    await db.set_broadcast_progress_message(job_id, callback.message.chat.id, callback.message.message_id)
+    broadcast.wake()
+    await broadcast.show_progress(bot, await db.get_broadcast(job_id))
+
+
+# Переходы статуса рассылки по кнопкам: действие -> (новый статус, из каких статусов)
+BROADCAST_ACTIONS = {
+    "pause": (db.BROADCAST_PAUSED, (db.BROADCAST_RUNNING,)),
+    "resume": (db.BROADCAST_RUNNING, (db.BROADCAST_PAUSED,)),
+    "cancel": (db.BROADCAST_CANCELLED, (db.BROADCAST_RUNNING, db.BROADCAST_PAUSED)),
+}
+
 
+@router.callback_query(F.data.startswith("broadcast_job:"))
+async def control_broadcast(callback: CallbackQuery, bot: Bot):
+    """Пауза, продолжение и отмена рассылки с сообщения о прогрессе"""
+    _, action, job_id = callback.data.split(":")
+    status, from_statuses = BROADCAST_ACTIONS[action]
+
+    job = await db.set_broadcast_status(int(job_id), status, from_statuses)
+    if job is None:
+        await callback.answer("Рассылка уже завершена или в этом статусе.", show_alert=True)
+        job = await db.get_broadcast(int(job_id))
+    else:
+        await callback.answer()
+        if status == db.BROADCAST_RUNNING:
+            broadcast.wake()
+    if job:
+        await broadcast.show_progress(bot, job)
 
 
 @router.callback_query(F.data == "admin:main")
@@ -333,16 +440,48 @@ async def menu_admin_stats(callback: CallbackQuery):
     await build_and_send_users_list(callback, page=0)
 
 
+async def edit_dashboard_message(callback: CallbackQuery):
+    """Перерисовывает сообщение с дашбордом."""
+    dashboard = await db.get_business_dashboard()
+    try:
+        await callback.message.edit_text(
+            build_dashboard_text(dashboard), reply_markup=get_admin_dashboard_kb(), parse_mode="HTML"
+        )
+    except AiogramError as e:
+        if "message is not modified" not in str(e).lower():
+            logging.error(f"Error sending dashboard: {e}")
+
+
+@router.callback_query(F.data == "admin:dashboard")
+async def menu_admin_dashboard(callback: CallbackQuery):
+    """Кнопка 'Дашборд' - сводка из таблиц бизнес-метрик"""
+    await callback.answer()
+    await edit_dashboard_message(callback)
+
+
+@router.callback_query(F.data == "admin:dashboard_rebuild")
+async def rebuild_admin_dashboard(callback: CallbackQuery):
+    """Полный пересчет метрик (сверка после ручных правок в БД)"""
+    await callback.answer("⏳ Пересчитываю метрики...")
+    await db.rebuild_business_metrics()
+    await edit_dashboard_message(callback)
+
+
 @router.callback_query(F.data.startswith("admin:users_page:"))
 async def paginate_users_list(callback: CallbackQuery):
-    """Пагинация для списка пользователей"""
+    """Пагинация для списка пользователей: admin:users_page:{page}[:{direction}:{cursor}]"""
     try:
-        page = int(callback.data.split(":")[-1])
+        parts = callback.data.split(":")
+        page = int(parts[2])
+        direction = parts[3] if len(parts) > 3 else NEXT
+        cursor = parts[4] if len(parts) > 4 and parts[4] else None
+        if cursor:
+            decode_cursor(cursor)
     except (ValueError, IndexError):
         await callback.answer("Ошибка страницы.", show_alert=True)
         return
 
-    await build_and_send_users_list(callback, page=page)
+    await build_and_send_users_list(callback, page=page, cursor=cursor, direction=direction)
 
 
 @router.callback_query(F.data.startswith("admin:user_card:"))
@@ -352,11 +491,12 @@ async def show_user_card(callback: CallbackQuery):
         parts = callback.data.split(":")
         user_id = int(parts[2])
         page = int(parts[3])
+        page_cursor = parts[4] if len(parts) > 4 and parts[4] else None
     except (ValueError, IndexError):
         await callback.answer("Ошибка получения данных пользователя.", show_alert=True)
         return
 
-    await build_and_send_user_card(callback, user_id, page)
+    await build_and_send_user_card(callback, user_id, page, page_cursor)
 
 
 @router.callback_query(F.data == "admin:broadcast")
@@ -14,6 +14,7 @@ from aiogram.fsm.state import State, StatesGroup
 from config import settings
 from database import db_commands as db
 from utils import issue_trial_key
+from database.pagination import NEXT, PREV, decode_cursor
 from keyboards import get_crm_keys_list_kb, get_crm_key_details_kb, get_crm_country_selection_kb
 import crm
 import vpn_api
@@ -306,13 +307,29 @@ async def cmd_trial(message: Message, bot: Bot):
 
 @router.callback_query(F.data.startswith("crm_keys_page:"))
 async def crm_keys_pagination(callback: CallbackQuery):
-    """Обработчик пагинации списка ключей в CRM."""
+    """
+    Обработчик пагинации списка ключей в CRM.
+    Формат: crm_keys_page:{page}:{direction}:{cursor}; без курсора (старые кнопки) - первая страница.
+    """
     if not await is_crm_topic(callback.message):
         await callback.answer("Эта функция работает только в CRM-топиках", show_alert=True)
         return
 
     try:
-        page = int(callback.data.split(":")[1])
+        parts = callback.data.split(":")
+        page = int(parts[1])
+        direction = parts[2] if len(parts) > 2 else NEXT
+        cursor = parts[3] if len(parts) > 3 and parts[3] else None
+        if cursor:
+            decode_cursor(cursor)
+    except (IndexError, ValueError):
+        log.warning(f"Некорректный callback_data для пагинации ключей CRM: {callback.data}")
+        await callback.answer("Ошибка навигации.", show_alert=True)
+        return
+    if not cursor:
+        page = 0
+
+    try:
         page_size = 5
 
         # Получаем user_id из топика
@@ -331,22 +348,29 @@ async def crm_keys_pagination(callback: CallbackQuery):
             return
 
         user_id = user.user_id
-        stats = await db.get_user_stats_detailed(user_id)
+        stats = await db.get_user_stats_detailed(user_id, keys_page_size=page_size, keys_cursor=cursor,
+                                                 keys_direction=direction)
+        if stats and not stats['keys'] and cursor:
+            # Ключи с этой страницы исчезли (архивированы) - показываем первую
+            page, cursor = 0, None
+            stats = await db.get_user_stats_detailed(user_id, keys_page_size=page_size)
 
         if not stats or not stats['keys']:
             await callback.answer("Ключи не найдены", show_alert=True)
             return
 
-        total_keys = len(stats['keys'])
-        keys_on_page = stats['keys'][page * page_size:(page + 1) * page_size]
+        total_keys = stats['total_keys_count']
+        keys_on_page = stats['keys']
+        # При шаге назад keys_has_more говорит о предыдущих страницах, а следующая точно есть
+        has_next = True if direction == PREV and cursor else stats['keys_has_more']
 
-        total_pages = math.ceil(total_keys / page_size)
+        total_pages = max(math.ceil(total_keys / page_size), page + 1)
         keys_text = "\n🔑 <b>Список ключей:</b>"
         if total_pages > 1:
             keys_text += f"\n📄 Страница {page + 1} из {total_pages}"
         keys_text += "\n\n<i>Нажмите на ключ для подробной информации</i>"
 
-        kb = get_crm_keys_list_kb(keys_on_page, total_keys, page=page, page_size=page_size)
+        kb = get_crm_keys_list_kb(keys_on_page, total_keys, page=page, page_size=page_size, has_next=has_next)
 
         await callback.message.edit_text(keys_text, reply_markup=kb, parse_mode="HTML")
         await callback.answer()
@@ -364,12 +388,14 @@ async def crm_key_details(callback: CallbackQuery):
         return
 
     try:
-        _, key_id_str, page_str = callback.data.split(":")
-        key_id = int(key_id_str)
-        current_page = int(page_str)
+        # crm_key_details:{key_id}:{page}[:{cursor}]
+        parts = callback.data.split(":")
+        key_id = int(parts[1])
+        current_page = int(parts[2])
+        page_cursor = parts[3] if len(parts) > 3 and parts[3] else None
 
-        # Получаем ключ
-        key = await db.get_key_by_id(key_id)
+        # Получаем ключ (CRM показывает и архивные)
+        key = await db.get_key_by_id(key_id, include_archived=True)
 
         if not key:
             await callback.answer("Ключ не найден", show_alert=True)
@@ -436,7 +462,7 @@ async def crm_key_details(callback: CallbackQuery):
             f"<code>{subscription_url}</code>"
         )
 
-        kb = get_crm_key_details_kb(key_id, current_page)
+        kb = get_crm_key_details_kb(key_id, current_page, page_cursor)
 
         await callback.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
         await callback.answer()
@@ -493,25 +519,19 @@ async def crm_add_days_process(message: Message, state: FSMContext, bot: Bot):
         data = await state.get_data()
         key_id = data['key_id']
 
-        # Получаем ключ
-        key = await db.get_key_by_id(key_id)
+        # Продлеваем ключ в БД.
+        # Если ключ уже истёк, дни добавляются к текущей дате,
+        # если ещё действует - к дате истечения
+        now = datetime.datetime.now()
+        key = await db.extend_key(key_id, datetime.timedelta(days=days))
 
         if not key:
             await message.reply("❌ Ключ не найден.")
             await state.clear()
             return
 
-        # Вычисляем новую дату истечения
-        old_expires_at = key.expires_at
-        now = datetime.datetime.now()
-
-        # Если ключ уже истёк, добавляем дни к текущей дате
-        # Если ключ ещё действует, добавляем к дате истечения
-        start_date = max(now, old_expires_at)
-        new_expires_at = start_date + datetime.timedelta(days=days)
-
-        # Обновляем ключ в БД
-        await db.update_key_expiry(key_id, new_expires_at)
+        old_expires_at = key.old_expires_at
+        new_expires_at = key.new_expires_at
 
         # Обновляем ключ на сервере VPN
         try:
@@ -0,0 +1,136 @@
+"""
+Служебные HTTP-эндпоинты для балансировщика и мониторинга.
+"""
+from aiohttp import web
+
+import scheduler_tasks
+from database import db_commands as db
+from database.routing import replica_state
+from notifier import dispatcher
+
+
+async def health_handler(request: web.Request):
+    """
+    GET /health
+    Жив ли процесс, доступна ли БД и является ли процесс лидером (см. database/leader.py).
+    При недоступной БД отвечает 503.
+    """
+    leader = request.app['leader']
+    database_ok = await db.check_database()
+    payload = {
+        'status': 'ok' if database_ok else 'degraded',
+        'database': database_ok,
+        'leader': leader.status(),
+        'replica': {
+            'configured': db.replica_engine is not None,
+            'healthy': replica_state.healthy,
+            'lag_seconds': replica_state.lag_seconds,
+        },
+    }
+    return web.json_response(payload, status=200 if database_ok else 503)
+
+
+class _Metrics:
+    """Сборщик ответа в текстовом формате Prometheus."""
+
+    def __init__(self):
+        self._lines = []
+
+    def add(self, name: str, kind: str, help_text: str, samples):
+        """samples - [(метки, значение), ...]; метки - dict."""
+        self._lines.append(f"# HELP {name} {help_text}")
+        self._lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+            self._lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    def add_histogram(self, name: str, help_text: str, histogram):
+        """histogram - LatencyHistogram (update_queue.py)."""
+        self._lines.append(f"# HELP {name} {help_text}")
+        self._lines.append(f"# TYPE {name} histogram")
+        for bound, count in histogram.cumulative():
+            self._lines.append(f'{name}_bucket{{le="{bound}"}} {count}')
+        self._lines.append(f"{name}_sum {round(histogram.sum, 6)}")
+        self._lines.append(f"{name}_count {histogram.count}")
+
+    def render(self) -> str:
+        return "\n".join(self._lines) + "\n"
+
+
+async def metrics_handler(request: web.Request):
+    """
+    GET /metrics
+    Счетчики этого процесса: циклы и фазы планировщика (работает только у лидера),
+    последние прогоны диспетчера уведомлений, кэши справочных запросов, очередь апдейтов,
+    троттлинг, лидерство, реплика.
+    """
+    metrics = _Metrics()
+    history = scheduler_tasks.run_history
+
+    metrics.add("vpnbot_scheduler_cycles_total", "counter", "Scheduler cycles by trigger",
+                [({'trigger': trigger}, count) for trigger, count in sorted(history.cycles.items())])
+    metrics.add("vpnbot_scheduler_failed_cycles_total", "counter", "Scheduler cycles with a failed phase",
+                [({}, history.errors)])
+    last = history.last
+    if last:
+        metrics.add("vpnbot_scheduler_last_cycle_timestamp_seconds", "gauge", "Start of the last scheduler cycle",
+                    [({}, round(last.started_at.timestamp(), 3))])
+        metrics.add("vpnbot_scheduler_last_cycle_duration_seconds", "gauge", "Duration of the last scheduler cycle",
+                    [({}, round(last.duration, 3))])
+        metrics.add("vpnbot_scheduler_last_cycle_lag_seconds", "gauge",
+                    "How late the last scheduler cycle started", [({}, round(last.lag, 3))])
+    metrics.add("vpnbot_scheduler_queued_deadlines", "gauge", "Deadlines in the scheduler queue",
+                [({}, len(scheduler_tasks.deadlines))])
+
+    phase_totals = sorted(history.phase_totals.items())
+    metrics.add("vpnbot_scheduler_phase_runs_total", "counter", "Scheduler phase runs",
+                [({'phase': phase}, totals['runs']) for phase, totals in phase_totals])
+    metrics.add("vpnbot_scheduler_phase_seconds_total", "counter", "Time spent in scheduler phases",
+                [({'phase': phase}, round(totals['seconds'], 3)) for phase, totals in phase_totals])
+    metrics.add("vpnbot_scheduler_phase_items_total", "counter", "Scheduler phase items by result",
+                [({'phase': phase, 'result': counter}, totals[counter])
+                 for phase, totals in phase_totals for counter in scheduler_tasks.RunHistory.PHASE_COUNTERS])
+
+    last_stats = sorted(dispatcher.last_stats.items())
+    metrics.add("vpnbot_notifier_last_run_items", "gauge", "Items of the last notifier run by result",
+                [({'run': name, 'result': counter}, getattr(stats, counter))
+                 for name, stats in last_stats for counter in scheduler_tasks.RunHistory.PHASE_COUNTERS])
+    metrics.add("vpnbot_notifier_last_run_rate", "gauge", "Messages per second in the last notifier run",
+                [({'run': name}, round(stats.rate, 2)) for name, stats in last_stats])
+    metrics.add("vpnbot_notifier_background_pending", "gauge", "Background sends in flight",
+                [({}, dispatcher.pending_background)])
+    metrics.add("vpnbot_notifier_background_dropped_total", "counter", "Background sends dropped on overflow",
+                [({}, dispatcher.dropped_background)])
+
+    cache_stats = sorted(db.get_lookup_cache_stats().items())
+    for counter, kind in (('hits', 'counter'), ('misses', 'counter'), ('size', 'gauge')):
+        suffix = "_total" if kind == 'counter' else ""
+        metrics.add(f"vpnbot_cache_{counter}{suffix}", kind, f"Lookup cache {counter}",
+                    [({'cache': name}, stats[counter]) for name, stats in cache_stats])
+
+    queue = request.app['update_queue']
+    metrics.add("vpnbot_updates_pending", "gauge", "Telegram updates accepted and not processed yet",
+                [({}, queue.pending)])
+    metrics.add("vpnbot_updates_queue_capacity", "gauge", "Update queue size limit", [({}, queue.maxsize)])
+    metrics.add("vpnbot_update_workers", "gauge", "Update workers", [({}, queue.workers)])
+    metrics.add("vpnbot_update_workers_busy", "gauge", "Update workers processing an update", [({}, queue.busy)])
+    metrics.add("vpnbot_update_workers_busy_seconds_total", "counter",
+                "Total worker time spent on updates (utilization = rate / workers)",
+                [({}, round(queue.busy_seconds, 3))])
+    metrics.add("vpnbot_updates_total", "counter", "Telegram updates by result",
+                [({'result': 'processed'}, queue.processed), ({'result': 'failed'}, queue.failed),
+                 ({'result': 'rejected'}, queue.rejected)])
+    metrics.add_histogram("vpnbot_update_wait_seconds", "Time from webhook to start of processing",
+                          queue.wait_latency)
+    metrics.add_histogram("vpnbot_update_processing_seconds", "Update processing time", queue.process_latency)
+
+    throttling = request.app['throttling']
+    metrics.add("vpnbot_throttled_total", "counter", "Updates dropped by the throttling middleware",
+                [({'action': action}, count) for action, count in sorted(throttling.throttled.items())])
+
+    leader = request.app['leader']
+    metrics.add("vpnbot_leader", "gauge", "1 if this process runs background jobs", [({}, int(leader.is_leader))])
+    if replica_state.lag_seconds is not None:
+        metrics.add("vpnbot_replica_lag_seconds", "gauge", "Read replica lag", [({}, replica_state.lag_seconds)])
+
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
@@ -8,8 +8,9 @@ from pathlib import Path
 
 
 from aiogram import Router, F, Bot
-from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, FSInputFile
-from aiogram.filters import CommandStart
+from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, FSInputFile, \
+    ChatMemberUpdated
+from aiogram.filters import CommandStart, ChatMemberUpdatedFilter, KICKED, MEMBER
 from aiogram.exceptions import AiogramError
 from config import settings
 from utils import issue_key_to_user, issue_trial_key
@@ -19,20 +20,16 @@ from keyboards import get_main_menu_kb, get_payment_kb, get_instruction_platform
     get_renewal_payment_method_kb, get_payment_success_kb, get_trial_already_used_kb, get_referral_kb, \
     get_referral_use_bonus_kb
 from database import db_commands as db
+from database.pagination import NEXT, PREV, decode_cursor
 from payments import create_yookassa_payment, check_yookassa_payment
 from utils import generate_vless_key, handle_payment_logic
-from middlewares.throttling import ThrottlingMiddleware
+from middlewares.throttling import THROTTLING_FLAG, ACTION_ORDER, ACTION_PAYMENT
 import crm
 import vpn_api
 
 log = logging.getLogger(__name__)
 router = Router()
 
-# router.message.filter(CommandStart()).middleware(ThrottlingMiddleware(rate_limit=1.0))
-router.message.middleware(ThrottlingMiddleware(rate_limit=1.0))
-
-router = Router()
-
 MAIN_MENU_PHOTO_ID = FSInputFile(Path(__file__).resolve().parent.parent / "menu_photo.jpg")
 
 TEXT_INSTRUCTION_MENU = "ℹ️ **Инструкция**\n\nВыберите вашу операционную систему:"
@@ -200,6 +197,18 @@ async def cmd_start(message: Message, bot: Bot):
     await db.update_user_menu_id(message.from_user.id, new_menu_message.message_id)
 
 
+@router.my_chat_member(F.chat.type == "private", ChatMemberUpdatedFilter(member_status_changed=KICKED))
+async def on_bot_blocked(event: ChatMemberUpdated):
+    """Пользователь заблокировал бота: исключаем его из массовых отправок."""
+    await db.set_chat_status(event.from_user.id, db.CHAT_BLOCKED)
+
+
+@router.my_chat_member(F.chat.type == "private", ChatMemberUpdatedFilter(member_status_changed=MEMBER))
+async def on_bot_unblocked(event: ChatMemberUpdated):
+    """Пользователь разблокировал бота."""
+    await db.set_chat_status(event.from_user.id, db.CHAT_ACTIVE)
+
+
 @router.callback_query(F.data == "menu:main")
 async def menu_main(callback: CallbackQuery, bot: Bot):
     keys_count = await db.count_user_keys(callback.from_user.id)
@@ -260,7 +269,7 @@ async def menu_buy_select_country(callback: CallbackQuery, bot: Bot):
     await db.update_user_menu_id(callback.from_user.id, new_menu_message.message_id)
 
 
-@router.callback_query(F.data == "trial:get")
+@router.callback_query(F.data == "trial:get", flags={THROTTLING_FLAG: ACTION_ORDER})
 async def process_trial_get(callback: CallbackQuery, bot: Bot):
     """
     Обрабатывает нажатие на кнопку 'Пробный период'.
@@ -320,7 +329,7 @@ async def process_trial_get(callback: CallbackQuery, bot: Bot):
         await callback.answer("Не удалось выдать пробный ключ. Попробуйте позже.", show_alert=True)
 
 
-@router.callback_query(F.data.startswith("special_offer:"))
+@router.callback_query(F.data.startswith("special_offer:"), flags={THROTTLING_FLAG: ACTION_ORDER})
 async def process_special_offer(callback: CallbackQuery):
     try:
         _, price_str, key_id_str = callback.data.split(":")
@@ -413,8 +422,8 @@ async def menu_keys_show_first_page(callback: CallbackQuery, bot: Bot):
         await db.update_user_menu_id(user_id, new_menu_message.message_id)
         return
 
-    keys_on_page = await db.get_user_keys(user_id, page=page, page_size=page_size)
-    kb = get_my_keys_kb(keys_on_page, total_keys, page=page, page_size=page_size)
+    keys_on_page, has_next = await db.get_user_keys_page(user_id, page_size=page_size)
+    kb = get_my_keys_kb(keys_on_page, total_keys, page=page, page_size=page_size, has_next=has_next)
 
     total_pages = math.ceil(total_keys / page_size)
     text = "🔑 **Ваши ключи:**"
@@ -429,9 +438,17 @@ async def menu_keys_show_first_page(callback: CallbackQuery, bot: Bot):
 
 @router.callback_query(F.data.startswith("mykeys_page:"))
 async def menu_keys_paginate(callback: CallbackQuery):
-    """Обрабатывает нажатия на кнопки пагинации 'Назад'/'Вперед'."""
+    """
+    Обрабатывает нажатия на кнопки пагинации 'Назад'/'Вперед'.
+    Формат: mykeys_page:{page}[:{direction}:{cursor}]; без курсора (старые кнопки) - первая страница.
+    """
     try:
-        page = int(callback.data.split(":")[1])
+        parts = callback.data.split(":")
+        page = int(parts[1])
+        direction = parts[2] if len(parts) > 2 else NEXT
+        cursor = parts[3] if len(parts) > 3 and parts[3] else None
+        if cursor:
+            decode_cursor(cursor)
     except (IndexError, ValueError):
         log.warning(f"Некорректный callback_data для пагинации ключей: {callback.data}")
         await callback.answer("Ошибка навигации.", show_alert=True)
@@ -442,11 +459,19 @@ async def menu_keys_paginate(callback: CallbackQuery):
     user_id = callback.from_user.id
     page_size = 5
 
-    total_keys = await db.count_user_keys(user_id)
-    keys_on_page = await db.get_user_keys(user_id, page=page, page_size=page_size)
-    kb = get_my_keys_kb(keys_on_page, total_keys, page=page, page_size=page_size)
+    if not cursor:
+        page = 0
 
-    total_pages = math.ceil(total_keys / page_size)
+    total_keys = await db.count_user_keys(user_id)
+    keys_on_page, has_more = await db.get_user_keys_page(user_id, cursor, direction, page_size)
+    has_next = True if direction == PREV and cursor else has_more
+    if not keys_on_page and cursor:
+        # Ключи с этой страницы исчезли - показываем первую
+        page = 0
+        keys_on_page, has_next = await db.get_user_keys_page(user_id, page_size=page_size)
+    kb = get_my_keys_kb(keys_on_page, total_keys, page=page, page_size=page_size, has_next=has_next)
+
+    total_pages = max(math.ceil(total_keys / page_size), page + 1)
     text = "🔑 **Ваши ключи:**\n\nНажмите на ключ чтобы скопировать его и узнать более подробную информацию"
     if total_pages > 1:
         text += f"\n\n📄 Страница {page + 1} из {total_pages}"
@@ -471,9 +496,11 @@ async def menu_key_details(callback: CallbackQuery):
     (Версия 3.1: Сразу показывает ссылку-подписку и кнопки Назад/Продлить)
     """
     try:
-        _, key_id_str, page_str = callback.data.split(":")
-        key_id = int(key_id_str)
-        current_page = int(page_str)
+        # key_details:{key_id}:{page}[:{cursor}]
+        parts = callback.data.split(":")
+        key_id = int(parts[1])
+        current_page = int(parts[2])
+        page_cursor = parts[3] if len(parts) > 3 and parts[3] else None
     except (IndexError, ValueError):
         log.warning(f"Некорректный callback_data для деталей ключа: {callback.data}")
         await callback.answer("Ошибка получения ключа.", show_alert=True)
@@ -541,7 +568,7 @@ async def menu_key_details(callback: CallbackQuery):
     )
 
     #
-    kb = get_key_details_kb(key_id, current_page)
+    kb = get_key_details_kb(key_id, current_page, page_cursor)
 
     try:
         await callback.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
@@ -551,7 +578,7 @@ async def menu_key_details(callback: CallbackQuery):
             pass
 
 
-@router.callback_query(F.data.startswith("key_renew:"))
+@router.callback_query(F.data.startswith("key_renew:"), flags={THROTTLING_FLAG: ACTION_ORDER})
 async def menu_key_renew(callback: CallbackQuery):
     try:
         _, key_id_str, page_str = callback.data.split(":")
@@ -738,7 +765,7 @@ async def menu_support(callback: CallbackQuery, bot: Bot):
     await db.update_user_menu_id(callback.from_user.id, new_menu_message.message_id)
 
 
-@router.callback_query(F.data.startswith("buy_product:"))
+@router.callback_query(F.data.startswith("buy_product:"), flags={THROTTLING_FLAG: ACTION_ORDER})
 async def process_buy_callback(callback: CallbackQuery, bot: Bot):
     """
     Обработка нажатия на кнопку тарифа.
@@ -790,7 +817,7 @@ async def process_buy_callback(callback: CallbackQuery, bot: Bot):
         await callback.answer("Не удалось обновить меню. Попробуйте снова.")
 
 
-@router.callback_query(F.data.startswith("pay_method:"))
+@router.callback_query(F.data.startswith("pay_method:"), flags={THROTTLING_FLAG: ACTION_PAYMENT})
 async def process_payment_method(callback: CallbackQuery, bot: Bot):
     await callback.answer("⏳ Создаю ссылку на оплату...")
     try:
@@ -859,7 +886,7 @@ async def process_payment_method(callback: CallbackQuery, bot: Bot):
         pass
 
 
-@router.callback_query(F.data.startswith("check_payment:"))
+@router.callback_query(F.data.startswith("check_payment:"), flags={THROTTLING_FLAG: ACTION_PAYMENT})
 async def process_check_payment(callback: CallbackQuery, bot: Bot):
     """
     Обработка нажатия на кнопку "Проверить оплату".
@@ -881,6 +908,10 @@ async def process_check_payment(callback: CallbackQuery, bot: Bot):
             await callback.answer("Проверяю ЮKassa... Пожалуйста, подождите.", show_alert=True)
             payment_info = await check_yookassa_payment(order.payment_id)
             if payment_info and payment_info.status == 'succeeded':
+                # Вебхук мог успеть раньше - тогда ключ уже выдан им
+                if not await db.mark_order_paid(order_id, db.PROVIDER_YOOKASSA, payment_info.id):
+                    await callback.message.edit_text("✅ Оплата уже обработана. Ключ должен был прийти в чат.")
+                    return
                 metadata = payment_info.metadata
                 success, message_text, operation_type = await handle_payment_logic(bot, order_id, metadata)
 
@@ -1,6 +1,5 @@
 import logging
 import json
-import base64
 from aiohttp import web
 from aiogram import Bot
 from yookassa.domain.notification import WebhookNotification
@@ -12,6 +11,15 @@ from keyboards import get_renewal_kb, get_main_menu_kb, get_payment_success_kb,
 log = logging.getLogger(__name__)
 
 
+async def claim_paid_order(order_id: int, provider: str, payment_id: str) -> bool:
+    """
+    Фиксирует оплату заказа. False - уведомление уже обработано (повторная доставка)
+    или заказа нет; тогда ключ выдавать нельзя.
+    """
+    # Счет мог быть оплачен после переноса заказа в архив
+    return await db.mark_order_paid(order_id, provider, payment_id, restore_archived=True)
+
+
 async def yookassa_webhook_handler(request: web.Request):
     """
     Обработчик вебхуков от ЮKassa.
@@ -34,17 +42,11 @@ async def yookassa_webhook_handler(request: web.Request):
                 return web.Response(status=200)
 
             order_id = int(order_id_str)
-            order = await db.get_order_by_id(order_id)
-            if not order:
-                logging.error(f"Order {order_id} not found in DB (Yookassa Webhook).")
+            if not await claim_paid_order(order_id, db.PROVIDER_YOOKASSA, payment.id):
+                logging.warning(f"Order {order_id} is already paid or not found (Yookassa Webhook).")
                 return web.Response(status=200)
-
-            if order.status == 'paid':
-                logging.warning(f"Order {order_id} is already paid (Yookassa Webhook).")
-                return web.Response(status=200)
-
-            await db.update_order_status(order_id, payment.id, status='paid')
             logging.info(f"Order {order_id} marked as 'paid' by Yookassa webhook.")
+            order = await db.get_order_by_id(order_id)
 
             metadata = payment.metadata
             success, message_text, operation_type = await handle_payment_logic(bot, order_id, metadata)
@@ -106,18 +108,12 @@ async def crypto_bot_webhook_handler(request: web.Request):
                 log.error(f"Crypto Bot Webhook error: Invalid order_id format '{order_id_str}'")
                 return web.Response(status=200)
 
-            order = await db.get_order_by_id(order_id)
-            if not order:
-                log.error(f"Order {order_id} not found in DB (Crypto Webhook).")
-                return web.Response(status=200)
-
-            if order.status == 'paid':
-                logging.warning(f"Order {order_id} is already paid (Crypto Webhook).")
-                return web.Response(status=200)
-
             invoice_id_str = str(invoice.get('invoice_id'))
-            await db.update_order_status(order_id, invoice_id_str, status='paid')
+            if not await claim_paid_order(order_id, db.PROVIDER_CRYPTO_BOT, invoice_id_str):
+                logging.warning(f"Order {order_id} is already paid or not found (Crypto Webhook).")
+                return web.Response(status=200)
             logging.info(f"Order {order_id} marked as 'paid' by Crypto Bot webhook (Invoice: {invoice_id_str}).")
+            order = await db.get_order_by_id(order_id)
 
             success, message_text, operation_type = await handle_payment_logic(bot, order_id, metadata)
 
@@ -147,29 +143,44 @@ async def crypto_bot_webhook_handler(request: web.Request):
     return web.Response(status=200)
 
 
+def _etag_matches(etag: str, if_none_match: str) -> bool:
+    """Сравнение If-None-Match по RFC 9110: список тегов через запятую, слабый префикс W/ не учитывается."""
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
 async def subscription_handler(request: web.Request):
     """
     Обработчик для V2Ray-клиентов (ссылка на подписку).
     (Модель 2: 1 токен = 1 ключ)
+    Ответ берется из кэша подписок; при совпадении If-None-Match отдается 304.
     """
     try:
         token = request.match_info.get('token')
         if not token:
             return web.Response(status=404, text="Token not found")
 
-        #
-        active_key = await db.get_key_by_subscription_token(token)
+        subscription = await db.get_subscription(token)
 
-        if not active_key:
+        if not subscription:
             #
             return web.Response(status=200, text="")
 
-            #
-        subscription_base64 = base64.b64encode(active_key.encode('utf-8')).decode('utf-8')
+        headers = {"ETag": subscription.etag, "Cache-Control": "no-cache"}
+        if _etag_matches(subscription.etag, request.headers.get("If-None-Match", "")):
+            return web.Response(status=304, headers=headers)
 
-        log.info(f"Subscription link for key (token {token[:4]}...) accessed.")
+        # Клиенты опрашивают ссылку постоянно - на уровне info это лишь шум
+        log.debug(f"Subscription link for key (token {token[:4]}...) accessed.")
 
-        return web.Response(status=200, body=subscription_base64, content_type="text/plain")
+        return web.Response(status=200, body=subscription.body, content_type="text/plain", headers=headers)
 
     except Exception as e:
         log.error(f"Error in subscription_handler: {e}")
@@ -4,6 +4,7 @@ import math
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
 
 from config import settings
+from database.pagination import NEXT, PREV, AT, encode_cursor
 
 
 def _get_flag_for_country(country_name: str) -> str:
@@ -143,11 +144,15 @@ def get_payment_method_kb(order_id: int, country: str) -> InlineKeyboardMarkup:
     )
 
 
-def get_my_keys_kb(keys_on_page: list, total_keys: int, page: int = 0, page_size: int = 5) -> InlineKeyboardMarkup:
+def get_my_keys_kb(keys_on_page: list, total_keys: int, page: int = 0, page_size: int = 5,
+                   has_next: bool | None = None) -> InlineKeyboardMarkup:
     """
     Генерирует клавиатуру для 'Мои ключи' с пагинацией.
+    Кнопки навигации несут курсор (expires_at, id) первой/последней строки страницы.
+    has_next - результат keyset-выборки; если не передан, считается по total_keys.
     """
     keyboard = []
+    page_cursor = encode_cursor(keys_on_page[0].expires_at, keys_on_page[0].id) if keys_on_page else ""
     server_ip_to_country = {s.vless_server: s.country for s in settings.XUI_SERVERS}
     if keys_on_page:
         now = datetime.datetime.now()
@@ -184,11 +189,13 @@ def get_my_keys_kb(keys_on_page: list, total_keys: int, page: int = 0, page_size
             keyboard.append([
                 InlineKeyboardButton(
                     text=btn_text,
-                    callback_data=f"key_details:{key.id}:{page}"
+                    callback_data=f"key_details:{key.id}:{page}:{page_cursor}"
                 )
             ])
 
-    total_pages = math.ceil(total_keys / page_size)
+    total_pages = max(math.ceil(total_keys / page_size), page + 1)
+    if has_next is None:
+        has_next = page + 1 < total_pages
     nav_row = []
 
     placeholder_btn = InlineKeyboardButton(text=" ", callback_data="ignore")
@@ -196,7 +203,7 @@ def get_my_keys_kb(keys_on_page: list, total_keys: int, page: int = 0, page_size
     # 1. Кнопка "Назад"
     if page > 0:
         nav_row.append(
-            InlineKeyboardButton(text="⬅️ Назад", callback_data=f"mykeys_page:{page - 1}")
+            InlineKeyboardButton(text="⬅️ Назад", callback_data=f"mykeys_page:{page - 1}:{PREV}:{page_cursor}")
         )
     else:
         nav_row.append(placeholder_btn)  #
@@ -210,9 +217,10 @@ def get_my_keys_kb(keys_on_page: list, total_keys: int, page: int = 0, page_size
         nav_row.append(InlineKeyboardButton(text="1/1", callback_data="ignore"))
 
     # 3. Кнопка "Вперед"
-    if page + 1 < total_pages:
+    if has_next and keys_on_page:
+        last_cursor = encode_cursor(keys_on_page[-1].expires_at, keys_on_page[-1].id)
         nav_row.append(
-            InlineKeyboardButton(text="Вперед ➡️", callback_data=f"mykeys_page:{page + 1}")
+            InlineKeyboardButton(text="Вперед ➡️", callback_data=f"mykeys_page:{page + 1}:{NEXT}:{last_cursor}")
         )
     else:
         nav_row.append(placeholder_btn)
@@ -226,11 +234,12 @@ def get_my_keys_kb(keys_on_page: list, total_keys: int, page: int = 0, page_size
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
-def get_key_details_kb(key_id: int, current_page: int) -> InlineKeyboardMarkup:
+def get_key_details_kb(key_id: int, current_page: int, page_cursor: str | None = None) -> InlineKeyboardMarkup:
     """Клавиатура для детального просмотра ключа."""
+    back_data = f"mykeys_page:{current_page}:{AT}:{page_cursor}" if page_cursor else f"mykeys_page:{current_page}"
     keyboard = [
         [
-            InlineKeyboardButton(text="⬅️ Назад", callback_data=f"mykeys_page:{current_page}"),
+            InlineKeyboardButton(text="⬅️ Назад", callback_data=back_data),
             InlineKeyboardButton(text="🔄 Продлить", callback_data=f"key_renew:{key_id}:{current_page}")
         ]
     ]
@@ -254,6 +263,7 @@ def get_admin_menu_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text="📊 Статистика", callback_data="admin:stats")],
+            [InlineKeyboardButton(text="📈 Дашборд", callback_data="admin:dashboard")],
             [InlineKeyboardButton(text="📣 Рассылка", callback_data="admin:broadcast")],
             [InlineKeyboardButton(text="⬅️ Назад в главное меню", callback_data="menu:main")]
         ]
@@ -269,6 +279,17 @@ def get_back_to_admin_kb() -> InlineKeyboardMarkup:
     )
 
 
+def get_admin_dashboard_kb() -> InlineKeyboardMarkup:
+    """Клавиатура дашборда бизнес-метрик."""
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin:dashboard")],
+            [InlineKeyboardButton(text="♻️ Пересчитать с нуля", callback_data="admin:dashboard_rebuild")],
+            [InlineKeyboardButton(text="⬅️ Назад в админ-меню", callback_data="admin:main")]
+        ]
+    )
+
+
 def get_admin_stats_kb(page: int, total_pages: int) -> InlineKeyboardMarkup:
     """
     Клавиатура пагинации для статистики админа (по 5 элементов).
@@ -311,6 +332,21 @@ def get_broadcast_confirmation_kb() -> InlineKeyboardMarkup:
     )
 
 
+
+def get_broadcast_progress_kb(job_id: int, status: str) -> InlineKeyboardMarkup | None:
+    """Управление идущей рассылкой; у завершенной кнопок нет."""
+    if status == "running":
+        toggle = InlineKeyboardButton(text="⏸ Пауза", callback_data=f"broadcast_job:pause:{job_id}")
+    elif status == "paused":
+        toggle = InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"broadcast_job:resume:{job_id}")
+    else:
+        return None
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [toggle, InlineKeyboardButton(text="⛔ Отменить", callback_data=f"broadcast_job:cancel:{job_id}")]
+        ]
+    )
+
 def get_renewal_kb(key_id: int) -> InlineKeyboardMarkup:
     """
     Создает кнопку "Продлить" для уведомлений об истечении.
@@ -387,12 +423,15 @@ def get_trial_expired_kb(key_id: int) -> InlineKeyboardMarkup:
 
 # ============= CRM КЛАВИАТУРЫ =============
 
-def get_crm_keys_list_kb(keys_on_page: list, total_keys: int, page: int = 0, page_size: int = 5) -> InlineKeyboardMarkup:
+def get_crm_keys_list_kb(keys_on_page: list, total_keys: int, page: int = 0, page_size: int = 5,
+                         has_next: bool | None = None) -> InlineKeyboardMarkup:
     """
     Генерирует клавиатуру со списком ключей для CRM (команда /info).
     Каждый ключ - кликабельная кнопка.
+    Навигация keyset: в callback передается курсор (expires_at, id) границы страницы.
     """
     keyboard = []
+    page_cursor = encode_cursor(keys_on_page[0].expires_at, keys_on_page[0].id) if keys_on_page else ""
     server_ip_to_country = {s.vless_server: s.country for s in settings.XUI_SERVERS}
 
     if keys_on_page:
@@ -430,29 +469,36 @@ def get_crm_keys_list_kb(keys_on_page: list, total_keys: int, page: int = 0, pag
             keyboard.append([
                 InlineKeyboardButton(
                     text=btn_text,
-                    callback_data=f"crm_key_details:{key.id}:{page}"
+                    callback_data=f"crm_key_details:{key.id}:{page}:{page_cursor}"
                 )
             ])
 
     # Кнопки пагинации
-    total_pages = math.ceil(total_keys / page_size)
-    if total_pages > 1:
-        nav_buttons = []
-        if page > 0:
-            nav_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"crm_keys_page:{page - 1}"))
-        if page < total_pages - 1:
-            nav_buttons.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"crm_keys_page:{page + 1}"))
-        if nav_buttons:
-            keyboard.append(nav_buttons)
+    total_pages = max(math.ceil(total_keys / page_size), page + 1)
+    if has_next is None:
+        has_next = page + 1 < total_pages
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(
+            InlineKeyboardButton(text="⬅️ Назад", callback_data=f"crm_keys_page:{page - 1}:{PREV}:{page_cursor}")
+        )
+    if has_next and keys_on_page:
+        last_cursor = encode_cursor(keys_on_page[-1].expires_at, keys_on_page[-1].id)
+        nav_buttons.append(
+            InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"crm_keys_page:{page + 1}:{NEXT}:{last_cursor}")
+        )
+    if nav_buttons:
+        keyboard.append(nav_buttons)
 
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
-def get_crm_key_details_kb(key_id: int, current_page: int) -> InlineKeyboardMarkup:
+def get_crm_key_details_kb(key_id: int, current_page: int, page_cursor: str | None = None) -> InlineKeyboardMarkup:
     """Клавиатура для детального просмотра ключа в CRM."""
+    back_data = f"crm_keys_page:{current_page}:{AT}:{page_cursor}" if page_cursor else "crm_keys_page:0"
     keyboard = [
         [InlineKeyboardButton(text="➕ Добавить дни", callback_data=f"crm_add_days:{key_id}:{current_page}")],
-        [InlineKeyboardButton(text="⬅️ Назад к списку", callback_data=f"crm_keys_page:{current_page}")]
+        [InlineKeyboardButton(text="⬅️ Назад к списку", callback_data=back_data)]
     ]
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
@@ -487,12 +533,15 @@ def get_crm_country_selection_kb() -> InlineKeyboardMarkup:
 #     ])
 
 
-def get_users_list_kb(users_on_page: list, total_users: int, page: int = 0, page_size: int = 10) -> InlineKeyboardMarkup:
+def get_users_list_kb(users_on_page: list, total_users: int, page: int = 0, page_size: int = 10,
+                      has_next: bool | None = None) -> InlineKeyboardMarkup:
     """
     Генерирует клавиатуру для списка пользователей с пагинацией.
     Каждая кнопка ведет на карточку пользователя.
+    Навигация keyset: в callback передается курсор (created_at, user_id) границы страницы.
     """
     keyboard = []
+    page_cursor = encode_cursor(users_on_page[0].created_at, users_on_page[0].user_id) if users_on_page else ""
 
     # Кнопки с пользователями
     if users_on_page:
@@ -507,17 +556,20 @@ def get_users_list_kb(users_on_page: list, total_users: int, page: int = 0, page
             keyboard.append([
                 InlineKeyboardButton(
                     text=btn_text,
-                    callback_data=f"admin:user_card:{user.user_id}:{page}"
+                    callback_data=f"admin:user_card:{user.user_id}:{page}:{page_cursor}"
                 )
             ])
 
     # Навигация
-    total_pages = math.ceil(total_users / page_size)
+    # Счетчик кэшируется, поэтому страниц может оказаться больше, чем он обещает
+    total_pages = max(math.ceil(total_users / page_size), page + 1)
+    if has_next is None:
+        has_next = page + 1 < total_pages
     nav_row = []
 
     if page > 0:
         nav_row.append(
-            InlineKeyboardButton(text="⬅️", callback_data=f"admin:users_page:{page - 1}")
+            InlineKeyboardButton(text="⬅️", callback_data=f"admin:users_page:{page - 1}:{PREV}:{page_cursor}")
         )
 
     if total_pages > 1:
@@ -525,9 +577,10 @@ def get_users_list_kb(users_on_page: list, total_users: int, page: int = 0, page
             InlineKeyboardButton(text=f"{page + 1}/{total_pages}", callback_data="ignore")
         )
 
-    if page + 1 < total_pages:
+    if has_next and users_on_page:
+        last_cursor = encode_cursor(users_on_page[-1].created_at, users_on_page[-1].user_id)
         nav_row.append(
-            InlineKeyboardButton(text="➡️", callback_data=f"admin:users_page:{page + 1}")
+            InlineKeyboardButton(text="➡️", callback_data=f"admin:users_page:{page + 1}:{NEXT}:{last_cursor}")
         )
 
     if nav_row:
@@ -539,13 +592,14 @@ def get_users_list_kb(users_on_page: list, total_users: int, page: int = 0, page
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
-def get_user_card_kb(page: int) -> InlineKeyboardMarkup:
+def get_user_card_kb(page: int, page_cursor: str | None = None) -> InlineKeyboardMarkup:
     """
     Клавиатура для карточки пользователя.
     Кнопка "Назад" возвращает к списку пользователей на той же странице.
     """
+    back_data = f"admin:users_page:{page}:{AT}:{page_cursor}" if page_cursor else f"admin:users_page:{page}"
     keyboard = [
-        [InlineKeyboardButton(text="⬅️ Назад к списку", callback_data=f"admin:users_page:{page}")]
+        [InlineKeyboardButton(text="⬅️ Назад к списку", callback_data=back_data)]
     ]
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
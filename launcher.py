@@ -0,0 +1,199 @@
+"""
+Несколько процессов бота на одном порту (WEB_WORKERS > 1, запуск - python main.py).
+
+Один процесс упирается в одно ядро: разбор JSON апдейтов, валидация моделей aiogram и сборка
+клавиатур - это CPU. Лаунчер запускает WEB_WORKERS процессов, каждый слушает APP_PORT
+с SO_REUSEPORT, и ядро ОС распределяет соединения между ними.
+
+Мастер (этот модуль) апдейты не обрабатывает:
+- при старте применяет миграции и начальные данные, запускает воркеры и, когда они готовы,
+  устанавливает вебхук Telegram; при остановке удаляет вебхук и останавливает воркеры;
+- перезапускает упавшие воркеры;
+- по SIGHUP перезапускает воркеры по одному (rolling restart): новый процесс запускается,
+  и только когда он принимает соединения, старый получает SIGTERM и дорабатывает принятые
+  апдейты (UPDATE_DRAIN_TIMEOUT_SECONDS). Воркеры запускаются через spawn, поэтому
+  перезапуск подхватывает новый код.
+
+Каждый воркер - отдельная реплика (свой WORKER_ID), общее состояние уже рассчитано на реплики:
+- FSM хранится в БД, его кэш в процессе сбрасывается через NOTIFY (database/fsm_storage.py);
+- кэши подписок и топиков CRM сбрасываются через NOTIFY CACHE_CHANNEL (database/db_commands.py),
+  кэш админов сбрасывать не нужно: админы задаются ADMIN_IDS при старте;
+- фоновые задачи работают только у лидера (database/leader.py);
+- каталог тарифов синхронизируется через LISTEN/NOTIFY - в воркерах он включается принудительно
+  (CATALOG_LISTEN_NOTIFY, вместе с ним и сброс кэшей выше);
+- лимиты троттлинга общие только при THROTTLE_BACKEND=database;
+- /metrics и /health отдает тот процесс, которому досталось соединение.
+Поэтому нужен Postgres: в SQLite каждый процесс считал бы себя лидером.
+"""
+import asyncio
+import logging
+import multiprocessing
+import signal
+import time
+
+from config import settings
+from database.dialect import IS_POSTGRES
+
+log = logging.getLogger(__name__)
+
+LOG_FORMAT = "%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s"
+
+# spawn: воркер - чистый интерпретатор без унаследованных соединений БД, event loop и WORKER_ID мастера
+_context = multiprocessing.get_context('spawn')
+
+
+def _worker_main(ready):
+    """Точка входа процесса-воркера."""
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    # Каталог тарифов, подписки и топики CRM меняются в одном процессе, а читаются из памяти всеми
+    settings.CATALOG_LISTEN_NOTIFY = True
+
+    import main
+    asyncio.run(main.serve(owns_webhook=False, reuse_port=True, ready=ready))
+
+
+class _Worker:
+    def __init__(self):
+        self.ready = _context.Event()
+        self.process = _context.Process(target=_worker_main, args=(self.ready,), name="vpnbot-worker")
+        self.process.start()
+        self.started_at = time.monotonic()
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+
+async def _prepare_database():
+    import main
+    from database import db_commands as db
+    try:
+        await main.setup_database()
+    finally:
+        await db.close_db()
+
+
+async def _set_webhook(remove: bool = False):
+    import main
+    bot = main.create_bot()
+    try:
+        if remove:
+            await bot.delete_webhook()
+            log.warning("Telegram webhook removed.")
+        else:
+            # Диспетчер нужен только для списка типов апдейтов, которые обрабатывают роутеры
+            await main.set_telegram_webhook(bot, main.create_dispatcher(bot, owns_webhook=False))
+    finally:
+        await bot.session.close()
+
+
+class Launcher:
+    """Мастер-процесс: держит workers воркеров, перезапускает упавшие, по SIGHUP - поочередно все."""
+
+    def __init__(self, workers: int):
+        self.size = workers
+        self.workers = []
+        self._stopping = False
+        self._restart_requested = False
+
+    def _on_stop(self, signum, frame):
+        log.warning(f"Received {signal.Signals(signum).name}, stopping workers")
+        self._stopping = True
+
+    def _on_restart(self, signum, frame):
+        log.warning("Received SIGHUP, restarting workers one by one")
+        self._restart_requested = True
+
+    def _wait_ready(self, worker: _Worker) -> bool:
+        deadline = time.monotonic() + settings.WORKER_START_TIMEOUT_SECONDS
+        while not self._stopping and time.monotonic() < deadline:
+            if worker.ready.wait(0.5):
+                return True
+            if not worker.process.is_alive():
+                return False
+        return False
+
+    def _stop_workers(self, workers: list):
+        for worker in workers:
+            if worker.process.is_alive():
+                worker.process.terminate()  # SIGTERM: штатная остановка (main.serve)
+        deadline = time.monotonic() + settings.WORKER_STOP_TIMEOUT_SECONDS
+        for worker in workers:
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                log.error(f"Worker {worker.pid} did not stop in time, killing")
+                worker.process.kill()
+                worker.process.join()
+
+    def _start_worker(self) -> _Worker | None:
+        worker = _Worker()
+        if self._wait_ready(worker):
+            log.info(f"Worker {worker.pid} is ready")
+            return worker
+        log.error(f"Worker {worker.pid} failed to start (exit code {worker.process.exitcode})")
+        self._stop_workers([worker])
+        return None
+
+    def _rolling_restart(self):
+        for old in list(self.workers):
+            if self._stopping:
+                return
+            new = self._start_worker()
+            if new is None:
+                log.error("Rolling restart aborted, old workers keep running")
+                return
+            self.workers.append(new)
+            self.workers.remove(old)
+            self._stop_workers([old])
+        log.info("Rolling restart finished")
+
+    def _replace_dead_workers(self):
+        for worker in list(self.workers):
+            if worker.process.is_alive():
+                continue
+            log.error(f"Worker {worker.pid} exited with code {worker.process.exitcode}, restarting")
+            self.workers.remove(worker)
+            if time.monotonic() - worker.started_at < settings.WORKER_START_TIMEOUT_SECONDS:
+                time.sleep(1)  # Падает сразу после старта - не перезапускаем в цикле без паузы
+            new = self._start_worker()
+            if new is not None:
+                self.workers.append(new)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_restart)
+
+        asyncio.run(_prepare_database())
+        for _ in range(self.size):
+            worker = self._start_worker()
+            if worker is None:
+                self._stopping = True
+                break
+            self.workers.append(worker)
+
+        if not self._stopping:
+            asyncio.run(_set_webhook())
+            log.info(f"Serving with {self.size} workers: {[worker.pid for worker in self.workers]}")
+            while not self._stopping:
+                if self._restart_requested:
+                    self._restart_requested = False
+                    self._rolling_restart()
+                self._replace_dead_workers()
+                time.sleep(0.5)
+            # Сначала вебхук: Telegram придержит новые апдейты, пока воркеры дорабатывают принятые
+            asyncio.run(_set_webhook(remove=True))
+
+        self._stop_workers(self.workers)
+        log.warning("Bot stopped!")
+
+
+def run(workers: int):
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    if not IS_POSTGRES:
+        log.error("WEB_WORKERS > 1 requires Postgres: leader election and cache invalidation use it")
+        raise SystemExit(1)
+    if settings.THROTTLE_BACKEND == 'memory':
+        log.warning(f"THROTTLE_BACKEND=memory: each of {workers} workers counts limits separately, "
+                    f"use THROTTLE_BACKEND=database for shared limits")
+    Launcher(workers).run()
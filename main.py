@@ -1,17 +1,23 @@
 import asyncio
 import logging
+import signal
 import scheduler_tasks
+import broadcast
 from pathlib import Path
 from aiohttp import web
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
-from sqlalchemy.dialects.postgresql import insert
+from aiogram.webhook.aiohttp_server import setup_application
 
 from config import settings
 from database import db_commands as db
-from handlers import user_handlers, admin_handlers, webhook_handlers, crm_handlers, webapp_handlers
+from database.leader import LeaderElection
+from database.fsm_storage import DatabaseStorage
+from handlers import user_handlers, admin_handlers, webhook_handlers, crm_handlers, webapp_handlers, health_handlers
 from middlewares.crm_filter import CRMFilterMiddleware
+from middlewares.chat_status import ChatStatusMiddleware
+from middlewares.fsm_flush import FSMFlushMiddleware
+from middlewares.throttling import ThrottlingMiddleware
+from update_queue import QueuedRequestHandler
 
 TELEGRAM_WEBHOOK_PATH = "/webhook/telegram"
 YOOKASSA_WEBHOOK_PATH = settings.WEBHOOK_PATH
@@ -21,18 +27,22 @@ APP_PORT = 8080
 log = logging.getLogger(__name__)
 
 
-async def on_startup(bot: Bot):
-    """Действия при старте: установка вебхука Telegram."""
+async def set_telegram_webhook(bot: Bot, dispatcher: Dispatcher):
+    """Устанавливает вебхук Telegram на этот сервер."""
     webhook_url = f"{settings.WEBHOOK_HOST}{TELEGRAM_WEBHOOK_PATH}"
-    await bot.set_webhook(webhook_url)
+    # Явный список типов апдейтов: иначе Telegram оставит список от прошлой установки вебхука
+    # (нужен, например, my_chat_member - блокировка бота пользователем)
+    await bot.set_webhook(webhook_url, allowed_updates=dispatcher.resolve_used_update_types())
     log.info(f"Telegram webhook set up at {webhook_url}")
 
-    # Инициализация БД и добавление данных
+
+async def setup_database():
+    """Миграции схемы и начальные данные (один раз на запуск, до приема апдейтов)."""
     await db.init_db()
     async with db.AsyncSessionLocal() as session:
         async with session.begin():
             # Добавляем админа
-            admin_insert_stmt = insert(db.Admins).values(
+            admin_insert_stmt = db.upsert_insert(db.Admins).values(
                 user_id=settings.get_admin_ids[0],
                 is_super_admin=True)
             admin_do_nothing_stmt = admin_insert_stmt.on_conflict_do_nothing(
@@ -58,35 +68,85 @@ async def on_startup(bot: Bot):
                     {'name': '90 дней', 'price': 379.0, 'duration_days': 90, 'country': 'Нидерланды'},
                 ]
                 # Добавляем новые тарифы
-                await session.execute(insert(db.Products), all_tariffs)
+                await session.execute(db.insert(db.Products), all_tariffs)
                 log.info("Начальные тарифы добавлены.")
             else:
                 log.info(f"В таблице Products уже есть {products_count} тарифов. Пропускаю добавление.")
             await session.commit()
     log.info("База данных инициализирована, админ и тарифы добавлены.")
 
-    asyncio.create_task(scheduler_tasks.check_expirations(bot))
+    # Сводные таблицы метрик для дашборда (заполняются при первом запуске)
+    await db.ensure_business_metrics()
 
 
-async def on_shutdown(bot: Bot):
-    """Действия при остановке: удаление вебхука."""
-    log.warning("Shutting down..")
-    await bot.delete_webhook()
-    log.warning("Telegram webhook removed.")
+async def on_startup(bot: Bot, leader: LeaderElection, dispatcher: Dispatcher, owns_webhook: bool):
+    """
+    Действия при старте процесса.
+    owns_webhook=False - процесс запущен лаунчером (launcher.py): вебхук и БД уже подготовил мастер.
+    """
+    if owns_webhook:
+        await set_telegram_webhook(bot, dispatcher)
+        await setup_database()
 
+    # Кэш FSM сбрасывается, когда состояние пользователя меняет другая реплика
+    await dispatcher.storage.start_listener()
+
+    # Каталог тарифов обслуживается из памяти
+    await db.load_product_catalog()
+    await db.start_catalog_listener()
+
+    # Реплика для чтения: включается только после первой проверки отставания
+    if db.replica_engine is not None:
+        await db.check_replica_lag()
+        asyncio.create_task(db.monitor_replica_lag())
+
+    # Планировщик и архивация запускаются только в реплике-лидере
+    asyncio.create_task(leader.run())
+
+
+async def on_shutdown(bot: Bot, leader: LeaderElection, dispatcher: Dispatcher, owns_webhook: bool):
+    """Действия при остановке: лидерство отдается другой реплике, вебхук удаляется (если он наш)."""
+    log.warning("Shutting down..")
+    await leader.stop()
+    await dispatcher.storage.close()
+    if owns_webhook:
+        await bot.delete_webhook()
+        log.warning("Telegram webhook removed.")
+    await db.close_db()
 
-async def main():
-    logging.basicConfig(level=logging.INFO)
-    global log
-    log = logging.getLogger(__name__)
 
+def create_bot() -> Bot:
     bot = Bot(token=settings.BOT_TOKEN.get_secret_value())
-    storage = MemoryStorage()
+    # Отмечает пользователей, заблокировавших бота (TelegramForbiddenError на любой запрос)
+    bot.session.middleware(ChatStatusMiddleware())
+    return bot
+
+
+def create_dispatcher(bot: Bot, owns_webhook: bool = True) -> Dispatcher:
+    """Диспетчер со всеми роутерами, middleware и задачами лидера (dp['leader'], dp['throttling'])."""
+    # FSM в БД: сценарий переживает рестарт и продолжается в любой реплике
+    storage = DatabaseStorage(db.engine, worker_id=db.WORKER_ID)
     dp = Dispatcher(storage=storage)
+    dp.update.outer_middleware(FSMFlushMiddleware(storage))
+
+    # Фоновые задачи, которые должны работать ровно в одном процессе
+    leader = LeaderElection(db.engine, worker_id=db.WORKER_ID, jobs=[
+        ("scheduler", lambda: scheduler_tasks.check_expirations(bot)),
+        ("archiver", scheduler_tasks.archive_stale_data),
+        ("broadcasts", lambda: broadcast.run_broadcasts(bot)),
+        ("fsm_cleanup", lambda: scheduler_tasks.cleanup_fsm_states(storage)),
+    ])
+    dp['leader'] = leader
+    dp['owns_webhook'] = owns_webhook
 
     # Регистрируем middleware для фильтрации CRM-топиков
     dp.message.middleware(CRMFilterMiddleware())
     dp.callback_query.middleware(CRMFilterMiddleware())
+    # Лимиты частоты действий пользователей (после CRM-фильтра: отброшенные им апдейты токены не тратят)
+    throttling = ThrottlingMiddleware()
+    dp.message.middleware(throttling)
+    dp.callback_query.middleware(throttling)
+    dp['throttling'] = throttling
 
     # Регистрируем роутеры (порядок важен!)
     dp.include_router(crm_handlers.router)  # CRM-команды первыми
@@ -96,22 +156,31 @@ async def main():
     # Регистрируем lifecycle хуки
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
+    return dp
+
 
+def create_app(bot: Bot, dp: Dispatcher) -> web.Application:
     # Создаем приложение aiohttp
     app = web.Application()
 
     # Передаем объект bot в приложение, чтобы вебхук ЮKassa мог его использовать
     app['bot'] = bot
+    app['leader'] = dp['leader']
+    app['throttling'] = dp['throttling']
 
-    # Регистрируем обработчик для вебхуков Telegram
-    SimpleRequestHandler(
+    # Регистрируем обработчик для вебхуков Telegram: отвечает сразу, апдейты обрабатывает пул воркеров
+    telegram_webhook = QueuedRequestHandler(
         dispatcher=dp,
         bot=bot,
-    ).register(app, path=TELEGRAM_WEBHOOK_PATH)
+    )
+    telegram_webhook.register(app, path=TELEGRAM_WEBHOOK_PATH)
+    app['update_queue'] = telegram_webhook.queue
 
     app.router.add_post(YOOKASSA_WEBHOOK_PATH, webhook_handlers.yookassa_webhook_handler)
     app.router.add_post(settings.CRYPTO_BOT_WEBHOOK_PATH, webhook_handlers.crypto_bot_webhook_handler)
     app.router.add_get("/sub/{token}", webhook_handlers.subscription_handler)
+    app.router.add_get("/health", health_handlers.health_handler)
+    app.router.add_get("/metrics", health_handlers.metrics_handler)
 
     # # Web App API endpoints
     # app.router.add_get("/api/webapp/health", webapp_handlers.webapp_health_check)
@@ -123,20 +192,49 @@ async def main():
 
     # Связываем aiohttp приложение с диспетчером aiogram
     setup_application(app, dp, bot=bot)
+    return app
+
+
+async def serve(owns_webhook: bool = True, reuse_port: bool = False, ready=None):
+    """
+    Запускает бота и работает до SIGTERM/SIGINT, затем останавливается штатно:
+    перестает принимать соединения, дорабатывает принятые апдейты и отдает лидерство.
+    reuse_port - порт слушают несколько процессов (launcher.py); ready.set() - процесс принимает запросы.
+    """
+    bot = create_bot()
+    dp = create_dispatcher(bot, owns_webhook=owns_webhook)
+    app = create_app(bot, dp)
 
     # Запускаем веб-сервер aiohttp
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, APP_HOST, APP_PORT)
+    site = web.TCPSite(runner, APP_HOST, APP_PORT, reuse_port=reuse_port)
     log.info(f"Starting aiohttp server on http://{APP_HOST}:{APP_PORT}")
     await site.start()
+    if ready is not None:
+        ready.set()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
 
-    # Бесконечный цикл (чтобы процесс не завершался)
-    await asyncio.Event().wait()
+    log.warning(f"Worker {db.WORKER_ID} is stopping")
+    await runner.cleanup()
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    global log
+    log = logging.getLogger(__name__)
+    await serve()
 
 
 if __name__ == "__main__":
-    try:
+    if settings.WEB_WORKERS > 1:
+        import launcher
+        launcher.run(settings.WEB_WORKERS)
+    else:
         asyncio.run(main())
-    except (KeyboardInterrupt, SystemExit):
         log.warning("Bot stopped!")
@@ -0,0 +1,32 @@
+"""
+Request-middleware бота для отслеживания недоступных чатов.
+Если Telegram отвечает TelegramForbiddenError на запрос в личный чат, пользователь получает
+chat_status blocked/deactivated и выпадает из массовых отправок (планировщик, рассылки).
+"""
+import logging
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramForbiddenError
+
+from database import db_commands as db
+
+log = logging.getLogger(__name__)
+
+
+class ChatStatusMiddleware(BaseRequestMiddleware):
+    """Отмечает пользователей, заблокировавших бота или удаливших аккаунт."""
+
+    async def __call__(self, make_request, bot, method):
+        try:
+            return await make_request(bot, method)
+        except TelegramForbiddenError as e:
+            chat_id = getattr(method, 'chat_id', None)
+            # У групп и каналов ID отрицательные, а chat_id может быть и @username
+            if isinstance(chat_id, int) and chat_id > 0:
+                status = db.CHAT_DEACTIVATED if "deactivated" in e.message.lower() else db.CHAT_BLOCKED
+                try:
+                    if await db.set_chat_status(chat_id, status):
+                        log.info(f"User {chat_id} chat status: {status}")
+                except Exception as db_error:
+                    log.warning(f"Failed to update chat status of {chat_id}: {db_error}")
+            raise
@@ -0,0 +1,42 @@
+"""
+Middleware, сохраняющий изменения FSM после обработки апдейта (см. database/fsm_storage.py).
+"""
+import logging
+from typing import Callable, Dict, Any, Awaitable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from database.fsm_storage import DatabaseStorage, track_changes
+
+log = logging.getLogger(__name__)
+
+
+class FSMFlushMiddleware(BaseMiddleware):
+    """
+    Все set_state/set_data за время обработки апдейта сохраняются одним запросом сразу после
+    его обработки. Сохраняются только ключи, измененные этим апдейтом: изменения других апдейтов,
+    которые еще обрабатываются, сохранят они сами.
+
+    Вебхук отвечает раньше (апдейт обрабатывается в фоне, см. update_queue.py): следующий апдейт
+    чата в этом процессе ждет в очереди и увидит изменения, другая реплика - после сохранения.
+    """
+
+    def __init__(self, storage: DatabaseStorage):
+        self.storage = storage
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        with track_changes() as keys:
+            try:
+                return await handler(event, data)
+            finally:
+                try:
+                    await self.storage.flush(keys)
+                except Exception as e:
+                    # Изменения остались в кэше процесса и сохранятся при следующем изменении ключа
+                    log.error(f"Failed to save FSM state: {e}")
@@ -1,34 +1,127 @@
-import asyncio
-from typing import Any, Awaitable, Callable, Dict
+"""
+Ограничение частоты действий пользователей (сообщения и нажатия кнопок).
+
+У каждого пользователя своя корзина токенов на каждое действие. Действие задает флаг хендлера:
+
+    @router.callback_query(F.data.startswith("buy_product:"), flags={THROTTLING_FLAG: ACTION_ORDER})
+
+Хендлеры без флага делят корзину ACTION_DEFAULT, flags={THROTTLING_FLAG: None} отключает ограничение.
+Лимиты действий - THROTTLE_* в настройках.
+Админы не ограничиваются.
+
+Бэкенды (THROTTLE_BACKEND):
+- memory: KeyedTokenBuckets в процессе, не больше THROTTLE_MAX_USERS корзин на действие;
+- database: общие корзины всех реплик в таблице throttle_buckets (один upsert на действие).
+  Сначала проверяется корзина процесса: ей видна только часть трафика пользователя, поэтому
+  если лимит исчерпан в ней, то исчерпан и в общей - флуд отсекается без запросов к БД.
+  Если БД недоступна, действие разрешается: троттлинг не должен останавливать бота.
+
+Middleware регистрируется как внутренний (dp.message.middleware(...)): флаги доступны
+только после выбора хендлера, а апдейты без хендлера токены не тратят.
+"""
+import logging
+import time
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, NamedTuple
 
 from aiogram import BaseMiddleware
 from aiogram.dispatcher.flags import get_flag
-from aiogram.types import Message
-from cachetools import TTLCache
+from aiogram.types import CallbackQuery, TelegramObject
+
+from config import settings
+from database import db_commands as db
+from rate_limit import KeyedTokenBuckets
+
+log = logging.getLogger(__name__)
+
+THROTTLING_FLAG = "throttling"
+
+ACTION_DEFAULT = "default"
+ACTION_ORDER = "order"  # Создание заказа или пробного ключа
+ACTION_PAYMENT = "payment"  # Запрос к платежной системе
+
+THROTTLED_TEXT = "⏳ Слишком часто. Попробуйте через несколько секунд."
+
+
+class Limit(NamedTuple):
+    rate: float  # Действий в секунду
+    burst: int  # Сколько действий подряд без ожидания
+
+
+ACTION_LIMITS = {
+    ACTION_DEFAULT: Limit(settings.THROTTLE_DEFAULT_RATE, settings.THROTTLE_DEFAULT_BURST),
+    ACTION_ORDER: Limit(settings.THROTTLE_ORDER_PER_MINUTE / 60, settings.THROTTLE_ORDER_BURST),
+    ACTION_PAYMENT: Limit(settings.THROTTLE_PAYMENT_PER_MINUTE / 60, settings.THROTTLE_PAYMENT_BURST),
+}
+
+
+class MemoryThrottleBackend:
+    """Корзины в памяти процесса."""
+
+    def __init__(self, limits: dict[str, Limit], max_users: int):
+        self._buckets = {
+            action: KeyedTokenBuckets(limit.rate, capacity=limit.burst, maxsize=max_users)
+            for action, limit in limits.items()
+        }
+
+    async def allow(self, action: str, user_id: int) -> bool:
+        return self._buckets[action].get(user_id).try_acquire() == 0
+
+    def stats(self) -> dict:
+        return {action: len(buckets) for action, buckets in self._buckets.items()}
+
+
+class DatabaseThrottleBackend(MemoryThrottleBackend):
+    """Общие корзины в throttle_buckets; корзины процесса - фильтр перед запросом к БД."""
+
+    def __init__(self, limits: dict[str, Limit], max_users: int):
+        super().__init__(limits, max_users)
+        self._limits = limits
+
+    async def allow(self, action: str, user_id: int) -> bool:
+        if not await super().allow(action, user_id):
+            return False
+        limit = self._limits[action]
+        try:
+            return await db.take_throttle_token(f"{action}:{user_id}", time.time(), limit.rate, limit.burst)
+        except Exception as e:
+            log.warning(f"Throttling backend unavailable, allowing {action} for {user_id}: {e!r}")
+            return True
 
 
 class ThrottlingMiddleware(BaseMiddleware):
-    """
-    Простой middleware для защиты от спама (троттлинга).
-    Использует TTLCache для хранения ID пользователей.
-    """
+    """Отбрасывает сообщения и нажатия кнопок сверх лимита действия."""
 
-    def __init__(self, rate_limit: float = 2.0):
-        #
-        self.cache = TTLCache(maxsize=10_000, ttl=rate_limit)
+    def __init__(self, backend=None, limits: dict[str, Limit] | None = None):
+        self.limits = limits or ACTION_LIMITS
+        if backend is None:
+            backend_class = DatabaseThrottleBackend if settings.THROTTLE_BACKEND == 'database' else MemoryThrottleBackend
+            backend = backend_class(self.limits, settings.THROTTLE_MAX_USERS)
+        self.backend = backend
+        self.admin_ids = frozenset(settings.get_admin_ids)
+        self.throttled = Counter()  # Действие -> отброшено апдейтов с запуска (для /metrics)
 
     async def __call__(
             self,
-            handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
-            event: Message,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
             data: Dict[str, Any],
     ) -> Any:
-        user_id = event.from_user.id
-        if user_id in self.cache:
-            return
+        user = data.get('event_from_user')
+        action = get_flag(data, THROTTLING_FLAG, default=ACTION_DEFAULT)
+        if user is None or user.id in self.admin_ids or action not in self.limits:
+            return await handler(event, data)
 
-        #
-        self.cache[user_id] = None
+        if await self.backend.allow(action, user.id):
+            return await handler(event, data)
 
-        #
-        return await handler(event, data)
\ No newline at end of file
+        self.throttled[action] += 1
+        log.info(f"Throttled {action} for user {user.id}")
+        if isinstance(event, CallbackQuery):
+            # Иначе у пользователя будут "часики" на кнопке до таймаута
+            try:
+                await event.answer(THROTTLED_TEXT)
+            except Exception as e:
+                log.debug(f"Failed to answer throttled callback: {e}")
+        # Лишние сообщения отбрасываются молча, чтобы не отвечать на флуд
+        return None
@@ -0,0 +1,194 @@
+"""
+Массовая отправка уведомлений с учетом лимитов Telegram.
+
+- общий лимит бота (NOTIFY_GLOBAL_RATE сообщений в секунду);
+- лимит на чат: личный чат - NOTIFY_PRIVATE_CHAT_RATE в секунду,
+  группа (CRM) - NOTIFY_GROUP_CHAT_PER_MINUTE в минуту;
+- TelegramRetryAfter приостанавливает отправки на указанное время, после чего сообщение
+  отправляется повторно (до NOTIFY_MAX_RETRIES раз). Из группы (CRM) - только в эту группу:
+  ее лимит свой; из личного чата - все отправки, там упираемся в общий лимит бота;
+- фоновых отправок (send_later) не больше NOTIFY_BACKGROUND_MAX_PENDING, лишние отбрасываются;
+- TelegramForbiddenError (пользователь заблокировал бота) считается в stats.blocked.
+
+Использование:
+    stats = await dispatcher.run("expiry", keys, handle_key)  # handle_key(key) -> bool
+
+    # внутри handle_key
+    await dispatcher.send(key.user_id, lambda: bot.send_message(key.user_id, text))
+    dispatcher.send_later(settings.CRM_GROUP_ID, lambda: crm.notify_key_expired(...))
+"""
+import asyncio
+import logging
+import time
+from contextvars import ContextVar
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
+
+from config import settings
+from rate_limit import TokenBucket, KeyedTokenBuckets
+
+log = logging.getLogger(__name__)
+
+# Счетчики текущего прогона run(); у каждого прогона свои, даже если они идут параллельно
+_current_stats = ContextVar('notifier_stats', default=None)
+
+
+class PhaseStats:
+    """Счетчики одного прогона (фазы планировщика, рассылки)."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.selected = 0  # Сколько элементов передано на обработку
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0  # Из failed: пользователь заблокировал бота
+        self.retries = 0
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def rate(self) -> float:
+        """Сообщений в секунду."""
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            'selected': self.selected,
+            'sent': self.sent,
+            'failed': self.failed,
+            'blocked': self.blocked,
+            'retries': self.retries,
+            'elapsed_seconds': round(self.elapsed, 3),
+            'rate_per_second': round(self.rate, 2),
+        }
+
+    def __str__(self):
+        return (f"{self.name}: selected {self.selected}, sent {self.sent}, failed {self.failed} "
+                f"(blocked {self.blocked}), retries {self.retries} "
+                f"in {self.elapsed:.1f}s ({self.rate:.1f} msg/s)")
+
+
+class NotificationDispatcher:
+    """Параллельная отправка сообщений в рамках общего лимита бота и лимитов чатов."""
+
+    def __init__(self, global_rate: float, private_chat_rate: float, group_chat_per_minute: float,
+                 concurrency: int, max_retries: int, max_background: int):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.max_background = max_background
+        self._global = TokenBucket(global_rate)
+        self._private_chats = KeyedTokenBuckets(private_chat_rate)
+        # В группу можно ~20 сообщений в минуту, без всплеска
+        self._group_chats = KeyedTokenBuckets(group_chat_per_minute / 60, capacity=1)
+        self._background = set()
+        self.dropped_background = 0  # Фоновых отправок, отброшенных из-за переполнения
+        self.last_stats = {}  # Имя прогона -> PhaseStats последнего прогона
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        # У групп и каналов отрицательные ID
+        return self._group_chats.get(chat_id) if chat_id < 0 else self._private_chats.get(chat_id)
+
+    async def send(self, chat_id: int, make_call):
+        """
+        Выполняет make_call() (корутину, отправляющую сообщение в chat_id) в рамках лимитов.
+        На TelegramRetryAfter ждет и повторяет; остальные ошибки пробрасывает.
+        """
+        chat_bucket = self._chat_bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            await chat_bucket.acquire()
+            await self._global.acquire()
+            try:
+                return await make_call()
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                log.warning(f"Flood control: retry after {e.retry_after}s (chat {chat_id})")
+                chat_bucket.pause(e.retry_after)
+                if chat_id > 0:
+                    # Лимит личного чата мы соблюдаем сами, значит уперлись в общий лимит бота -
+                    # притормаживаем все отправки. Лимит группы свой и других чатов не касается
+                    self._global.pause(e.retry_after)
+                stats = _current_stats.get()
+                if stats:
+                    stats.retries += 1
+            except TelegramForbiddenError:
+                stats = _current_stats.get()
+                if stats:
+                    stats.blocked += 1
+                raise
+
+    def send_later(self, chat_id: int | None, make_call):
+        """
+        Отправка в фоне, без ожидания результата (уведомления в CRM-группу:
+        ее лимит намного ниже личных чатов и не должен тормозить основную рассылку).
+        Если в фоне уже max_background отправок, сообщение отбрасывается: при лимите группы
+        ~20 в минуту большая рассылка копила бы задачи в памяти часами.
+        """
+        if chat_id is None:
+            return
+        if len(self._background) >= self.max_background:
+            self.dropped_background += 1
+            if self.dropped_background % 100 == 1:  # Не больше строки лога на сотню отброшенных
+                log.warning(f"Background send queue is full ({self.max_background}), "
+                            f"{self.dropped_background} sends dropped so far (chat {chat_id})")
+            return
+
+        async def _send():
+            _current_stats.set(None)  # Фоновая отправка не относится к прогону, из которого запущена
+            try:
+                await self.send(chat_id, make_call)
+            except Exception as e:
+                log.warning(f"Background send to {chat_id} failed: {e}")
+
+        task = asyncio.create_task(_send())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def run(self, name: str, items: list, handler, stats: PhaseStats | None = None) -> PhaseStats:
+        """
+        Обрабатывает items параллельно (не больше concurrency одновременно).
+        handler(item) возвращает True, если сообщение доставлено; исключение считается ошибкой.
+        stats - продолжить счетчики предыдущей пачки того же прогона.
+        """
+        stats = stats or PhaseStats(name)
+        stats.selected += len(items)
+        token = _current_stats.set(stats)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def _handle(item):
+            async with semaphore:
+                try:
+                    delivered = await handler(item)
+                except Exception as e:
+                    log.warning(f"{name}: failed to handle {item}: {e}")
+                    delivered = False
+            if delivered:
+                stats.sent += 1
+            else:
+                stats.failed += 1
+
+        try:
+            await asyncio.gather(*(_handle(item) for item in items))
+        finally:
+            stats.finished_at = time.monotonic()
+            _current_stats.reset(token)
+        self.last_stats[name] = stats
+        return stats
+
+    @property
+    def pending_background(self) -> int:
+        return len(self._background)
+
+
+dispatcher = NotificationDispatcher(
+    global_rate=settings.NOTIFY_GLOBAL_RATE,
+    private_chat_rate=settings.NOTIFY_PRIVATE_CHAT_RATE,
+    group_chat_per_minute=settings.NOTIFY_GROUP_CHAT_PER_MINUTE,
+    concurrency=settings.NOTIFY_CONCURRENCY,
+    max_retries=settings.NOTIFY_MAX_RETRIES,
+    max_background=settings.NOTIFY_BACKGROUND_MAX_PENDING,
+)
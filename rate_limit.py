@@ -0,0 +1,77 @@
+"""
+Ограничители частоты (token bucket) для исходящих сообщений и входящих апдейтов.
+
+Не потокобезопасны: рассчитаны на использование из одного event loop.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """
+    Корзина на capacity токенов, пополняется со скоростью rate токенов в секунду.
+    capacity задает допустимый всплеск; по умолчанию - одна секунда работы на полной скорости.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        """Берет токены и возвращает 0 или, если их не хватает, сколько секунд подождать."""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._refill(now)
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return 0.0
+        return (tokens - self._tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1.0):
+        while (delay := self.try_acquire(tokens)) > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float):
+        """Никому не выдавать токены ближайшие seconds секунд (например, по RetryAfter)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    @property
+    def is_full(self) -> bool:
+        self._refill(time.monotonic())
+        return self._tokens >= self.capacity and time.monotonic() >= self._paused_until
+
+
+class KeyedTokenBuckets:
+    """
+    Отдельная TokenBucket на каждый ключ (чат, пользователь) с ограничением числа ключей.
+    При переполнении вытесняются давно не использованные корзины.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None, maxsize: int = 10_000):
+        self.rate = rate
+        self.capacity = capacity
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+
+    def get(self, key) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def __len__(self):
+        return len(self._buckets)
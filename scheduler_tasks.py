@@ -1,114 +1,446 @@
 import asyncio
+import heapq
 import logging
 import datetime
+import time
+from collections import deque, Counter, defaultdict
 
 from aiogram import Bot
 from database import db_commands as db
 from keyboards import get_renewal_kb, get_trial_discount_kb, get_take_trial_reminder_kb, get_trial_expired_kb
 from config import settings
+from notifier import dispatcher, PhaseStats
 import crm
 
 log = logging.getLogger(__name__)
 
 
+# Фазы планировщика. Каждая фаза захватывает строки пачками (db.get_* делают атомарный claim),
+# поэтому несколько реплик делят работу без повторных уведомлений
+PHASE_RENEWAL_WARNING = "renewal_warning"
+PHASE_TRIAL_WARNING = "trial_warning"
+PHASE_EXPIRY = "expiry"
+PHASE_TRIAL_REMINDER = "trial_reminder"
+
+RENEWAL_WARNING_HOURS = 24  # Предупреждение за 24 часа (платные ключи)
+TRIAL_WARNING_HOURS = 2  # Предупреждение за 2 часа (пробные ключи)
+TRIAL_REMINDER_HOURS = 24  # Напоминание взять триал через 24 часа после регистрации
+
+
+# Что разбудило цикл планировщика
+TRIGGER_RESYNC = "resync"
+TRIGGER_DEADLINE = "deadline"
+
+
+async def _run_phase(phase: str, claim_batch, notify, release) -> PhaseStats:
+    """
+    Захватывает пачки и рассылает их через диспетчер, пока захватывать нечего.
+    Захват неотправленных снимается release(items) после фазы (а не сразу - иначе фаза
+    захватывала бы их снова): следующая фаза или цикл их подберет, не дожидаясь CLAIM_TTL.
+    """
+    stats = PhaseStats(phase)
+    failed = []
+
+    async def handle(item) -> bool:
+        delivered = False
+        try:
+            delivered = await notify(item)
+        finally:
+            if not delivered:
+                failed.append(item)
+        return delivered
+
+    try:
+        while batch := await claim_batch():
+            await dispatcher.run(phase, batch, handle, stats)
+    finally:
+        if failed:
+            try:
+                await release(failed)
+            except Exception as e:
+                log.error(f"Failed to release {len(failed)} claims of scheduler phase {phase}: {e}")
+    stats.finished_at = time.monotonic()
+    if stats.selected:
+        log.info(f"Scheduler phase {stats}")
+    return stats
+
+
+async def _release_keys(keys):
+    await db.release_key_claims([key.id for key in keys])
+
+
+async def send_renewal_warnings(bot: Bot) -> PhaseStats:
+    """=== 1. ПРЕДУПРЕЖДЕНИЕ ЗА 24 ЧАСА (Платные ключи) ==="""
+    async def notify(key) -> bool:
+        try:
+            await dispatcher.send(key.user_id, lambda: bot.send_message(
+                key.user_id,
+                f"🔔 **Напоминание:**\n\n"
+                f"Ваш ключ для тарифа «{key.name}» истекает менее чем через 24 часа.\n"
+                "Чтобы избежать прерывания, вы можете продлить его прямо сейчас.",
+                reply_markup=get_renewal_kb(key.id),
+                parse_mode="Markdown"
+            ))
+            await db.mark_renewal_warning_sent(key.id)
+
+            # CRM: Уведомление об отправке предупреждения
+            dispatcher.send_later(settings.CRM_GROUP_ID,
+                                  lambda: crm.notify_renewal_warning_sent(bot, key.user_id, key.name, 24))
+            return True
+        except Exception as e:
+            log.warning(f"Failed to send 24h warning to {key.user_id}: {e}")
+            return False
+
+    return await _run_phase(PHASE_RENEWAL_WARNING,
+                            lambda: db.get_keys_for_renewal_warning(hours=RENEWAL_WARNING_HOURS), notify,
+                            _release_keys)
+
+
+async def send_trial_warnings(bot: Bot) -> PhaseStats:
+    """=== 2. TASK 4: ПРЕДУПРЕЖДЕНИЕ ЗА 2 ЧАСА (Пробные ключи) ==="""
+    async def notify(key) -> bool:
+        try:
+            await dispatcher.send(key.user_id, lambda: bot.send_message(
+                key.user_id,
+                "⏳ **Ваш пробный период истекает через 2 часа!**\n\n"
+                "Понравилась скорость? 🔥\n"
+                "Продлите доступ сейчас со скидкой: **1 месяц (Финляндия) всего за 119₽** вместо 199₽!",
+                reply_markup=get_trial_discount_kb(key.id),
+                parse_mode="Markdown"
+            ))
+            await db.mark_trial_warning_sent(key.id)
+
+            # CRM: Уведомление об отправке предупреждения о триале
+            dispatcher.send_later(settings.CRM_GROUP_ID, lambda: crm.notify_trial_warning_sent(bot, key.user_id))
+            return True
+        except Exception as e:
+            log.warning(f"Failed to send 2h trial warning to {key.user_id}: {e}")
+            return False
+
+    return await _run_phase(PHASE_TRIAL_WARNING,
+                            lambda: db.get_trial_keys_for_warning(hours=TRIAL_WARNING_HOURS), notify,
+                            _release_keys)
+
+
+async def send_expiry_notifications(bot: Bot) -> PhaseStats:
+    """=== 3. ИСТЕКШИЕ КЛЮЧИ (Task 3 update) ==="""
+    async def notify(key) -> bool:
+        try:
+            if key.order_id is None:
+                # TASK 3: Сообщение об истечении триала с кнопкой продления
+                await dispatcher.send(key.user_id, lambda: bot.send_message(
+                    key.user_id,
+                    "⌛️ **Ваш пробный период (24ч) истек.**\n\n"
+                    "Надеемся, вам понравилась скорость! 🇫🇮\n\n"
+                    "Чтобы продолжить пользоваться VPN, продлите подписку.\n\n"
+                    "💬 **Напишите в поддержку свой отзыв и получите 7 дней бесплатно!**",
+                    reply_markup=get_trial_expired_kb(key.id),
+                    parse_mode="Markdown"
+                ))
+            else:
+                # Обычное истечение платного ключа
+                await dispatcher.send(key.user_id, lambda: bot.send_message(
+                    key.user_id,
+                    "❌ **Срок действия вашего ключа истек.**\n\n"
+                    "Вы можете продлить его, чтобы восстановить доступ.",
+                    reply_markup=get_renewal_kb(key.id),
+                    parse_mode="Markdown"
+                ))
+            await db.mark_expiry_notification_sent(key.id)
+
+            # CRM: Уведомление об истечении ключа
+            dispatcher.send_later(settings.CRM_GROUP_ID,
+                                  lambda: crm.notify_key_expired(bot, key.user_id, is_trial=(key.order_id is None)))
+            return True
+        except Exception as e:
+            log.warning(f"Failed to send expiry notification to {key.user_id}: {e}")
+            return False
+
+    # Заблокировавшим бота не пишем, но ключ все равно закрываем (метрики серверов, архив)
+    closed = await db.close_expired_keys_of_inactive_chats()
+    if closed:
+        log.info(f"Closed {closed} expired keys of users who blocked the bot")
+    return await _run_phase(PHASE_EXPIRY, db.get_keys_for_expiry_notification, notify, _release_keys)
+
+
+async def send_trial_reminders(bot: Bot) -> PhaseStats:
+    """=== 4. ЗАДАЧА 2: НАПОМИНАНИЕ О ТРИАЛЕ (КТО НЕ ВЗЯЛ) ==="""
+    async def notify(user_id: int) -> bool:
+        try:
+            await dispatcher.send(user_id, lambda: bot.send_message(
+                user_id,
+                "👋 Привет!\n\n"
+                "Вы были в боте 24 часа назад, но так и не попробовали наш VPN.\n\n"
+                "Не упускайте шанс оценить премиум-скорость (Финляндия 🇫🇮) бесплатно!\n\n"
+                "💬 Если нужна помощь — напишите в поддержку, мы всегда на связи!",
+                reply_markup=get_take_trial_reminder_kb(),
+                parse_mode="Markdown"
+            ))
+            await db.mark_trial_reminder_sent(user_id)
+
+            # CRM: Уведомление об отправке напоминания о триале
+            dispatcher.send_later(settings.CRM_GROUP_ID, lambda: crm.notify_trial_reminder_sent(bot, user_id))
+            return True
+        except Exception as e:
+            log.warning(f"Failed to send trial reminder to {user_id}: {e}")
+            return False
+
+    return await _run_phase(
+        PHASE_TRIAL_REMINDER,
+        lambda: db.get_users_for_trial_reminder(hours_min=TRIAL_REMINDER_HOURS, hours_max=TRIAL_REMINDER_HOURS + 1),
+        notify,
+        db.release_user_claims
+    )
+
+
+PHASES = {
+    PHASE_RENEWAL_WARNING: send_renewal_warnings,
+    PHASE_TRIAL_WARNING: send_trial_warnings,
+    PHASE_EXPIRY: send_expiry_notifications,
+    PHASE_TRIAL_REMINDER: send_trial_reminders,
+}
+
+
+def key_deadlines(order_id: int | None, expires_at: datetime.datetime):
+    """Моменты, когда по ключу наступает работа для фаз: [(срок, фаза), ...]."""
+    if order_id is None:
+        warning = (expires_at - datetime.timedelta(hours=TRIAL_WARNING_HOURS), PHASE_TRIAL_WARNING)
+    else:
+        warning = (expires_at - datetime.timedelta(hours=RENEWAL_WARNING_HOURS), PHASE_RENEWAL_WARNING)
+    return [warning, (expires_at, PHASE_EXPIRY)]
+
+
+class DeadlineQueue:
+    """
+    Min-heap сроков (срок, фаза) на окно вперед. Элемент - лишь повод запустить фазу:
+    сама фаза берет из БД все, что уже наступило, поэтому устаревшие элементы
+    (ключ продлили, уведомление уже отправила другая реплика) стоят один пустой запрос.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._changed = asyncio.Event()
+        self.window_end = datetime.datetime.min  # Сроки позже этого в очередь не попадают
+
+    def push(self, due_at: datetime.datetime, phase: str):
+        if due_at > self.window_end:
+            return  # Загрузится при следующей сверке
+        if not self._heap or due_at < self._heap[0][0]:
+            self._changed.set()  # Пересчитать время сна
+        heapq.heappush(self._heap, (due_at, phase))
+
+    def reset(self, window_end: datetime.datetime):
+        self._heap.clear()
+        self.window_end = window_end
+
+    @property
+    def next_due(self) -> datetime.datetime | None:
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: datetime.datetime) -> set:
+        phases = set()
+        while self._heap and self._heap[0][0] <= now:
+            phases.add(heapq.heappop(self._heap)[1])
+        return phases
+
+    async def wait(self, until: datetime.datetime):
+        """Спит до until или до ближайшего срока в очереди, если новый элемент оказался раньше."""
+        if self._heap:
+            until = min(until, self._heap[0][0])
+        timeout = (until - datetime.datetime.now()).total_seconds()
+        if timeout <= 0:
+            return
+        self._changed.clear()
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def __len__(self):
+        return len(self._heap)
+
+
+deadlines = DeadlineQueue()
+
+
+def on_key_changed(change: db.KeyChange):
+    """Ключ выдан или продлен (в любом процессе) - ставим его сроки в очередь сразу, не дожидаясь сверки."""
+    for due_at, phase in key_deadlines(change.order_id, change.expires_at):
+        deadlines.push(due_at, phase)
+
+
+class SchedulerRun:
+    """Один цикл планировщика: что его разбудило, сколько он длился и что сделала каждая фаза."""
+
+    def __init__(self, trigger: str, scheduled_at: datetime.datetime):
+        self.trigger = trigger
+        self.started_at = datetime.datetime.now()
+        # Опоздание старта: растет, когда фазы не укладываются в интервал между сроками
+        self.lag = max(0.0, (self.started_at - scheduled_at).total_seconds())
+        self.phases = {}  # Фаза -> PhaseStats.as_dict(); у упавшей фазы - еще и 'error'
+        self.error = None
+        self.duration = 0.0
+        self._started = time.monotonic()
+
+    def finish(self):
+        self.duration = time.monotonic() - self._started
+
+    def total(self, counter: str) -> int:
+        return sum(phase.get(counter, 0) for phase in self.phases.values())
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None or any('error' in phase for phase in self.phases.values())
+
+    def __str__(self):
+        return (f"{self.trigger} cycle: {self.duration:.1f}s, lag {self.lag:.1f}s, "
+                f"selected {self.total('selected')}, sent {self.total('sent')}, failed {self.total('failed')} "
+                f"(blocked {self.total('blocked')})" + (f", error: {self.error}" if self.error else ""))
+
+
+class RunHistory:
+    """Последние циклы (кольцевой буфер) и накопительные счетчики процесса для /metrics."""
+
+    PHASE_COUNTERS = ('selected', 'sent', 'failed', 'blocked', 'retries')
+
+    def __init__(self, maxlen: int):
+        self.runs = deque(maxlen=maxlen)
+        self.cycles = Counter()  # Триггер -> число циклов
+        self.errors = 0  # Циклов, в которых упала фаза или сам цикл
+        self.phase_totals = defaultdict(Counter)  # Фаза -> счетчики + 'seconds'
+
+    def add(self, run: SchedulerRun):
+        self.runs.append(run)
+        self.cycles[run.trigger] += 1
+        if run.failed:
+            self.errors += 1
+        for phase, stats in run.phases.items():
+            totals = self.phase_totals[phase]
+            totals['runs'] += 1
+            totals['seconds'] += stats.get('elapsed_seconds', 0)
+            for counter in self.PHASE_COUNTERS:
+                totals[counter] += stats.get(counter, 0)
+
+    @property
+    def last(self) -> SchedulerRun | None:
+        return self.runs[-1] if self.runs else None
+
+
+run_history = RunHistory(settings.SCHEDULER_RUN_HISTORY)
+
+
+async def run_phases(bot: Bot, phases, run: SchedulerRun):
+    for phase in PHASES:  # Порядок как в словаре: предупреждения раньше истечения
+        if phase in phases:
+            started = time.monotonic()
+            try:
+                stats = await PHASES[phase](bot)
+                run.phases[phase] = stats.as_dict()
+            except Exception as e:
+                log.error(f"Error in scheduler phase {phase}: {e}")
+                run.phases[phase] = {'elapsed_seconds': round(time.monotonic() - started, 3), 'error': str(e)}
+
+
+async def resync_deadlines():
+    """Перезагружает очередь сроками на SCHEDULER_LOOKAHEAD_SECONDS вперед."""
+    now = datetime.datetime.now()
+    window_end = now + datetime.timedelta(seconds=settings.SCHEDULER_LOOKAHEAD_SECONDS)
+    deadlines.reset(window_end)
+
+    # Предупреждение за 24 часа наступает раньше всех остальных сроков ключа
+    keys = await db.get_upcoming_key_deadlines(window_end + datetime.timedelta(hours=RENEWAL_WARNING_HOURS))
+    for key in keys:
+        for due_at, phase in key_deadlines(key.order_id, key.expires_at):
+            if due_at > now:
+                deadlines.push(due_at, phase)
+
+    reminder_delay = datetime.timedelta(hours=TRIAL_REMINDER_HOURS)
+    registered = await db.get_upcoming_trial_reminders(window_end - reminder_delay, now - reminder_delay)
+    for created_at in registered:
+        deadlines.push(created_at + reminder_delay, PHASE_TRIAL_REMINDER)
+
+    log.info(f"Scheduler resync: {len(deadlines)} deadlines until {window_end:%H:%M:%S}")
+
+
 async def check_expirations(bot: Bot):
-    """Главная задача планировщика."""
+    """
+    Главная задача планировщика.
+    Спит до ближайшего срока из очереди (а не опрашивает БД по таймеру) и запускает нужную фазу.
+    Очередь пополняется событиями выдачи/продления ключей (из других процессов - через KEY_CHANNEL)
+    и сверкой раз в SCHEDULER_RESYNC_SECONDS;
+    на сверке все фазы запускаются целиком - это догоняет пропущенное (простой бота, ошибки отправки).
+    """
     log.info("Starting background expiration checker...")
+    db.add_key_change_listener(on_key_changed)
+    # Подписка до первой сверки: изменение между сверкой и подпиской не потеряется
+    listener_conn = await db.start_key_change_listener()
+    resync_interval = datetime.timedelta(seconds=settings.SCHEDULER_RESYNC_SECONDS)
+    next_resync = datetime.datetime.now()
+    try:
+        while True:
+            now = datetime.datetime.now()
+            if now >= next_resync:
+                run = SchedulerRun(TRIGGER_RESYNC, next_resync)
+                next_resync = now + resync_interval
+                await run_cycle(bot, run, PHASES)
+            else:
+                due_at = deadlines.next_due  # Опоздание считаем от самого раннего наступившего срока
+                if phases := deadlines.pop_due(now):
+                    await run_cycle(bot, SchedulerRun(TRIGGER_DEADLINE, due_at), phases)
+
+            await deadlines.wait(next_resync)
+    finally:
+        # Лидерство потеряно или процесс останавливается
+        if listener_conn is not None:
+            await listener_conn.close()
+
+
+async def run_cycle(bot: Bot, run: SchedulerRun, phases):
+    """Выполняет цикл и записывает его в историю (память и таблицу scheduler_runs)."""
+    try:
+        await run_phases(bot, phases, run)
+        if run.trigger == TRIGGER_RESYNC:
+            await resync_deadlines()
+    except Exception as e:
+        log.error(f"Error in expiration checker task: {e}")
+        run.error = str(e)
+    run.finish()
+
+    run_history.add(run)
+    if run.total('selected') or run.failed:
+        log.info(f"Scheduler {run}")
+    try:
+        await db.save_scheduler_run(run.trigger, run.started_at, run.duration, run.lag, run.phases, run.error)
+    except Exception as e:
+        log.warning(f"Failed to save scheduler run: {e}")
+
+
+async def archive_stale_data():
+    """
+    Периодически переносит устаревшие заказы и ключи в архивные таблицы
+    и удаляет простаивающие общие корзины троттлинга.
+    """
+    log.info("Starting background archiver...")
     while True:
         try:
-            # === 1. ПРЕДУПРЕЖДЕНИЕ ЗА 24 ЧАСА (Платные ключи) ===
-            warning_keys = await db.get_keys_for_renewal_warning(hours=24)
-            for key in warning_keys:
-                try:
-                    await bot.send_message(
-                        key.user_id,
-                        f"🔔 **Напоминание:**\n\n"
-                        f"Ваш ключ для тарифа «{key.name}» истекает менее чем через 24 часа.\n"
-                        "Чтобы избежать прерывания, вы можете продлить его прямо сейчас.",
-                        reply_markup=get_renewal_kb(key.id),
-                        parse_mode="Markdown"
-                    )
-                    await db.mark_renewal_warning_sent(key.id)
-
-                    # CRM: Уведомление об отправке предупреждения
-                    await crm.notify_renewal_warning_sent(bot, key.user_id, key.name, 24)
-                except Exception as e:
-                    log.warning(f"Failed to send 24h warning to {key.user_id}: {e}")
-
-            # === 2. TASK 4: ПРЕДУПРЕЖДЕНИЕ ЗА 2 ЧАСА (Пробные ключи) ===
-            trial_warnings = await db.get_trial_keys_for_warning(hours=2)
-            for key in trial_warnings:
-                try:
-                    await bot.send_message(
-                        key.user_id,
-                        "⏳ **Ваш пробный период истекает через 2 часа!**\n\n"
-                        "Понравилась скорость? 🔥\n"
-                        "Продлите доступ сейчас со скидкой: **1 месяц (Финляндия) всего за 119₽** вместо 199₽!",
-                        reply_markup=get_trial_discount_kb(key.id),
-                        parse_mode="Markdown"
-                    )
-                    await db.mark_trial_warning_sent(key.id)
-
-                    # CRM: Уведомление об отправке предупреждения о триале
-                    await crm.notify_trial_warning_sent(bot, key.user_id)
-                except Exception as e:
-                    log.warning(f"Failed to send 2h trial warning to {key.user_id}: {e}")
-
-            # === 3. ИСТЕКШИЕ КЛЮЧИ (Task 3 update) ===
-            expired_keys = await db.get_keys_for_expiry_notification()
-            for key in expired_keys:
-                try:
-                    if key.order_id is None:
-                        # TASK 3: Сообщение об истечении триала с кнопкой продления
-                        await bot.send_message(
-                            key.user_id,
-                            "⌛️ **Ваш пробный период (24ч) истек.**\n\n"
-                            "Надеемся, вам понравилась скорость! 🇫🇮\n\n"
-                            "Чтобы продолжить пользоваться VPN, продлите подписку.\n\n"
-                            "💬 **Напишите в поддержку свой отзыв и получите 7 дней бесплатно!**",
-                            reply_markup=get_trial_expired_kb(key.id),
-                            parse_mode="Markdown"
-                        )
-                    else:
-                        # Обычное истечение платного ключа
-                        await bot.send_message(
-                            key.user_id,
-                            "❌ **Срок действия вашего ключа истек.**\n\n"
-                            "Вы можете продлить его, чтобы восстановить доступ.",
-                            reply_markup=get_renewal_kb(key.id),
-                            parse_mode="Markdown"
-                        )
-                    await db.mark_expiry_notification_sent(key.id)
-
-                    # CRM: Уведомление об истечении ключа
-                    await crm.notify_key_expired(bot, key.user_id, is_trial=(key.order_id is None))
-                except Exception as e:
-                    log.warning(f"Failed to send expiry notification to {key.user_id}: {e}")
-
-            # === 4. ЗАДАЧА 2: НАПОМИНАНИЕ О ТРИАЛЕ (КТО НЕ ВЗЯЛ) ===
-            users_to_remind = await db.get_users_for_trial_reminder(hours_min=24, hours_max=25)
-            for user_id in users_to_remind:
-                try:
-                    await bot.send_message(
-                        user_id,
-                        "👋 Привет!\n\n"
-                        "Вы были в боте 24 часа назад, но так и не попробовали наш VPN.\n\n"
-                        "Не упускайте шанс оценить премиум-скорость (Финляндия 🇫🇮) бесплатно!\n\n"
-                        "💬 Если нужна помощь — напишите в поддержку, мы всегда на связи!",
-                        reply_markup=get_take_trial_reminder_kb(),
-                        parse_mode="Markdown"
-                    )
-                    await db.mark_trial_reminder_sent(user_id)
-
-                    # CRM: Уведомление об отправке напоминания о триале
-                    await crm.notify_trial_reminder_sent(bot, user_id)
-                except Exception as e:
-                    log.warning(f"Failed to send trial reminder to {user_id}: {e}")
-                    # Если юзер заблочил бота, тоже ставим метку, чтоб не пытаться снова
-                    if "bot was blocked" in str(e).lower():
-                        await db.mark_trial_reminder_sent(user_id)
+            await db.archive_stale_rows()
+            if settings.THROTTLE_BACKEND == 'database':
+                await db.delete_idle_throttle_buckets(time.time())
+        except Exception as e:
+            log.error(f"Error in archiver task: {e}")
+
+        await asyncio.sleep(settings.ARCHIVE_INTERVAL_SECONDS)
+
 
+async def cleanup_fsm_states(storage):
+    """Периодически удаляет состояния FSM брошенных сценариев."""
+    log.info("Starting FSM states cleanup...")
+    while True:
+        try:
+            deleted = await storage.cleanup_expired()
+            if deleted:
+                log.info(f"FSM cleanup: удалено состояний {deleted}")
         except Exception as e:
-            log.error(f"Error in expiration checker task: {e}")
+            log.error(f"Error in FSM cleanup task: {e}")
 
-        await asyncio.sleep(600)  # Проверка каждые 10 минут
+        await asyncio.sleep(settings.FSM_CLEANUP_INTERVAL_SECONDS)
@@ -0,0 +1,204 @@
+"""
+Обработка апдейтов Telegram в фоне: вебхук отвечает сразу, апдейт ставится в очередь.
+
+- Очередь ограничена UPDATE_QUEUE_SIZE апдейтами. Если она заполнена, вебхук отвечает 503,
+  и Telegram доставит апдейт повторно позже.
+- UPDATE_WORKERS воркеров обрабатывают апдейты параллельно.
+- Апдейты одного чата обрабатываются строго по очереди и в порядке поступления.
+  Чат с длинной очередью не блокирует остальных: после каждого апдейта он встает в конец.
+- При остановке новые апдейты не принимаются (503), а принятые дорабатываются
+  в течение UPDATE_DRAIN_TIMEOUT_SECONDS.
+- Каждый апдейт выполняется в своей задаче, то есть со свежей копией contextvars,
+  как при обычной обработке aiogram.
+
+Стандартный handle_in_background aiogram создает задачу на каждый апдейт: без ограничения
+их числа и без порядка внутри чата (два быстрых нажатия могли обработаться наоборот).
+"""
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from collections import deque
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+from config import settings
+
+log = logging.getLogger(__name__)
+
+
+class LatencyHistogram:
+    """Гистограмма длительностей (секунды) с фиксированными границами, как histogram Prometheus."""
+
+    BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)  # Последний - больше всех границ (+Inf)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(self.BOUNDS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def cumulative(self):
+        """[(граница, число значений <= границы), ...], последняя граница - '+Inf'."""
+        total = 0
+        result = []
+        for bound, count in zip((*self.BOUNDS, '+Inf'), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+def order_key(update: dict):
+    """Ключ упорядочивания апдейта: ID чата, иначе ID пользователя, иначе update_id (без порядка)."""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        user = value.get('from')
+        if user:
+            return user['id']
+    return ('update', update.get('update_id'))
+
+
+class UpdateQueue:
+    """Ограниченная очередь с пулом воркеров и порядком обработки внутри ключа (чата)."""
+
+    def __init__(self, process, workers: int, maxsize: int):
+        self.process = process  # async process(item)
+        self.workers = workers
+        self.maxsize = maxsize
+        self._chats = {}  # Ключ -> deque[(item, время постановки)]; первый элемент обрабатывается
+        self._ready = asyncio.Queue()  # Ключи чатов, ожидающих воркера (каждый не больше одного раза)
+        self._tasks = []
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._closing = False
+
+        self.pending = 0  # Принято и еще не обработано
+        self.busy = 0  # Воркеров, обрабатывающих апдейт
+        self.busy_seconds = 0.0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_latency = LatencyHistogram()  # От постановки в очередь до начала обработки
+        self.process_latency = LatencyHistogram()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker(), name=f"update-worker-{i}") for i in range(self.workers)]
+        log.info(f"Update queue started: {self.workers} workers, up to {self.maxsize} updates")
+
+    def put_nowait(self, key, item) -> bool:
+        """Ставит item в очередь чата key. False - очередь заполнена или останавливается."""
+        if self._closing or self.pending >= self.maxsize:
+            self.rejected += 1
+            return False
+        queued = self._chats.get(key)
+        if queued is None:
+            self._chats[key] = deque([(item, time.monotonic())])
+            self._ready.put_nowait(key)
+        else:
+            # Чат уже ждет воркера или обрабатывается - воркер заберет апдейт после предыдущего
+            queued.append((item, time.monotonic()))
+        self.pending += 1
+        self._idle.clear()
+        return True
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queued = self._chats[key]
+            item, enqueued_at = queued[0]
+            started = time.monotonic()
+            self.wait_latency.observe(started - enqueued_at)
+            self.busy += 1
+            try:
+                # Отдельная задача - свой контекст (contextvars) на апдейт: закрепление за основной БД
+                # после записи (database/routing.py) не должно переживать апдейт и оставаться у воркера
+                await asyncio.create_task(self.process(item))
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                log.exception(f"Failed to process update of chat {key}: {e}")
+            finally:
+                elapsed = time.monotonic() - started
+                self.busy -= 1
+                self.busy_seconds += elapsed
+                self.process_latency.observe(elapsed)
+
+                queued.popleft()
+                if queued:
+                    self._ready.put_nowait(key)  # В конец: остальные чаты не ждут этот
+                else:
+                    del self._chats[key]
+                self.pending -= 1
+                if not self.pending:
+                    self._idle.set()
+
+    async def close(self, timeout: float):
+        """Перестает принимать апдейты и ждет обработки принятых (не дольше timeout)."""
+        self._closing = True
+        if self.pending:
+            log.info(f"Update queue: waiting for {self.pending} pending updates")
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                log.warning(f"Update queue: {self.pending} updates dropped on shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        return {
+            'pending': self.pending,
+            'maxsize': self.maxsize,
+            'chats': len(self._chats),
+            'workers': self.workers,
+            'busy': self.busy,
+            'processed': self.processed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+        }
+
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """Вебхук Telegram, который передает апдейты в UpdateQueue и сразу отвечает."""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, workers: int | None = None,
+                 maxsize: int | None = None, **data):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **data)
+        self.queue = UpdateQueue(
+            self._process,
+            workers=workers or settings.UPDATE_WORKERS,
+            maxsize=maxsize or settings.UPDATE_QUEUE_SIZE,
+        )
+
+    def register(self, app: web.Application, /, path: str, **kwargs) -> None:
+        super().register(app, path, **kwargs)
+        app.on_startup.append(self._start_queue)
+
+    async def _start_queue(self, app: web.Application):
+        self.queue.start()
+
+    async def _process(self, update: dict):
+        await self._background_feed_update(self.bot, update)
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        if not self.queue.put_nowait(order_key(update), update):
+            log.warning(f"Update queue is full ({self.queue.pending}), update {update.get('update_id')} rejected")
+            return web.Response(status=503)  # Telegram доставит апдейт повторно
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def close(self) -> None:
+        # Сессию бота закрываем только после того, как принятые апдейты обработаны
+        await self.queue.close(settings.UPDATE_DRAIN_TIMEOUT_SECONDS)
+        await super().close()
@@ -343,20 +343,13 @@ async def extend_key_with_referral_bonus(user_id: int, key_id: int, days: int) -
             log.warning(f"Недостаточно бонусных дней у пользователя {user_id}")
             return None
 
-        # Получаем ключ
-        key = await db.get_key_by_id(key_id)
-        if not key or key.user_id != user_id:
+        # Продлеваем ключ (только если он принадлежит пользователю)
+        key = await db.extend_key(key_id, datetime.timedelta(days=days), user_id=user_id)
+        if not key:
             # Возвращаем дни обратно
             await db.add_referral_balance(user_id, days)
             return None
-
-        # Вычисляем новую дату
-        now = datetime.datetime.now()
-        start_date = max(now, key.expires_at)
-        new_expiry = start_date + datetime.timedelta(days=days)
-
-        # Обновляем в БД
-        await db.update_key_expiry(key_id, new_expiry)
+        new_expiry = key.new_expires_at
 
         # Синхронизируем на панели X-UI
         try:
@@ -446,17 +439,17 @@ async def handle_payment_logic(bot: Bot, order_id: int, metadata: dict) -> tuple
             renewal_key_id = int(renewal_key_id_str)
             log.info(f"[PaymentLogic] Заказ {order_id} определен как ПРОДЛЕНИЕ ключа {renewal_key_id}.")
 
-            key_to_renew = await db.get_key_by_id(renewal_key_id)
             product = await db.get_product_by_id(product_id)
+            key_to_renew = None
+            if product:
+                key_to_renew = await db.extend_key(
+                    renewal_key_id, datetime.timedelta(days=product.duration_days), user_id=user_id
+                )
 
-            if not key_to_renew or not product or key_to_renew.user_id != user_id:
+            if not key_to_renew:
                 raise ValueError("Ключ или продукт для продления не найден или не принадлежит вам.")
 
-            now = datetime.datetime.now()
-            start_date = max(now, key_to_renew.expires_at)
-            new_expiry_date = start_date + datetime.timedelta(days=product.duration_days)
-
-            await db.update_key_expiry(renewal_key_id, new_expiry_date)
+            new_expiry_date = key_to_renew.new_expires_at
             log.info(f"Ключ {renewal_key_id} продлен до {new_expiry_date}.")
 
             # Синхронизируем срок действия на панели X-UI